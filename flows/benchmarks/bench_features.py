@@ -0,0 +1,58 @@
+""" Benchmark FeatureEngine.build on multi-season inputs against a per-team rolling baseline.
+
+    python benchmarks/bench_features.py --seasons 25
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.preprocessing import DataTransform, FeatureEngine  # noqa: E402
+from benchmarks.bench_transform import raw_seasons, timed  # noqa: E402
+
+
+def rolling_baseline(games, window: int = 10):
+    """ Rolling goals for per team and season with groupby().rolling(), the way it would be written by hand """
+    home = pd.DataFrame({'game': games.index, 'date': games['date'], 'team': games['home_team_id'].astype(str),
+                         'goals_for': games['home_goals'].astype('float64')})
+    away = pd.DataFrame({'game': games.index, 'date': games['date'], 'team': games['away_team_id'].astype(str),
+                         'goals_for': games['away_goals'].astype('float64')})
+    long = pd.concat([home, away], ignore_index=True).sort_values(['date', 'game'], kind='stable')
+    long['season'] = long['date'].dt.year + (long['date'].dt.month >= 7)
+
+    played = long.dropna(subset=['goals_for'])
+    played = played.assign(gf_avg=played.groupby(['team', 'season'])['goals_for'].transform(
+        lambda goals: goals.shift(1).rolling(window, min_periods=1).mean()
+    ))
+
+    # Unplayed games take the average as of the last played game
+    long = long.merge(played[['game', 'team', 'gf_avg']], on=['game', 'team'], how='left')
+    long['gf_avg'] = long.groupby(['team', 'season'])['gf_avg'].ffill()
+    return long.loc[long['team'] == long['game'].map(home.set_index('game')['team'])].set_index('game')['gf_avg']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the feature engine')
+    parser.add_argument('--seasons', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=1.0, help='Seconds FeatureEngine.build must stay under')
+    args = parser.parse_args()
+
+    games = DataTransform.seasons(raw_seasons(args.seasons))
+    baseline_time, baseline = timed(rolling_baseline, games, args.repeat)
+    engine_time, features = timed(FeatureEngine.build, games, args.repeat)
+
+    # The engine and the hand-written rolling window must agree on every played game
+    played = games['home_goals'].notna().to_numpy()
+    np.testing.assert_allclose(
+        features['home_gf_avg'].to_numpy()[played], baseline.sort_index().to_numpy()[played], equal_nan=True
+    )
+
+    print(f'Rows: {len(games)} ({args.seasons} seasons), features: {features.shape[1]}')
+    print(f'Rolling baseline (1 feature):  {baseline_time * 1000:8.1f} ms')
+    print(f'FeatureEngine ({features.shape[1]} features): {engine_time * 1000:8.1f} ms')
+    print(f'Budget {args.budget:.2f} s: {"PASS" if engine_time < args.budget else "FAIL"}')
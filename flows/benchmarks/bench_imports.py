@@ -0,0 +1,80 @@
+""" Benchmark cold-start latency of the flow entry points.
+
+    Each entry point is imported, and run with --help, in fresh interpreters. The report shows the median wall time,
+    the packages that took longest to import, and any backend that was loaded although no query or upload ran.
+    The budget applies to --help, which parses its arguments before pandas and Prefect are imported. Importing a
+    flow module still pays for both, since its tasks and flows are declared with Prefect decorators.
+
+    python benchmarks/bench_imports.py --repeat 5 --budget 2.0
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FLOWS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ['nhl_regular_seasons', 'nhl_team_stats', 'nhl_pipeline', 'nhl_backfill']
+
+# Only needed once a flow talks to Snowflake or S3
+LAZY_BACKENDS = ['snowflake.connector', 'prefect_snowflake', 'boto3', 'botocore', 'duckdb']
+
+
+def run(args) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=FLOWS_DIR, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def cold_start(module: str, repeat: int) -> dict:
+    """ Median seconds to import `module` and to print its --help, each in a new interpreter """
+    return {
+        'import': statistics.median(run(['-c', f'import {module}']) for _ in range(repeat)),
+        'help': statistics.median(run([f'{module}.py', '--help']) for _ in range(repeat)),
+    }
+
+
+def slowest_imports(module: str, top: int = 5) -> list:
+    """ (seconds, package) for the packages whose modules took longest to import, from -X importtime self times """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=FLOWS_DIR, capture_output=True, text=True
+    )
+    packages = {}
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[0].split(':')[-1].strip().isdigit():
+            continue
+        package = fields[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(fields[0].split(':')[-1]) / 1e6
+    return sorted(((seconds, package) for package, seconds in packages.items()), reverse=True)[:top]
+
+
+def loaded_backends(module: str) -> list:
+    code = f'import sys, {module}; print(",".join(m for m in {LAZY_BACKENDS!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], cwd=FLOWS_DIR, capture_output=True, text=True, check=True)
+    return [name for name in result.stdout.strip().split(',') if name]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cold-start latency of the flow entry points')
+    parser.add_argument('entry_points', nargs='*', default=ENTRY_POINTS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=2.0, help='Seconds every --help must stay under')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.entry_points:
+        timings = cold_start(module, args.repeat)
+        backends = loaded_backends(module)
+        within = timings['help'] < args.budget and not backends
+        failed |= not within
+
+        print(f'{module}: import {timings["import"]:.2f} s, --help {timings["help"]:.2f} s')
+        for seconds, name in slowest_imports(module):
+            print(f'    {seconds:6.3f} s  {name}')
+        if backends:
+            print(f'    Loaded at import: {", ".join(backends)}')
+        print(f'    Budget {args.budget:.2f} s: {"PASS" if within else "FAIL"}')
+
+    sys.exit(1 if failed else 0)
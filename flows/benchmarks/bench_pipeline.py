@@ -0,0 +1,281 @@
+""" Offline benchmark of the ingestion pipeline stages against a stored baseline.
+
+    Replays synthetic hockeyreference.com pages rendered from the sample CSVs (or recorded pages when present, see
+    benchmarks/fixtures.py) and multi-season scale-ups through the parse step of file_parser, the DataTransform transforms, CSV/Parquet serialization into S3
+    and COPY INTO Snowflake. The two full load routes, S3 upload + COPY and PUT to the table stage + COPY, are timed
+    end to end at every scale, and COPY of one new file by PATTERN or by FILES list as the prefix fills up. S3 and Snowflake are replaced by the local backends in src.local_backend, so no
+    credentials or network are needed.
+
+    python benchmarks/bench_pipeline.py                   # report
+    python benchmarks/bench_pipeline.py --compare         # exit 1 on a regression against benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --save-baseline   # store this machine's results as the baseline
+
+    Timings are divided by a fixed calibration workload before they are compared. That does not make a baseline
+    portable: a baseline is only meaningful on the machine and library versions it was recorded with. Elsewhere,
+    including CI, --compare is advisory.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+
+# Local stand-ins for S3 and Snowflake, read by src.local_backend when they are first used.
+WAREHOUSE_DIR = tempfile.mkdtemp(prefix='nhl_bench_')
+os.environ['NHL_S3_BACKEND'] = 'local'
+os.environ['NHL_LOCAL_WAREHOUSE_DIR'] = WAREHOUSE_DIR
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fixtures  # noqa: E402
+from src.extract import parse_source  # noqa: E402
+from src.helpers import write_chunks  # noqa: E402
+from src.local_backend import LocalConnection  # noqa: E402
+from src.preprocessing import DataTransform  # noqa: E402
+from src.snowflake_queries import (  # noqa: E402
+    snowflake_stages, snowflake_schema, snowflake_ingestion, snowflake_stage_ingestion
+)
+from src.storage import upload_frame  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+BUCKET, DB, SCHEMA = 'nhl-bench', 'nhl_bench', 'raw'
+
+
+def calibrate(repeat: int = 5) -> float:
+    """ Seconds taken by a fixed mix of interpreter and NumPy work on this machine """
+    rng = np.random.default_rng(0)
+    values = rng.random(1_000_000)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        np.sort(values)
+        sum(i * i for i in range(200_000))
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """ Latency percentiles over `repeat` runs after a warm-up, then one traced run for peak Python memory """
+    func(*(setup() if setup else ()))
+
+    timings = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'p50_s': float(np.percentile(timings, 50)),
+        'p95_s': float(np.percentile(timings, 95)),
+        'p99_s': float(np.percentile(timings, 99)),
+        'peak_mb': peak / 1e6,
+    }
+
+
+def prepare_warehouse():
+    conn = LocalConnection()
+    curs = conn.cursor()
+    for queries in (snowflake_stages(DB, SCHEMA, BUCKET), snowflake_schema(DB, SCHEMA)):
+        for query in queries.values():
+            curs.execute(query)
+    return conn
+
+
+def cases(scales):
+    """ (name, rows, func, setup) for every benchmarked stage """
+    conn = prepare_warehouse()
+    curs = conn.cursor()
+
+    def copy_into(table, source, file_format):
+        # FORCE reloads the same staged file on every run
+        query = snowflake_ingestion(DB, SCHEMA, table, source, file_format)['ingest_from_stage']
+        query = query.strip().rstrip(';') + ' FORCE = TRUE'
+
+        def load():
+            curs.execute(f'DELETE FROM {DB}.{SCHEMA}.{table}')
+            curs.execute(query)
+        return load
+
+    def s3_route(table, frame, key, file_format):
+        copy = copy_into(table, key.split('/')[0], file_format)
+
+        def load():
+            upload_frame(frame, BUCKET, key, file_format)
+            copy()
+        return load
+
+    def stage_route(table, frame, file_format, parallel=4):
+        # Same steps as src.helpers.snowflake_stage_load, on the benchmark cursor instead of the Prefect pool
+        def load():
+            curs.execute(f'DELETE FROM {DB}.{SCHEMA}.{table}')
+            with tempfile.TemporaryDirectory() as directory:
+                write_chunks(frame, directory, table, file_format, max_workers=parallel)
+                queries = snowflake_stage_ingestion(DB, SCHEMA, table, directory, uuid.uuid4().hex, file_format, parallel)
+                for query in queries.values():
+                    curs.execute(query)
+        return load
+
+    standings = fixtures.page('standings')
+    teams_raw = parse_source(standings, 'teams')
+    teams = DataTransform.teams(teams_raw.copy())
+    yield 'parse_standings', len(teams_raw), lambda: parse_source(standings, 'teams'), None
+    yield 'transform_teams', len(teams_raw), DataTransform.teams, lambda: (teams_raw.copy(),)
+
+    for n_seasons in scales:
+        games = fixtures.page('games', n_seasons)
+        raw = parse_source(games, 'seasons')
+        seasons = DataTransform.seasons(raw)
+        encoded = seasons.rename(columns={'away_team_id': 'away_team', 'home_team_id': 'home_team'})
+        rows, tag = len(raw), f'{n_seasons}x'
+
+        yield f'parse_games_{tag}', rows, lambda page=games: parse_source(page, 'seasons'), None
+        yield f'transform_seasons_{tag}', rows, lambda frame=raw: DataTransform.seasons(frame), None
+        yield f'encoding_full_{tag}', rows, DataTransform.encoding_full, lambda frame=encoded: (frame.copy(), 'date')
+
+        for file_format in ('csv', 'parquet'):
+            key = f'seasons_{tag}/NHL_bench.{file_format}'
+            yield (
+                f'serialize_{file_format}_{tag}', rows,
+                lambda frame=seasons, key=key, fmt=file_format: upload_frame(frame, BUCKET, key, fmt), None
+            )
+            yield (
+                f'copy_into_{file_format}_{tag}', rows,
+                copy_into('regular_season', f'seasons_{tag}', file_format), None
+            )
+            yield (
+                f'load_s3_{file_format}_{tag}', rows,
+                s3_route('regular_season', seasons, f'load_{tag}/NHL_bench.{file_format}', file_format), None
+            )
+            yield f'load_stage_{file_format}_{tag}', rows, stage_route('regular_season', seasons, file_format), None
+
+    for file_format in ('csv', 'parquet'):
+        upload_frame(teams, BUCKET, f'teams/NHL_bench.{file_format}', file_format)
+        yield (
+            f'copy_into_{file_format}_teams', len(teams),
+            copy_into('team_stats', 'teams', file_format), None
+        )
+
+    # One new snapshot in a prefix holding `n_files` snapshots that were loaded before
+    for n_files in (10, 1000):
+        prefix = f'snapshots_{n_files}'
+        for idx in range(n_files):
+            upload_frame(teams, BUCKET, f'{prefix}/NHL_bench_{idx:05d}.csv')
+        curs.execute(snowflake_ingestion(DB, SCHEMA, 'team_stats', prefix)['ingest_from_stage'])
+
+        def new_snapshot(prefix=prefix):
+            upload_frame(teams, BUCKET, f'{prefix}/NHL_bench_new.csv')
+            return ()
+
+        by_pattern = snowflake_ingestion(DB, SCHEMA, 'team_stats', prefix)['ingest_from_stage']
+        by_files = snowflake_ingestion(DB, SCHEMA, 'team_stats', prefix, files=['NHL_bench_new.csv'])['ingest_files_0']
+        yield f'copy_pattern_{n_files}_files', len(teams), lambda query=by_pattern: curs.execute(query), new_snapshot
+        yield f'copy_manifest_{n_files}_files', len(teams), lambda query=by_files: curs.execute(query), new_snapshot
+
+
+def run(scales, repeat: int) -> dict:
+    results = {}
+    # The pipeline modules print previews and queries, which would swamp the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, rows, func, setup in cases(scales):
+            results[name] = measure(func, repeat, setup)
+            results[name]['rows'] = rows
+
+    for result in results.values():
+        result['rows_per_s'] = result['rows'] / result['p50_s'] if result['p50_s'] else None
+    return results
+
+
+def compare(results: dict, calibration: float, baseline: dict, tolerance: float, floor_ms: float = 2.0) -> list:
+    """ Stages whose normalized p50 latency or peak memory grew by more than `tolerance`.
+        Latency changes under `floor_ms` are timer noise and never count.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        latency = (result['p50_s'] / calibration) / (base['p50_s'] / baseline['calibration_s'])
+        memory = result['peak_mb'] / base['peak_mb'] if base['peak_mb'] else 1.0
+        if latency > 1 + tolerance and (result['p50_s'] - base['p50_s']) * 1000 > floor_ms:
+            regressions.append(f'{name}: p50 latency {latency:.2f}x the baseline')
+        if memory > 1 + tolerance:
+            regressions.append(f'{name}: peak memory {memory:.2f}x the baseline')
+    return regressions
+
+
+def load_routes(results: dict) -> dict:
+    """ {'csv_1x': 'stage', ...}: the faster full load route for every format and scale """
+    routes = {}
+    for name in results:
+        if name.startswith('load_s3_'):
+            case = name[len('load_s3_'):]
+            stage = results.get(f'load_stage_{case}')
+            if stage is not None:
+                routes[case] = 'stage' if stage['p50_s'] < results[name]['p50_s'] else 's3'
+    return routes
+
+
+def report(results: dict):
+    print(f'{"stage":<26} {"rows":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"rows/s":>12} {"peak MB":>9}')
+    for name, result in results.items():
+        print(
+            f'{name:<26} {result["rows"]:>8} {result["p50_s"] * 1000:>9.2f} {result["p95_s"] * 1000:>9.2f} '
+            f'{result["p99_s"] * 1000:>9.2f} {result["rows_per_s"]:>12,.0f} {result["peak_mb"]:>9.2f}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the ingestion pipeline')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 5, 20], help='Seasons per synthetic page')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--compare', action='store_true', help='Fail on a regression against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed growth before failing. Default: 25%%')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--record', action='store_true', help='Record hockeyreference.com pages as fixtures and exit')
+    parser.add_argument('--endpoint', default='https://www.hockey-reference.com/leagues/')
+    parser.add_argument('--year', type=int, default=2024)
+    args = parser.parse_args()
+
+    if args.record:
+        print('\n'.join(fixtures.record_pages(args.endpoint, args.year)))
+        sys.exit(0)
+
+    calibration = calibrate()
+    results = run(args.scales, args.repeat)
+    report(results)
+    print('Faster load route: ' + ', '.join(f'{case} -> {route}' for case, route in load_routes(results).items()))
+    print(f'Calibration: {calibration * 1000:.1f} ms on {platform.node()} ({platform.machine()})')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'machine': f'{platform.system()} {platform.machine()} {platform.python_version()}',
+                'calibration_s': calibration,
+                'cases': results,
+            }, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, calibration, baseline, args.tolerance)
+        if regressions:
+            print('Performance regressions against the baseline:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+        print(f'No regressions beyond {args.tolerance:.0%} against the baseline')
@@ -0,0 +1,98 @@
+""" Benchmark DataTransform.seasons against the previous row-wise implementation on multi-season inputs.
+
+    python benchmarks/bench_transform.py --seasons 20
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.preprocessing import DataTransform  # noqa: E402
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'NHL_2024_regular_season.csv')
+
+
+def raw_seasons(n_seasons: int) -> pd.DataFrame:
+    """ Scale the sample season up to `n_seasons` in the raw shape produced by the page parser """
+    sample = pd.read_csv(SAMPLE)
+    frames = []
+    for offset in range(n_seasons):
+        minutes = sample['length_of_game_min']
+        frames.append(pd.DataFrame({
+            'Date': (pd.to_datetime(sample['date']) - pd.DateOffset(years=offset)).dt.strftime('%Y-%m-%d'),
+            'Visitor': sample['away_team_id'],
+            'G': sample['away_goals'],
+            'Home': sample['home_team_id'],
+            'G.1': sample['home_goals'],
+            'LOG': np.where(
+                minutes.notna(),
+                (minutes // 60).astype('Int64').astype(str) + ':' + (minutes % 60).astype('Int64').astype(str).str.zfill(2),
+                None
+            ),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def legacy_seasons(dataframe):
+    """ The row-wise transform DataTransform.seasons replaced, kept as the benchmark baseline """
+    dataframe = dataframe.rename(columns=({
+        'Date': 'date', 'Visitor': 'away_team_id', 'Home': 'home_team_id', 'G': 'away_goals', 'G.1': 'home_goals',
+        'LOG': 'length_of_game_min'
+    }))
+    dataframe = dataframe[
+        ['date', 'away_team_id', 'away_goals', 'home_team_id', 'home_goals', 'length_of_game_min']
+    ].copy()
+    dataframe['updated_at'] = dt.now()
+    dataframe['length_of_game_min'] = dataframe['length_of_game_min'].apply(
+        lambda x: (int(str(x).split(":")[0]) * 60) + (int(str(x).split(":")[1])) if str(x).lower() not in ('nan', 'none') else x
+    )
+    dataframe.date = dataframe.date.apply(pd.to_datetime)
+    return dataframe
+
+
+def comparable(dataframe):
+    """ Values of a transformed frame independent of the dtypes used to hold them """
+    return pd.DataFrame({
+        'date': pd.to_datetime(dataframe['date']),
+        'away_team_id': dataframe['away_team_id'].astype(str),
+        'away_goals': pd.to_numeric(dataframe['away_goals']).astype('float64'),
+        'home_team_id': dataframe['home_team_id'].astype(str),
+        'home_goals': pd.to_numeric(dataframe['home_goals']).astype('float64'),
+        'length_of_game_min': pd.to_numeric(dataframe['length_of_game_min']).astype('float64'),
+    }).reset_index(drop=True)
+
+
+def timed(func, dataframe, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(dataframe)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the regular season transform')
+    parser.add_argument('--seasons', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    raw = raw_seasons(args.seasons)
+    legacy_time, legacy = timed(legacy_seasons, raw, args.repeat)
+    vector_time, vector = timed(DataTransform.seasons, raw, args.repeat)
+
+    # Both paths must agree on every value
+    pd.testing.assert_frame_equal(comparable(legacy), comparable(vector))
+
+    legacy_mb = legacy.memory_usage(deep=True).sum() / 1e6
+    vector_mb = vector.memory_usage(deep=True).sum() / 1e6
+    print(f'Rows: {len(raw)} ({args.seasons} seasons)')
+    print(f'Legacy:     {legacy_time * 1000:8.1f} ms  {legacy_mb:7.2f} MB')
+    print(f'Vectorized: {vector_time * 1000:8.1f} ms  {vector_mb:7.2f} MB')
+    print(f'Speedup: {legacy_time / vector_time:.1f}x, memory: {legacy_mb / vector_mb:.1f}x smaller')
@@ -0,0 +1,127 @@
+""" Page fixtures for the benchmarks.
+
+    Recorded hockeyreference.com pages are replayed from benchmarks/fixtures/ when present. Record them once with
+        python benchmarks/bench_pipeline.py --record --year 2024
+    Otherwise synthetic pages are rendered from the sample CSVs in flows/data, with the table layout src.extract
+    expects. They also provide the multi-season scale-ups. No recorded pages are committed, so the benchmarks do
+    not catch changes in the real page layout.
+"""
+import gzip
+import html
+import os
+
+import numpy as np
+import pandas as pd
+
+FLOWS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(FLOWS_DIR, 'data')
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+SEASONS_SAMPLE = os.path.join(DATA_DIR, 'NHL_2024_regular_season.csv')
+TEAMS_SAMPLE = os.path.join(DATA_DIR, 'NHL_2024_team_stats.csv')
+
+# Divisions of the sample standings, in page order
+DIVISIONS = {
+    'standings_EAS': {'Atlantic Division': 8, 'Metropolitan Division': 8},
+    'standings_WES': {'Central Division': 8, 'Pacific Division': 8},
+}
+
+
+def _cell(value, tag='td'):
+    text = '' if value is None or (isinstance(value, float) and np.isnan(value)) else html.escape(str(value))
+    return f'<{tag}>{text}</{tag}>'
+
+
+def _page(body: str) -> bytes:
+    # Page chrome so the parser has to skip content that is not a requested table, as on the real site
+    chrome = ''.join(f'<div class="nav"><ul>{"".join(f"<li>{idx}</li>" for idx in range(40))}</ul></div>' for _ in range(5))
+    return f'<html><head><title>NHL</title></head><body>{chrome}{body}{chrome}</body></html>'.encode()
+
+
+def games_page(n_seasons: int = 1) -> bytes:
+    """ Schedule page shaped like NHL_{year}_games.html, scaled up to `n_seasons` copies of the sample season """
+    sample = pd.read_csv(SEASONS_SAMPLE)
+    minutes = sample['length_of_game_min']
+    log = np.where(
+        minutes.notna(),
+        (minutes // 60).astype('Int64').astype(str) + ':' + (minutes % 60).astype('Int64').astype(str).str.zfill(2),
+        None
+    )
+    dates = pd.to_datetime(sample['date'])
+
+    rows = []
+    for offset in range(n_seasons):
+        season_dates = (dates - pd.DateOffset(years=offset)).dt.strftime('%Y-%m-%d')
+        for date, away, away_goals, home, home_goals, length in zip(
+                season_dates, sample['away_team_id'], sample['away_goals'],
+                sample['home_team_id'], sample['home_goals'], log
+        ):
+            goals = [None if np.isnan(g) else int(g) for g in (away_goals, home_goals)]
+            rows.append(
+                '<tr>' + _cell(date, 'th') + _cell('7:00 PM') + _cell(away) + _cell(goals[0]) + _cell(home)
+                + _cell(goals[1]) + _cell('OT' if length and length > '2:40' else '') + _cell('18,000')
+                + _cell(length) + _cell(None) + '</tr>'
+            )
+
+    header = ''.join(_cell(name, 'th') for name in ['Date', 'Time', 'Visitor', 'G', 'Home', 'G', '', 'Att.', 'LOG', 'Notes'])
+    table = f'<table id="games"><thead><tr>{header}</tr></thead><tbody>{"".join(rows)}</tbody></table>'
+    return _page(table)
+
+
+def standings_page() -> bytes:
+    """ League page shaped like NHL_{year}.html. The western standings sit inside an HTML comment, as on the site. """
+    sample = pd.read_csv(TEAMS_SAMPLE, dtype=str).drop(columns=['updated_at'])
+    columns = [''] + list(sample.columns[1:])
+
+    tables, start = [], 0
+    for table_id, divisions in DIVISIONS.items():
+        rows = []
+        for division, size in divisions.items():
+            rows.append(f'<tr class="thead onecell">{_cell(division)}</tr>')
+            for _, team in sample.iloc[start:start + size].iterrows():
+                rows.append('<tr>' + ''.join(_cell(value) for value in team) + '</tr>')
+            start += size
+        header = ''.join(_cell(name, 'th') for name in columns)
+        tables.append(f'<table id="{table_id}"><thead><tr>{header}</tr></thead><tbody>{"".join(rows)}</tbody></table>')
+
+    # Secondary tables the parser must skip
+    filler = ''.join(
+        f'<!-- <table id="filler_{idx}"><tbody>{"<tr><td>0</td></tr>" * 50}</tbody></table> -->' for idx in range(10)
+    )
+    return _page(tables[0] + filler + f'<!-- {tables[1]} -->')
+
+
+def recorded_page(name: str):
+    """ Bytes of a recorded page, or None when it has not been recorded """
+    path = os.path.join(FIXTURE_DIR, f'{name}.html.gz')
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+def record_pages(endpoint: str, year: int) -> list:
+    """ Download the pages used by the benchmarks into benchmarks/fixtures/ """
+    from src.connectors import get_legacy_session
+    from src.helpers import build_url
+
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    written = []
+    for source, name in (('seasons', 'games'), ('teams', 'standings')):
+        url, _ = build_url(source, endpoint, year)
+        response = get_legacy_session().get(url)
+        response.raise_for_status()
+        path = os.path.join(FIXTURE_DIR, f'{name}.html.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(response.content)
+        written.append(path)
+    return written
+
+
+def page(name: str, n_seasons: int = 1) -> bytes:
+    """ Recorded page when available for a single season, rendered page otherwise """
+    if n_seasons == 1:
+        recorded = recorded_page(name)
+        if recorded is not None:
+            return recorded
+    return games_page(n_seasons) if name == 'games' else standings_page()
@@ -0,0 +1,323 @@
+import argparse
+
+import datetime as dt
+import time
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="SnowflakeBackfill",
+        description="Rebuild a range of seasons from hockeyreference.com into S3 and Snowflake"
+    )
+
+    parser.add_argument('sources', nargs='+', choices=['seasons', 'teams'])
+    parser.add_argument('--endpoint', default='https://www.hockey-reference.com/leagues/')
+    parser.add_argument('--start_year', type=int, required=True)
+    parser.add_argument('--end_year', type=int, default=dt.datetime.now().year)
+    parser.add_argument('--s3_bucket_name', default='nhl-data-raw')
+    parser.add_argument('--snowflake_conn', default='standard')
+    parser.add_argument('--db', default='nhl_stats')
+    parser.add_argument('--schema', default='raw')
+    parser.add_argument('--env', default='development')
+    parser.add_argument('--max_workers', type=int, default=4)
+    parser.add_argument('--min_interval', type=float, default=3.0)
+    parser.add_argument('--file_format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the on-disk HTTP cache')
+
+    return parser
+
+
+if __name__ in "__main__":
+    # Parsed before pandas and Prefect are imported, so --help and argument errors return at once
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.start_year > args.end_year:
+        parser.error(f'--start_year {args.start_year} is after --end_year {args.end_year}')
+
+from src.connectors import s3_conn, close_connection_pools  # noqa: E402
+from src.fetcher import fetch_pages  # noqa: E402
+from src.http_cache import get_http_cache  # noqa: E402
+from src.snowflake_queries import *  # noqa: E402
+from src.preprocessing import DataTransform  # noqa: E402
+from src.extract import parse_source  # noqa: E402
+from src.schema_registry import get_schema_registry  # noqa: E402
+from src.lake import lake_store  # noqa: E402
+from src.serializers import FRAME_TASK  # noqa: E402
+from src.profiling import get_profiler, export_profile  # noqa: E402
+from src import incremental  # noqa: E402
+
+from src.helpers import build_url, snowflake_query_exec  # noqa: E402
+from src.storage import upload_frame, get_run_manifest  # noqa: E402
+from nhl_regular_seasons import snowflake_base_model  # noqa: E402
+
+# Orchestration
+from prefect import flow, task, get_run_logger  # noqa: E402
+
+# Data transformations
+transform = DataTransform
+
+# Destination table and transformation per source. Team seasons are validated against team_stats but merged into
+# team_stats_history from the `history` prefix, so reloading a season never duplicates its rows.
+SOURCES = {
+    'seasons': {'table': 'regular_season', 'transform': transform.seasons},
+    'teams': {'table': 'team_stats', 'transform': transform.teams, 'history': 'teams_history'},
+}
+
+
+def transform_page(source, year, content):
+    """ Parse and transform one fetched page. Runs inside the backfill worker pool. """
+    with get_profiler().stage('file_parser', source=source, year=year) as stage:
+        stage.bytes = len(content)
+        dataframe = parse_source(content, source)
+        stage.phase('parse')
+        dataframe = SOURCES[source]['transform'](dataframe)
+        stage.phase('transform')
+        stage.rows = len(dataframe)
+
+    return dataframe
+
+
+@task(name="backfill_fetch", **FRAME_TASK)
+def backfill_fetch(
+        db, sources, endpoint, years, snowflake_conn,
+        max_workers: int = 4, min_interval: float = 3.0, cache: bool = True, schema: str = 'raw'
+):
+    """ Fetch every source and year with the async fetcher, then transform the pages with a bounded worker pool.
+        Requests share `max_workers` connections and are rate limited to one every `min_interval` seconds per host.
+    """
+    logging = get_run_logger()
+    pages = {}
+    for source in sources:
+        for year in years:
+            url, filename = build_url(source, endpoint, year)
+            # Team snapshots are date-stamped to match nhl_team_stats
+            if source == 'teams':
+                filename = f'{filename}_{dt.date.today()}'
+            pages[url] = (source, year, filename)
+
+    # Finished seasons are served from the HTTP cache without touching the network
+    logging.info(f'Fetching {len(pages)} pages')
+    fetched = fetch_pages(
+        list(pages), concurrency=max_workers, rate=1 / min_interval,
+        cache=get_http_cache() if cache else None, logger=logging
+    )
+
+    results = {source: {} for source in sources}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for url, page in fetched.items():
+            source, year, filename = pages[url]
+            if not page.ok:
+                # Missing seasons (e.g. the 2005 lockout) should not fail the whole backfill
+                logging.error(f'Failed to retrieve {source} for {year}: {page.error}')
+                continue
+            futures[pool.submit(transform_page, source, year, page.content)] = (source, year, filename)
+
+        for future in as_completed(futures):
+            source, year, filename = futures[future]
+            try:
+                results[source][year] = filename, future.result()
+                logging.info(f'Retrieved {source} for {year}: {len(results[source][year][1])} rows')
+            except Exception as e:
+                logging.error(f'Failed to transform {source} for {year}: {e}')
+
+    # Check column mappings against the cached table definitions, loaded at most once for the whole backfill.
+    # Older seasons can have a different layout (e.g. T instead of OL before 2005-06), so a season that does not
+    # match is skipped like a missing page rather than stopping every other season.
+    logging.info('Checking column mappings...')
+    registry = get_schema_registry()
+    skipped = []
+    for source in sources:
+        for year, (_, dataframe) in sorted(results[source].items()):
+            problems = registry.validate(dataframe, db, schema, SOURCES[source]['table'], snowflake_conn)
+            if problems:
+                logging.error(f'Skipping {source} for {year}, columns do not match the destination table: {problems}')
+                del results[source][year]
+                skipped.append(f'{source} {year}')
+    if skipped:
+        logging.warning(f'Seasons skipped by the column check: {skipped}')
+
+    return results
+
+
+@task(name="backfill_s3_upload", **FRAME_TASK)
+@s3_conn
+def backfill_s3_parser(
+        results, s3_bucket_name: str = 'nhl-data-raw', max_workers: int = 4, file_format: str = 'csv'
+):
+    """ Stream every fetched frame to S3 concurrently through the shared client. Team seasons are staged as history
+        rows, as CSV, which the history merge reads positionally.
+    """
+    logging = get_run_logger()
+
+    def upload(source, year, filename, data):
+        folder, fmt = source, file_format
+        if 'history' in SOURCES[source]:
+            data, folder, fmt = incremental.changed_team_rows(data, None, year), SOURCES[source]['history'], 'csv'
+
+        # Each file streams its own parts serially; files are uploaded in parallel across the pool
+        with get_profiler().stage('s3_parser', source=source, file=filename) as stage:
+            stage.bytes = upload_frame(data, s3_bucket_name, f'{folder}/{filename}.{fmt}', fmt, max_workers=1)
+            stage.rows = len(data)
+        return filename
+
+    uploaded = {source: [] for source in results}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(upload, source, year, filename, data): source
+                for source, years in results.items() for year, (filename, data) in years.items()
+            }
+            for future in as_completed(futures):
+                uploaded[futures[future]].append(future.result())
+                logging.info(f'Successfully uploaded {future.result()} to S3')
+
+    except Exception as e:
+        logging.error(f'An error occurred when storing data in S3: {e}')
+        sys.exit(1)
+
+    return uploaded
+
+
+@task(name="backfill_snowflake_load")
+def backfill_snowflake_load(db, schema, source, years, filenames, snowflake_conn, file_format: str = 'csv'):
+    """ Clear the games of every backfilled season in one session, then load the new files by name with batched
+        COPY INTO. Rows are deleted by game date: every backfilled row carries this run's load date in updated_at.
+    """
+    logging = get_run_logger()
+    table = SOURCES[source]['table']
+
+    with get_profiler().stage('snowflake_load', table=table, mode='backfill') as stage:
+        # DEDUPE FROM SNOWFLAKE
+        cleanup = {}
+        for year in years:
+            cleanup.update({
+                f'{idx}_{year}': query for idx, query in snowflake_season_cleanup(db, schema, table, year).items()
+            })
+        if cleanup:
+            logging.info(f"Deduplicating record data for {len(years)} seasons")
+            snowflake_query_exec(cleanup, method=snowflake_conn, concurrent=True)
+        stage.phase('cleanup')
+
+        # INGEST RAW DATA TO SNOWFLAKE
+        # Files of cleared seasons are forced past the load history
+        logging.info(f"Loading {len(filenames)} files into {table}")
+        snowflake_query_exec(
+            snowflake_backfill_ingestion(db, schema, table, source, filenames, file_format, force=bool(cleanup)),
+            method=snowflake_conn
+        )
+        stage.phase('copy')
+
+    return
+
+
+@task(name="backfill_history_load")
+def backfill_history_load(db, schema, source, filenames, snowflake_conn):
+    """ Merge every backfilled team season into team_stats_history in one session. Rows whose hash is already
+        current are skipped, so a season reloaded on a later day adds nothing unless its stats changed.
+    """
+    logging = get_run_logger()
+    folder = SOURCES[source]['history']
+
+    with get_profiler().stage('snowflake_load', table=TEAM_HISTORY_TABLE, mode='backfill'):
+        queries = {}
+        for filename in sorted(filenames):
+            queries.update({
+                f'{idx}_{filename}': query
+                for idx, query in snowflake_team_history_merge(db, schema, folder, filename).items()
+            })
+        logging.info(f"Merging {len(filenames)} files into {TEAM_HISTORY_TABLE}")
+        snowflake_query_exec(queries, method=snowflake_conn)
+
+    return
+
+
+@flow(
+    name='nhl_backfill', retries=1, retry_delay_seconds=5, log_prints=True
+)
+def nhl_backfill(
+        sources, endpoint, start_year, end_year,
+        s3_bucket_name, db, schema,
+        snowflake_conn, env,
+        max_workers: int = 4, min_interval: float = 3.0, cache: bool = True,
+        file_format: str = 'csv'
+):
+    start = time.time()
+    logging = get_run_logger()
+    try:
+        invalid = [source for source in sources if source not in SOURCES]
+        if invalid:
+            logging.error(f'Invalid source specified: {invalid}')
+            sys.exit(1)
+
+        years = list(range(int(start_year), int(end_year) + 1))
+        if not years:
+            logging.error(f'Invalid season range: {start_year} is after {end_year}')
+            sys.exit(1)
+        logging.info(f'Backfilling {sources} for {years[0]}-{years[-1]}')
+
+        # Prepare snowflake stages and schemas once for the whole backfill
+        logging.info('Preparing snowflake base model for ingestion')
+        snowflake_base_model(snowflake_conn, s3_bucket_name, db, schema)
+
+        logging.info("Extracting raw data from source, formatting and transformation")
+        results = backfill_fetch(db, sources, endpoint, years, snowflake_conn, max_workers, min_interval, cache, schema)
+
+        if env == "development":
+            logging.info(
+                "\n"
+                "\t Backfill executed successfully in development. "
+                "\t No data was uploaded to S3 or Snowflake. "
+                "\t To try testing out your ingestion completely, use the production branch."
+                "\n"
+            )
+        else:
+            # KEEP EVERY SEASON IN THE LOCAL DATA LAKE
+            for source, fetched in results.items():
+                for year, (_, dataframe) in fetched.items():
+                    lake_store.fn(dataframe, source, year)
+
+            # INGEST RAW DATA TO S3
+            uploaded = backfill_s3_parser(
+                results, s3_bucket_name=s3_bucket_name, max_workers=max_workers, file_format=file_format
+            )
+
+            # DEDUPE SOURCE TABLES & TRANSFER RAW DATA
+            for source, filenames in uploaded.items():
+                if filenames and 'history' in SOURCES[source]:
+                    backfill_history_load(db, schema, source, filenames, snowflake_conn)
+                elif filenames:
+                    backfill_snowflake_load(
+                        db, schema, source, sorted(results[source]), filenames, snowflake_conn, file_format
+                    )
+
+        end = time.time() - start
+        logging.info(f'Process Completed. Time elapsed: {end}')
+    finally:
+        # Release every pooled Snowflake session on flow exit
+        close_connection_pools()
+        try:
+            logging.info(f'Stage profile written to {export_profile("nhl_backfill")}')
+        except Exception as e:
+            # Reporting must not replace the outcome of the run
+            logging.warning(f'Could not export the stage profile: {e}')
+        try:
+            for manifest in get_run_manifest().save('nhl_backfill'):
+                logging.info(f'Run manifest written to {manifest}')
+        except Exception as e:
+            logging.warning(f'Could not write the run manifest: {e}')
+
+
+if __name__ in "__main__":
+    print(f"Received Arguments: {args}")
+
+    # Execute the pipeline
+    nhl_backfill(
+        args.sources, args.endpoint, args.start_year, args.end_year,
+        args.s3_bucket_name, args.db, args.schema,
+        args.snowflake_conn, args.env,
+        args.max_workers, args.min_interval, not args.no_cache,
+        args.file_format
+    )
@@ -0,0 +1,200 @@
+import argparse
+
+import datetime as dt
+import time
+import sys
+
+from src.snowflake_queries import DEFAULT_CHUNK_ROWS
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="SnowflakePipeline",
+        description="Move regular season and team stats data to S3 and Snowflake in a single run"
+    )
+
+    parser.add_argument('sources', nargs='*', help="Any of ['seasons', 'teams']. Defaults to every source")
+    parser.add_argument('--endpoint', default='https://www.hockey-reference.com/leagues/')
+    parser.add_argument('--year', default=dt.datetime.now().year)
+    parser.add_argument('--s3_bucket_name', default='nhl-data-raw')
+    parser.add_argument('--snowflake_conn', default='standard')
+    parser.add_argument('--db', default='nhl_stats')
+    parser.add_argument('--schema', default='raw')
+    parser.add_argument('--env', default='development')
+    parser.add_argument('--file_format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--cache', action='store_true', help='Use the on-disk HTTP cache and skip unchanged pages')
+    parser.add_argument(
+        '--load_method', default='s3', choices=['s3', 'stage'],
+        help='COPY from S3, or PUT the data to the table stage directly'
+    )
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_ROWS, help='Rows per file for --load_method stage')
+    parser.add_argument('--parallel', type=int, default=4, help='PUT threads for --load_method stage')
+
+    return parser
+
+
+if __name__ in "__main__":
+    # Parsed before pandas and Prefect are imported, so --help and argument errors return at once
+    args = build_parser().parse_args()
+
+from src.connectors import close_connection_pools, get_connection_pool  # noqa: E402
+from src.http_cache import get_http_cache, is_unchanged  # noqa: E402
+from src.schema_registry import get_schema_registry  # noqa: E402
+from src.lake import lake_store  # noqa: E402
+from src.profiling import export_profile  # noqa: E402
+from src.storage import get_run_manifest  # noqa: E402
+from src.snowflake_queries import *  # noqa: E402
+
+from src.helpers import build_url, snowflake_query_exec  # noqa: E402
+import nhl_regular_seasons  # noqa: E402
+import nhl_team_stats  # noqa: E402
+
+# Orchestration
+from prefect import flow, task, get_run_logger  # noqa: E402
+
+# Per-source stages, reused from the single-source flows
+PIPELINES = {
+    'seasons': {'table': 'regular_season', 'flow': nhl_regular_seasons},
+    'teams': {'table': 'team_stats', 'flow': nhl_team_stats},
+}
+
+
+@task(name="snowflake_base_model_versioned")
+def snowflake_base_model_versioned(snowflake_conn, s3_bucket_name, db, schema):
+    """ Run the idempotent stage and table DDL only when it changed since it was last applied to this schema """
+    logging = get_run_logger()
+
+    version = schema_version(db, schema, s3_bucket_name)
+    applied = (snowflake_query_exec(
+        snowflake_schema_version_check(db, schema, version), method=snowflake_conn, fetch={'version': 'scalar'}
+    ) or {}).get('version')
+
+    if applied:
+        logging.info(f'Snowflake base model is up to date at version {version}. Skipping DDL.')
+        return version
+
+    # The marker is only written once every DDL statement succeeded, so a failed migration is retried next run
+    logging.info(f'Applying Snowflake base model version {version}')
+    nhl_regular_seasons.snowflake_base_model.fn(snowflake_conn, s3_bucket_name, db, schema, raise_errors=True)
+    snowflake_query_exec(
+        snowflake_schema_version_mark(db, schema, version), method=snowflake_conn, raise_errors=True
+    )
+
+    # Column checks must see the tables as they are after this DDL
+    get_schema_registry().invalidate(db, schema)
+
+    return version
+
+
+@task(name="source_pipeline")
+def source_pipeline(
+        source, endpoint, year,
+        s3_bucket_name, db, schema,
+        snowflake_conn, env, cache: bool = False,
+        file_format: str = 'csv', load_method: str = 's3', chunk_size: int = DEFAULT_CHUNK_ROWS, parallel: int = 4
+):
+    """ Fetch, stage and load one source. Runs the single-source flow's task functions inline. """
+    logging = get_run_logger()
+    stages = PIPELINES[source]['flow']
+
+    url, filename = build_url(source, endpoint, year)
+    logging.info(f'Source URL: {url}, Filename: {filename}')
+
+    output_df = stages.file_parser.fn(db, url, snowflake_conn, cache, schema)
+
+    if env == "development":
+        logging.info(f'{source} executed successfully in development. No data was uploaded to S3 or Snowflake.')
+        return
+    if is_unchanged(output_df):
+        logging.info(f'{source} unchanged since the last load. Skipping upload and load.')
+        return
+
+    lake_store.fn(output_df, source, year)
+
+    if load_method == 'stage':
+        # DEDUPE SOURCE TABLE & PUSH THE PARSED DATA STRAIGHT INTO SNOWFLAKE
+        stages.snowflake_load.fn(
+            db, schema, PIPELINES[source]['table'], year, source, snowflake_conn, file_format,
+            data=output_df, chunk_size=chunk_size, parallel=parallel
+        )
+    else:
+        # INGEST RAW DATA TO S3
+        stages.s3_parser.fn(
+            filename=filename, data=output_df, s3_folder=source, s3_bucket_name=s3_bucket_name,
+            file_format=file_format
+        )
+
+        # DEDUPE SOURCE TABLE & TRANSFER THE FILES OF THIS RUN
+        files = get_run_manifest().files(s3_bucket_name, source, file_format)
+        stages.snowflake_load.fn(
+            db, schema, PIPELINES[source]['table'], year, source, snowflake_conn, file_format, files
+        )
+
+    if cache:
+        get_http_cache().mark_processed(url)
+
+
+@flow(
+    name='nhl_pipeline', retries=1, retry_delay_seconds=5, log_prints=True
+)
+def nhl_pipeline(
+        sources, endpoint, year,
+        s3_bucket_name, db, schema,
+        snowflake_conn, env, cache: bool = False,
+        file_format: str = 'csv', load_method: str = 's3', chunk_size: int = DEFAULT_CHUNK_ROWS, parallel: int = 4
+):
+    """ Run the regular season and team stats pipelines in one process with one Snowflake session """
+    start = time.time()
+    logging = get_run_logger()
+    try:
+        invalid = [source for source in sources if source not in PIPELINES]
+        if invalid:
+            logging.error(f'Invalid source specified: {invalid}')
+            sys.exit(1)
+
+        # A single pooled session is shared by every task in the run
+        get_connection_pool(snowflake_conn, max_size=1)
+
+        logging.info('Preparing snowflake base model for ingestion')
+        snowflake_base_model_versioned(snowflake_conn, s3_bucket_name, db, schema)
+
+        # Fan out the source pipelines concurrently
+        futures = [
+            source_pipeline.submit(
+                source, endpoint, year,
+                s3_bucket_name, db, schema,
+                snowflake_conn, env, cache,
+                file_format, load_method, chunk_size, parallel
+            )
+            for source in sources
+        ]
+        for future in futures:
+            future.result()
+
+        end = time.time() - start
+        logging.info(f'Process Completed. Time elapsed: {end}')
+    finally:
+        # Release every pooled Snowflake session on flow exit
+        close_connection_pools()
+        try:
+            logging.info(f'Stage profile written to {export_profile("nhl_pipeline")}')
+        except Exception as e:
+            # Reporting must not replace the outcome of the run
+            logging.warning(f'Could not export the stage profile: {e}')
+        try:
+            for manifest in get_run_manifest().save('nhl_pipeline'):
+                logging.info(f'Run manifest written to {manifest}')
+        except Exception as e:
+            logging.warning(f'Could not write the run manifest: {e}')
+
+
+if __name__ in "__main__":
+    print(f"Received Arguments: {args}")
+
+    # Execute the pipeline
+    nhl_pipeline(
+        args.sources or list(PIPELINES), args.endpoint, args.year,
+        args.s3_bucket_name, args.db, args.schema,
+        args.snowflake_conn, args.env, args.cache,
+        args.file_format, args.load_method, args.chunk_size, args.parallel
+    )
@@ -1,20 +1,62 @@
-import pandas as pd
 import argparse
 
 import datetime as dt
 import time
 import sys
-import os
-import boto3
 
-from src.connectors import s3_conn, get_legacy_session
-from src.snowflake_queries import *
-from src.preprocessing import DataTransform
+from src.snowflake_queries import DEFAULT_CHUNK_ROWS
 
-from src.helpers import setup, snowflake_query_exec 
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="SnowflakeIngestion",
+        description="Move data from raw S3 uploads to a produced Schema in Snowflake"
+    )
+
+    parser.add_argument('source')
+    parser.add_argument('--endpoint', default='https://www.hockey-reference.com/leagues/')
+    parser.add_argument('--year', default=dt.datetime.now().year)
+    parser.add_argument('--s3_bucket_name', default='nhl-data-raw')
+    parser.add_argument('--snowflake_conn', default='standard')
+    parser.add_argument('--db', default='nhl_stats')
+    parser.add_argument('--schema', default='raw')
+    parser.add_argument('--env', default='development')
+    parser.add_argument('--file_format', default='csv', choices=['csv', 'parquet'])
+    parser.add_argument('--cache', action='store_true', help='Use the on-disk HTTP cache and skip unchanged pages')
+    parser.add_argument('--load_mode', default='full', choices=['full', 'incremental'])
+    parser.add_argument('--watermark', default='snowflake', choices=['snowflake', 'local'])
+    parser.add_argument(
+        '--load_method', default='s3', choices=['s3', 'stage'],
+        help='Full loads: COPY from S3, or PUT the data to the table stage directly'
+    )
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_ROWS, help='Rows per file for --load_method stage')
+    parser.add_argument('--parallel', type=int, default=4, help='PUT threads for --load_method stage')
+
+    return parser
+
+
+if __name__ in "__main__":
+    # Parsed before pandas and Prefect are imported, so --help and argument errors return at once
+    args = build_parser().parse_args()
+
+import pandas as pd  # noqa: E402
+
+from src.connectors import s3_conn, get_legacy_session, close_connection_pools  # noqa: E402
+from src.http_cache import get_http_cache, UNCHANGED, is_unchanged  # noqa: E402
+from src.snowflake_queries import *  # noqa: E402
+from src.preprocessing import DataTransform  # noqa: E402
+from src.extract import parse_source  # noqa: E402
+from src.schema_registry import get_schema_registry  # noqa: E402
+from src.lake import lake_store  # noqa: E402
+from src.serializers import FRAME_TASK  # noqa: E402
+from src.profiling import get_profiler, export_profile  # noqa: E402
+from src import incremental  # noqa: E402
+
+from src.helpers import setup, snowflake_query_exec, snowflake_stage_load  # noqa: E402
+from src.storage import upload_frame, get_run_manifest, DEFAULT_PART_SIZE  # noqa: E402
 
 # Orchestration
-from prefect import flow, task, get_run_logger
+from prefect import flow, task, get_run_logger  # noqa: E402
 
 # Data Source: https://www.hockey-reference.com/leagues/NHL_2022.html ##
 
@@ -22,81 +64,78 @@ from prefect import flow, task, get_run_logger
 transform = DataTransform
 
 
-@task(name="file_parser")
-def file_parser(db, url, snowflake_conn):
+@task(name="file_parser", **FRAME_TASK)
+def file_parser(db, url, snowflake_conn, cache: bool = False, schema: str = 'raw'):
     """ Download raw source data and upload to S3
         Data Source: hockeyreference.com
+        With `cache`, returns UNCHANGED when the page is identical to the last one loaded downstream.
+        Any failure fails the task, so an error is never mistaken for an unchanged page.
     """
     try:
         logging = get_run_logger()
-        response = get_legacy_session().get(url)
-        dataframes = pd.read_html(response.text)
-        dataframe = pd.concat(dataframes, axis=0, ignore_index=True).reset_index(drop=True)
+        with get_profiler().stage('file_parser', source='seasons') as stage:
+            response = get_legacy_session(cached=cache).get(url)
+            # Rate limited or failed pages carry no cache annotations and must not be parsed
+            response.raise_for_status()
+            stage.phase('http')
+            stage.bytes = len(response.content)
+
+            if cache and not response.content_changed:
+                logging.info(f'Source page unchanged since the last load (from cache: {response.from_cache}).')
+                return UNCHANGED
 
-        logging.info(f'Retrieved data with columns: {dataframe.columns}.')
+            dataframe = parse_source(response.content, 'seasons')
+            stage.phase('parse')
+
+            logging.info(f'Retrieved data with columns: {dataframe.columns}.')
         
-        logging.info('Transforming data...')
-        dataframe = transform.seasons(dataframe)
-
-        logging.info('Checking column mappings...')
-        checks = snowflake_query_exec(snowflake_checks(db=db, table='regular_season'), method=snowflake_conn)
-        logging.info(f'Expected columns from destination: {checks}')
-        len_source, len_dest = len(dataframe.columns), len(checks['columns'])
-
-        logging.info(
-            f'Destination mappings: {len_dest}'
-            '\n'
-            f'Source mappings: {len_source}'
-        )
+            logging.info('Transforming data...')
+            dataframe = transform.seasons(dataframe)
+            stage.phase('transform')
+            stage.rows = len(dataframe)
 
-        if not len_dest == len_source:
-            logging.error('Length of source columns does not match number of destination columns.')
-            sys.exit(1)
+            logging.info('Checking column mappings...')
+            problems = get_schema_registry().validate(dataframe, db, schema, 'regular_season', snowflake_conn)
+            if problems:
+                raise ValueError(f'Source columns of {url} do not match the regular_season table: {problems}')
+            stage.phase('schema_check')
 
-        logging.info(
-            f'Retrieved data with columns: {dataframe.columns}'
-            f'\n'
-            f'Preview: \n{dataframe.head(3)}'
-        )
+            logging.info(
+                f'Retrieved data with columns: {dataframe.columns}'
+                f'\n'
+                f'Preview: \n{dataframe.head(3)}'
+            )
 
-        return dataframe
+            return dataframe
 
     except Exception as e:
         logging.error(f'An error occurred while retrieving raw data: {e}')
+        raise
 
 
-@task(name="s3_upload")
+@task(name="s3_upload", **FRAME_TASK)
 @s3_conn
-def s3_parser(filename: str, data: pd.DataFrame, s3_folder: str, s3_bucket_name: str = 'nhl-data-raw'):
+def s3_parser(
+        filename: str, data: pd.DataFrame, s3_folder: str, s3_bucket_name: str = 'nhl-data-raw',
+        file_format: str = 'csv', compression: str = 'snappy', row_group_size: int = 100_000,
+        part_size: int = DEFAULT_PART_SIZE, max_workers: int = 4
+):
     try:
 
         logging = get_run_logger()
 
-        # Establish connection
-        s3_client, s3_resource = boto3.client('s3'), boto3.resource('s3')
-
-        os.path.join('src/')
-
-        if os.path.exists('data'):
-            pass
-        else:
-            os.mkdir('data', mode=0o777)
-
-        # Convert DF to CSV File
-        path = f'./data/{filename}.csv'
-        data.to_csv(path, index=False)
-
-        logging.info(f'Data stored at {path}')
-
         # Build the targets
-        dst, filename = f'{s3_bucket_name}', f'{s3_folder}/{filename}.csv'
+        dst, filename = f'{s3_bucket_name}', f'{s3_folder}/{filename}.{file_format}'
 
-        # Retrieve S3 paths & store raw file to s3
+        # Serialize straight into S3 from memory, no local ./data copy
         logging.info(f'Storing parsed data in S3 at {filename}')
-        s3_client.upload_file(
-            path, dst, filename
-        )
-        logging.info(f'Successfully uploaded to S3')
+        with get_profiler().stage('s3_parser', source=s3_folder) as stage:
+            size = upload_frame(
+                data, dst, filename, file_format, compression, row_group_size,
+                part_size=part_size, max_workers=max_workers
+            )
+            stage.rows, stage.bytes = len(data), size
+        logging.info(f'Successfully uploaded {size} bytes to S3')
 
     except Exception as e:
         logging.error(f'An error occurred when storing data in S3: {e}')
@@ -104,31 +143,95 @@ def s3_parser(filename: str, data: pd.DataFrame, s3_folder: str, s3_bucket_name:
         
 
 @task(name="snowflake_base_model")
-def snowflake_base_model(snowflake_conn, s3_bucket_name, db, schema):
+def snowflake_base_model(snowflake_conn, s3_bucket_name, db, schema, raise_errors: bool = False):
+    """ Create the stages and tables if needed. With `raise_errors`, a failed statement fails the task. """
     logging = get_run_logger()
 
     # Create stages
     logging.info("Updating snowflake stages if needed")
-    snowflake_query_exec(snowflake_stages(db, schema, s3_bucket_name), method=snowflake_conn)
+    snowflake_query_exec(
+        snowflake_stages(db, schema, s3_bucket_name), method=snowflake_conn,
+        concurrent=True, depends_on=STAGE_DEPENDENCIES, raise_errors=raise_errors
+    )
 
     # Create Schemas
     logging.info("Updating table schemas if needed")
-    snowflake_query_exec(snowflake_schema(db, schema), method=snowflake_conn)
+    snowflake_query_exec(
+        snowflake_schema(db, schema), method=snowflake_conn,
+        concurrent=True, depends_on=SCHEMA_DEPENDENCIES, raise_errors=raise_errors
+    )
+
+    return
+
+
+@task(name="snowflake_load", **FRAME_TASK)
+def snowflake_load(
+        db, schema, table, year, source, snowflake_conn, file_format: str = 'csv', files: list = None,
+        data: pd.DataFrame = None, chunk_size: int = DEFAULT_CHUNK_ROWS, parallel: int = 4
+):
+    """ Replace the season in `table` with the files staged in S3 under `source`: the `files` named by the run
+        manifest, or every file under the prefix when not given. With `data`, the frame is pushed straight into the table stage instead, in files of `chunk_size` rows
+        uploaded by `parallel` threads.
+    """
+    logging = get_run_logger()
+
+    method = 's3' if data is None else 'stage'
+    with get_profiler().stage('snowflake_load', table=table, mode='full', method=method) as stage:
+        # Built before the delete, so a run without files fails before the season is cleared.
+        # The season is cleared below, so the named files are loaded even if Snowflake saw them before.
+        if data is None:
+            ingestion = snowflake_ingestion(db, schema, table, source, file_format, files, force=files is not None)
+
+        # DEDUPE FROM SNOWFLAKE
+        # Keyed on the game date, so seasons loaded earlier the same year (e.g. by a backfill) are kept
+        logging.info(f"Deduplicating yearly record data to refresh the schedule")
+        snowflake_query_exec(snowflake_season_cleanup(db, schema, table, year), method=snowflake_conn)
+
+        # INGEST RAW DATA TO SNOWFLAKE
+        logging.info(f"Updating yearly record data")
+        if data is None:
+            snowflake_query_exec(ingestion, method=snowflake_conn)
+        else:
+            staged = snowflake_stage_load(
+                data, db, schema, table, f'{source}_{year}', snowflake_conn, file_format, chunk_size, parallel
+            )
+            stage.rows, stage.bytes = len(data), staged['bytes']
+            logging.info(f"Loaded {len(data)} rows from {staged['files']} files through the table stage")
 
     return
 
 
-@task(name="snowflake_load")
-def snowflake_load(db, schema, table, year, source, snowflake_conn):
+@task(name="incremental_diff", **FRAME_TASK)
+def incremental_diff(db, schema, table, year, dataframe, snowflake_conn, watermark: str = 'snowflake'):
+    """ Diff the parsed season against what was last loaded and return only new or changed games.
+        :param: watermark -> 'snowflake' to diff against the rows stored for the season, 'local' for the watermark
+                              file written by the previous run on this host.
+    """
     logging = get_run_logger()
 
-    # DEDUPE FROM SNOWFLAKE
-    logging.info(f"Deduplicating yearly record data to refresh the schedule")
-    snowflake_query_exec(snowflake_cleanup(db, schema, table, year), method=snowflake_conn)
+    if watermark == 'local':
+        loaded = incremental.load_local_watermark(table, year)
+    else:
+        rows = snowflake_query_exec(snowflake_watermark(db, schema, table, year), method=snowflake_conn) or {}
+        loaded = incremental.snowflake_watermark(rows.get('watermark'))
+
+    changes = incremental.changed_rows(dataframe, loaded)
+    logging.info(f'{len(changes)} of {len(dataframe)} games are new or changed since the last load')
+
+    return changes
+
 
-    # INGEST RAW DATA TO SNOWFLAKE
-    logging.info(f"Updating yearly record data")
-    snowflake_query_exec(snowflake_ingestion(db, schema, table, source), method=snowflake_conn)
+@task(name="snowflake_merge_load")
+def snowflake_merge_load(db, schema, table, source, filename, snowflake_conn):
+    """ Merge the staged increment into `table`. A failed MERGE fails the task, so the watermark is not advanced. """
+    logging = get_run_logger()
+
+    # UPSERT CHANGED GAMES INTO SNOWFLAKE
+    logging.info(f"Merging changed games from {filename}")
+    with get_profiler().stage('snowflake_load', table=table, mode='incremental'):
+        snowflake_query_exec(
+            snowflake_merge(db, schema, table, source, filename), method=snowflake_conn, raise_errors=True
+        )
 
     return
 
@@ -139,71 +242,100 @@ def snowflake_load(db, schema, table, year, source, snowflake_conn):
 def nhl_regular_seasons(
         source, endpoint, year,
         s3_bucket_name, db, schema,
-        snowflake_conn, env
+        snowflake_conn, env,
+        load_mode: str = 'full', watermark: str = 'snowflake', cache: bool = False,
+        file_format: str = 'csv', load_method: str = 's3', chunk_size: int = DEFAULT_CHUNK_ROWS, parallel: int = 4
 ):
     start = time.time()
     logging = get_run_logger()
-
-    # Prepare Source URL
-    url, filename = setup(source, endpoint, year)
-    logging.info(f'Source URL: {url}, Filename: {filename}')
-
-    # Prepare snowflake stages and schemas
-    logging.info('Preparing snowflake base model for ingestion')
-    snowflake_base_model(snowflake_conn, s3_bucket_name, db, schema)
-
-    # Parse Files from Raw Endpoint
-    # Only store data in S3 in Production
-    if env == "development":
-        try:
+    try:
+        # Prepare Source URL
+        url, filename = setup(source, endpoint, year)
+        logging.info(f'Source URL: {url}, Filename: {filename}')
+
+        # Prepare snowflake stages and schemas
+        logging.info('Preparing snowflake base model for ingestion')
+        snowflake_base_model(snowflake_conn, s3_bucket_name, db, schema)
+
+        # Parse Files from Raw Endpoint
+        # Only store data in S3 in Production
+        if env == "development":
+            try:
+                logging.info("Extracting raw data from source, formatting and transformation, and loading it to S3")
+                file_parser(db, url, snowflake_conn, cache, schema)
+                logging.info(
+                    "\n"
+                    "\t Process executed successfully in development. "
+                    "\t No data was uploaded to S3 or Snowflake. "
+                    "\t To try testing out your ingestion completely, use the production branch."
+                    "\n"
+                )
+            except Exception as e:
+                logging.error(
+                    f'Test failed while executing in development. Please review: \n'
+                    f'\t\t{e}'
+                )
+        else:
+            # INGEST RAW DATA TO S3
             logging.info("Extracting raw data from source, formatting and transformation, and loading it to S3")
-            file_parser(db, url, snowflake_conn)
-            logging.info(
-                "\n"
-                "\t Process executed successfully in development. "
-                "\t No data was uploaded to S3 or Snowflake. "
-                "\t To try testing out your ingestion completely, use the production branch."
-                "\n"
-            )
+            output_df = file_parser(db, url, snowflake_conn, cache, schema)
+            table = 'regular_season'
+
+            if not is_unchanged(output_df):
+                lake_store(output_df, source, year)
+
+            if is_unchanged(output_df):
+                logging.info('Source unchanged since the last load. Skipping upload and load.')
+            elif load_mode == 'incremental':
+                # STAGE ONLY NEW OR CHANGED GAMES & MERGE THEM
+                changes = incremental_diff(db, schema, table, year, output_df, snowflake_conn, watermark)
+                if len(changes):
+                    # Kept outside the seasons/ prefix so full loads never COPY the partial files.
+                    # Staged as CSV, which snowflake_merge reads positionally.
+                    increment = f'{filename}_{dt.datetime.now():%Y%m%d%H%M%S}'
+                    s3_parser(filename=increment, data=changes, s3_folder=f'{source}_incremental', s3_bucket_name=s3_bucket_name)
+                    snowflake_merge_load(db, schema, table, f'{source}_incremental', increment, snowflake_conn)
+                else:
+                    logging.info('No new or changed games. Skipping upload and load.')
+                # Only reached once the MERGE succeeded, a failed merge leaves the previous watermark in place
+                incremental.save_local_watermark(output_df, table, year)
+            elif load_method == 'stage':
+                # DEDUPE SOURCE TABLE & PUSH THE PARSED DATA STRAIGHT INTO SNOWFLAKE
+                snowflake_load(
+                    db, schema, table, year, source, snowflake_conn, file_format,
+                    data=output_df, chunk_size=chunk_size, parallel=parallel
+                )
+            else:
+                s3_parser(
+                    filename=filename, data=output_df, s3_folder=source, s3_bucket_name=s3_bucket_name,
+                    file_format=file_format
+                )
+
+                # DEDUPE SOURCE TABLE & TRANSFER THE FILES OF THIS RUN
+                files = get_run_manifest().files(s3_bucket_name, source, file_format)
+                snowflake_load(db, schema, table, year, source, snowflake_conn, file_format, files)
+
+            if cache and not is_unchanged(output_df):
+                get_http_cache().mark_processed(url)
+
+        end = time.time() - start
+        logging.info(f'Process Completed. Time elapsed: {end}')
+    finally:
+        # Release every pooled Snowflake session on flow exit
+        close_connection_pools()
+        try:
+            logging.info(f'Stage profile written to {export_profile("nhl_regular_seasons")}')
         except Exception as e:
-            logging.error(
-                f'Test failed while executing in development. Please review: \n'
-                f'\t\t{e}'
-            )
-    else:
-        # INGEST RAW DATA TO S3
-        logging.info("Extracting raw data from source, formatting and transformation, and loading it to S3")
-        output_df = file_parser(db, url, snowflake_conn)
-        s3_parser(filename=filename, data=output_df, s3_folder=source, s3_bucket_name=s3_bucket_name)
-
-        # DEDUPE SOURCE TABLE & TRANSFER RAW DATA
-        table = 'regular_season'
-
-
-        snowflake_load(db, schema, table, year, source, snowflake_conn)
-
-    end = time.time() - start
-    logging.info(f'Process Completed. Time elapsed: {end}')
+            # Reporting must not replace the outcome of the run
+            logging.warning(f'Could not export the stage profile: {e}')
+        try:
+            for manifest in get_run_manifest().save('nhl_regular_seasons'):
+                logging.info(f'Run manifest written to {manifest}')
+        except Exception as e:
+            logging.warning(f'Could not write the run manifest: {e}')
 
 
 if __name__ in "__main__":
-
-    parser = argparse.ArgumentParser(
-        prog="SnowflakeIngestion",
-        description="Move data from raw S3 uploads to a produced Schema in Snowflake"
-    )
-
-    parser.add_argument('source')
-    parser.add_argument('--endpoint', default='https://www.hockey-reference.com/leagues/')
-    parser.add_argument('--year', default=dt.datetime.now().year)
-    parser.add_argument('--s3_bucket_name', default='nhl-data-raw')
-    parser.add_argument('--snowflake_conn', default='standard')
-    parser.add_argument('--db', default='nhl_stats')
-    parser.add_argument('--schema', default='raw')
-    parser.add_argument('--env', default='development')
-
-    args = parser.parse_args()
-
     source = args.source if args.source is not None else ""
     endpoint = args.endpoint if args.endpoint is not None else ""
     year = args.year if args.year is not None else ""
@@ -221,5 +353,7 @@ if __name__ in "__main__":
     nhl_regular_seasons(
         source, endpoint, year,
         s3_bucket_name, db, schema,
-        snowflake_conn, env
+        snowflake_conn, env,
+        load_mode=args.load_mode, watermark=args.watermark, cache=args.cache,
+        file_format=args.file_format, load_method=args.load_method, chunk_size=args.chunk_size, parallel=args.parallel
     )
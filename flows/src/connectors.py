@@ -1,22 +1,47 @@
 import sys
-import boto3
-import botocore.exceptions
+import atexit
+import functools
+import inspect
+from cachetools import TTLCache
 import requests
 import urllib3
 import ssl
+import threading
+import time
 # from secrets_access import get_secret
-import snowflake.connector
 # from snowflake.snowpark import Session
 import os
-from dotenv import load_dotenv, find_dotenv
+from contextlib import contextmanager
 
-# Get environment vars
-load_dotenv(find_dotenv())
+# The Snowflake connector, boto3 and python-dotenv are imported on first use, so flows and --help do not pay for
+# backends a run never touches. See benchmarks/bench_imports.py.
+_environment_loaded = False
+
+
+def load_environment():
+    """ Load credentials from the nearest .env file into the environment, once per process """
+    global _environment_loaded
+    if not _environment_loaded:
+        from dotenv import load_dotenv, find_dotenv
+        load_dotenv(find_dotenv())
+        _environment_loaded = True
+
+
+def env_setting(name: str, default=None):
+    """ A setting from the environment or .env, read when it is needed rather than when a module is imported """
+    load_environment()
+    return os.getenv(name, default)
 
 
 def get_snowflake_connection(method):
     """ Confirm Access to Snowflake"""
+    load_environment()
     try:
+        if method == 'local':
+            # Embedded DuckDB warehouse for offline development, see src.local_backend
+            from src.local_backend import LocalConnection
+            return LocalConnection(os.getenv('SNOWFLAKE_DB'), os.getenv('SFSCHEMA'))
+
         params = {
             "user": os.getenv('SFUSER'),
             "password": os.getenv('SFPW'),
@@ -33,6 +58,7 @@ def get_snowflake_connection(method):
             sys.exit(-1)
             
         if method == 'standard':
+            import snowflake.connector
             conn = snowflake.connector.connect(
                 user=params['user'],
                 password=params['password'],
@@ -52,26 +78,205 @@ def get_snowflake_connection(method):
         raise e
 
 
+class SnowflakeConnectionPool:
+    """ Process-wide, bounded pool of Snowflake sessions shared by every task in a flow run.
+        Idle sessions are health checked before reuse and evicted after `idle_timeout` seconds.
+    """
+
+    def __init__(self, method: str = 'standard', max_size: int = 4, idle_timeout: float = 600,
+                 health_check_interval: float = 60):
+        self.method = method
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _healthy(self, conn, last_used):
+        """ Cheap liveness check. Only round trips to the warehouse when the session has been idle a while. """
+        try:
+            if conn.is_closed():
+                return False
+            if time.monotonic() - last_used > self.health_check_interval:
+                conn.cursor().execute('select 1').close()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        expired = [(conn, used) for conn, used in self._idle if now - used > self.idle_timeout]
+        self._idle = [(conn, used) for conn, used in self._idle if now - used <= self.idle_timeout]
+        for conn, _ in expired:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """ Borrow a session, reusing an idle one when possible. Blocks while `max_size` sessions are in use. """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Snowflake connection pool has been closed')
+            self._evict_idle()
+            while True:
+                while self._idle:
+                    conn, last_used = self._idle.pop()
+                    if self._healthy(conn, last_used):
+                        self._in_use += 1
+                        return conn
+                    self._close_quietly(conn)
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    break
+                self._cond.wait()
+
+        try:
+            conn = get_snowflake_connection(self.method)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        if conn is None:
+            # Methods without a native connection fall back to the Prefect connector and are not pooled
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+        return conn
+
+    def release(self, conn):
+        """ Return a borrowed session to the pool """
+        if conn is None:
+            return
+        with self._cond:
+            self._in_use -= 1
+            if self._closed or conn.is_closed():
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """ Close every idle session. Sessions still borrowed are closed as they are released. """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(method: str = 'standard', **kwargs):
+    """ Return the shared connection pool for a connection method, creating it on first use """
+    with _pools_lock:
+        pool = _pools.get(method)
+        if pool is None or pool._closed:
+            pool = _pools[method] = SnowflakeConnectionPool(method, **kwargs)
+        return pool
+
+
+def close_connection_pools():
+    """ Close every pooled Snowflake session. Called on flow exit and again at interpreter shutdown. """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_connection_pools)
+
+
+# S3 clients keyed by (region, profile). Building a client resolves credentials and loads endpoint data, which is
+# far too slow to repeat per call, so each one is created once per process and shared across tasks and threads.
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+# Bucket existence checks, refreshed after BUCKET_CHECK_TTL seconds
+BUCKET_CHECK_TTL = 300
+_bucket_checks = TTLCache(maxsize=64, ttl=BUCKET_CHECK_TTL)
+_bucket_checks_lock = threading.Lock()
+
+
+def get_s3_client(region_name: str = None, profile_name: str = None):
+    """ Shared boto3 S3 client for a region and profile. boto3 clients are thread-safe once created. """
+    load_environment()
+    key = (region_name, profile_name)
+    with _s3_clients_lock:
+        client = _s3_clients.get(key)
+        if client is None:
+            if os.getenv('NHL_S3_BACKEND') == 'local':
+                # Local directories standing in for buckets, see src.local_backend
+                from src.local_backend import LocalS3Client
+                client = _s3_clients[key] = LocalS3Client()
+                return client
+            # Sessions are not thread-safe, so each client gets its own, created under the lock
+            import boto3
+            session = boto3.session.Session(region_name=region_name, profile_name=profile_name)
+            client = _s3_clients[key] = session.client('s3')
+        return client
+
+
+def bucket_exists(bucket: str, client=None) -> bool:
+    """ HeadBucket on the target bucket only, cached for BUCKET_CHECK_TTL seconds """
+    with _bucket_checks_lock:
+        if bucket in _bucket_checks:
+            return _bucket_checks[bucket]
+
+    import botocore.exceptions
+
+    client = client or get_s3_client()
+    try:
+        client.head_bucket(Bucket=bucket)
+        exists = True
+    except botocore.exceptions.ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        # 403 means the bucket exists but HeadBucket is not permitted. Let the upload itself decide.
+        exists = code not in ('404', 'NoSuchBucket')
+
+    with _bucket_checks_lock:
+        _bucket_checks[bucket] = exists
+    return exists
+
+
 def s3_conn(func):
     """ Confirm Access to S3 """
-    def wrapper_s3_checks(*args, **kwargs):
-        """ Provides a series of checks for S3 before running a function provided """
+    signature = inspect.signature(func)
 
-        s3_client, s3_resource = boto3.client('s3'), boto3.resource('s3')
-        print('Successfully connected to S3.')
+    @functools.wraps(func)
+    def wrapper_s3_checks(*args, **kwargs):
+        """ Checks the target bucket exists before running a function provided """
 
-        # Stores the passed args and kwargs into available lists
-        arg_vars, kw_vars = [arg for arg in args], [arg for arg in kwargs]
+        s3_client = get_s3_client()
 
         try:
-            if type(func) != str:
-                pass
-            else:
-                # Check if the bucket exists. If a bucket exists, it should be passed into a function as an argument.
-                buckets = [name['Name'] for name in s3_client.list_buckets()['Buckets']]
-                matches = [name for name in arg_vars if name in buckets]
-                if not matches:
-                    print(f'S3 Bucket provided does not exist: {arg_vars}')
+            # The bucket is passed into a function as the s3_bucket_name argument
+            bound = signature.bind_partial(*args, **kwargs)
+            bound.apply_defaults()
+            bucket = bound.arguments.get('s3_bucket_name')
+            if bucket and not bucket_exists(bucket, s3_client):
+                print(f'S3 Bucket provided does not exist: {bucket}')
+                sys.exit(-1)
 
             return func(*args, **kwargs)
 
@@ -95,9 +300,21 @@ class CustomHttpAdapter (requests.adapters.HTTPAdapter):
             block=block, ssl_context=self.ssl_context)
 
 
-def get_legacy_session():
+def legacy_ssl_context():
+    """ TLS context accepting hockeyreference.com's legacy renegotiation. Shared with the async fetcher. """
     ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
     ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
+    return ctx
+
+
+def get_legacy_session(cached: bool = False):
+    """ Requests session for hockeyreference.com's legacy TLS setup.
+        With `cached`, responses go through the on-disk conditional HTTP cache in src.http_cache.
+    """
     session = requests.session()
-    session.mount('https://', CustomHttpAdapter(ctx))
+    session.mount('https://', CustomHttpAdapter(legacy_ssl_context()))
+    if cached:
+        from src.http_cache import CachedSession, get_http_cache
+        return CachedSession(session, get_http_cache())
     return session
+
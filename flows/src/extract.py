@@ -0,0 +1,115 @@
+# Targeted table extraction for hockeyreference.com pages. Streams the page through lxml and builds only the
+# tables that are loaded, instead of having pd.read_html parse every table on the page.
+
+import io
+import warnings
+
+import pandas as pd
+from lxml import etree, html as lxml_html
+
+# Tables loaded per source. Team stats are the divisional standings, which match the team_stats schema.
+# Repeated header and division rows are tagged with a "thead" class and skipped while extracting.
+SOURCE_TABLES = {
+    'seasons': ['games'],
+    'teams': ['standings_EAS', 'standings_WES'],
+}
+
+SKIP_ROW_CLASSES = {'thead', 'over_header', 'spacer', 'partial_table'}
+
+
+def _text(cell):
+    text = ''.join(cell.itertext()).strip()
+    return text if text else None
+
+
+def _header(table):
+    """ Column names from the last header row, named the way pd.read_html names them """
+    rows = table.findall('./thead/tr')
+    if not rows:
+        return []
+
+    columns, seen = [], {}
+    for idx, cell in enumerate(rows[-1].iterchildren('th', 'td')):
+        name = _text(cell) or f'Unnamed: {idx}'
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+def _rows(table):
+    for body in table.iterchildren('tbody'):
+        for row in body.iterchildren('tr'):
+            classes = set((row.get('class') or '').split())
+            if classes & SKIP_ROW_CLASSES:
+                continue
+            yield [_text(cell) for cell in row.iterchildren('th', 'td')]
+
+
+def _typed(columns, rows) -> pd.DataFrame:
+    """ Build the frame column by column, converting columns that are entirely numeric """
+    data = {}
+    for idx, name in enumerate(columns):
+        values = [row[idx] if idx < len(row) else None for row in rows]
+        numeric = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+        if numeric.notna().sum() == sum(value is not None for value in values):
+            data[name] = numeric
+        else:
+            data[name] = pd.Series(values, dtype=object)
+    return pd.DataFrame(data)
+
+
+def _table_frame(table) -> pd.DataFrame:
+    return _typed(_header(table), list(_rows(table)))
+
+
+def extract_tables(content: bytes, table_ids) -> dict:
+    """
+    Stream a page and return {table_id: DataFrame} for the requested tables only.
+    hockeyreference.com ships most secondary tables inside HTML comments, which are parsed only if they contain a
+    requested table. Everything else is discarded as soon as it has been read.
+    """
+    wanted, found = set(table_ids), {}
+    inside = 0
+
+    events = etree.iterparse(io.BytesIO(content), events=('start', 'end', 'comment'), html=True, recover=True)
+    for event, elem in events:
+        if event == 'comment':
+            text = elem.text or ''
+            for table_id in wanted - set(found):
+                if f'id="{table_id}"' in text:
+                    fragment = lxml_html.fromstring(text)
+                    table = fragment if fragment.get('id') == table_id else fragment.find(f'.//table[@id="{table_id}"]')
+                    if table is not None:
+                        found[table_id] = _table_frame(table)
+        elif elem.tag == 'table' and elem.get('id') in wanted:
+            if event == 'start':
+                inside += 1
+                continue
+            inside -= 1
+            found[elem.get('id')] = _table_frame(elem)
+            elem.clear()
+        elif event == 'end' and not inside:
+            # Nothing outside a requested table is needed once it has been read
+            elem.clear()
+
+        if len(found) == len(wanted):
+            break
+
+    return found
+
+
+def parse_source(content: bytes, source: str) -> pd.DataFrame:
+    """ Extract the tables for a source and stack them. Falls back to pd.read_html if none are found. """
+    tables = extract_tables(content, SOURCE_TABLES[source])
+    if tables:
+        return pd.concat(
+            [tables[table_id] for table_id in SOURCE_TABLES[source] if table_id in tables], axis=0, ignore_index=True
+        )
+
+    warnings.warn(f'No {SOURCE_TABLES[source]} tables found for {source}. Falling back to pd.read_html.')
+    dataframes = pd.read_html(io.StringIO(content.decode('utf-8', errors='replace')))
+    return pd.concat(dataframes, axis=0, ignore_index=True).reset_index(drop=True)
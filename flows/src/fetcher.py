@@ -0,0 +1,273 @@
+# Asynchronous page fetcher for hockeyreference.com. Every request shares one persistent connection pool with the
+# legacy TLS context of get_legacy_session, each host has its own token bucket, and 429 / 5xx responses are retried
+# with jittered exponential backoff. A 429 pauses the whole host, honouring Retry-After. URLs go in through a queue and
+# results come back in completion order.
+#
+#   pages = fetch_pages(urls, concurrency=4, rate=20 / 60)
+
+import asyncio
+import email.utils
+import logging as std_logging
+import random
+import time
+from urllib.parse import urlparse
+
+import httpx
+
+from src.connectors import legacy_ssl_context
+from src.http_cache import cache_ttl
+from src.profiling import get_profiler
+
+# hockey-reference.com blocks clients making more than 20 requests a minute
+DEFAULT_RATE = 20 / 60
+DEFAULT_BURST = 1
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """ Per-host request budget: `rate` requests a second on average and at most `burst` back to back.
+        Must be created inside the event loop that uses it.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+        self._updated = max(self._updated, now)
+
+    async def acquire(self):
+        """ Wait for a token. Waiters are served in arrival order. """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep(max(self._updated - now, 0) + (1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """ Empty the bucket and stop refilling it for `seconds`, holding back every request to the host """
+        self._tokens = 0.0
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+
+class FetchResult:
+    """ Outcome of one URL. `tag` is whatever was passed to AsyncFetcher.put with it. """
+
+    def __init__(self, url: str, tag=None):
+        self.url = url
+        self.tag = tag
+        self.status = None
+        self.content = None
+        self.error = None
+        self.attempts = 0
+        self.from_cache = False
+        self.content_hash = None
+        self.content_changed = True
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status == 200
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise IOError(f'Failed to fetch {self.url}: {self.error}')
+
+    def _set(self, status, content, meta=None, from_cache=False):
+        self.status, self.content, self.from_cache = status, content, from_cache
+        if meta is not None:
+            self.content_hash = meta['content_hash']
+            self.content_changed = meta['content_hash'] != meta.get('processed_hash')
+        return self
+
+
+def retry_after(response) -> float:
+    """ Seconds requested by a Retry-After header, given as seconds or as an HTTP date. None when absent. """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AsyncFetcher:
+    """
+    Queue-driven fetcher. Use inside a running event loop:
+
+        async with AsyncFetcher(concurrency=4) as fetcher:
+            for url in urls:
+                fetcher.put(url)
+            async for result in fetcher.results():
+                ...
+
+        :param: concurrency -> requests in flight and size of the connection pool. Default: 4
+        :param: rate / burst -> token bucket of every host. Default: 20 requests a minute, one at a time
+        :param: host_rates -> {host: (rate, burst)} overrides for specific hosts
+        :param: max_retries -> retries of a 429, 5xx or connection error before giving up. Default: 5
+        :param: backoff / max_backoff -> first and largest retry delay in seconds, before jitter
+        :param: cache -> optional src.http_cache.HttpCache. Fresh pages are served without a request, stale ones are
+                         revalidated with conditional headers.
+    """
+
+    def __init__(
+            self, concurrency: int = 4, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST, host_rates: dict = None,
+            max_retries: int = 5, backoff: float = 2.0, max_backoff: float = 120.0, timeout: float = 30.0,
+            cache=None, logger=None
+    ):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = host_rates or {}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.logger = logger or std_logging.getLogger(__name__)
+        self._buckets = {}
+        self._pending = 0
+
+    async def __aenter__(self):
+        self._client = httpx.AsyncClient(
+            verify=legacy_ssl_context(), timeout=self.timeout, follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        )
+        self._queue = asyncio.Queue()
+        self._results = asyncio.Queue()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        return self
+
+    async def __aexit__(self, *exc):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await self._client.aclose()
+
+    def put(self, url: str, tag=None):
+        """ Queue a URL. Its result is returned by `get` or `results` once it finishes. """
+        self._pending += 1
+        self._queue.put_nowait((url, tag))
+
+    async def get(self) -> FetchResult:
+        """ Next finished result, in completion order """
+        result = await self._results.get()
+        self._pending -= 1
+        return result
+
+    async def results(self):
+        """ Yield results until every queued URL has finished """
+        while self._pending:
+            yield await self.get()
+
+    def _bucket(self, host) -> TokenBucket:
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(*self.host_rates.get(host, (self.rate, self.burst)))
+        return self._buckets[host]
+
+    def _delay(self, attempt, requested=None) -> float:
+        """ Exponential backoff with equal jitter, never shorter than a server-requested delay """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        return max(delay, requested or 0)
+
+    async def _worker(self):
+        while True:
+            url, tag = await self._queue.get()
+            try:
+                result = await self._fetch(FetchResult(url, tag))
+            except Exception as e:
+                result = FetchResult(url, tag)
+                result.error = str(e)
+            self._results.put_nowait(result)
+
+    async def _fetch(self, result: FetchResult) -> FetchResult:
+        url, headers, meta, body = result.url, {}, None, None
+
+        if self.cache is not None:
+            meta, body = await asyncio.to_thread(self.cache.get, url)
+            if meta is not None:
+                ttl = cache_ttl(url, meta['fetched_at'])
+                if ttl is None or time.time() - meta['fetched_at'] < ttl:
+                    return result._set(200, body, meta, from_cache=True)
+                # Stale: revalidate with the stored validators
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+        host = urlparse(url).netloc
+        bucket = self._bucket(host)
+        stage = get_profiler().start('http_fetch', host=host)
+        try:
+            while True:
+                result.attempts += 1
+                await bucket.acquire()
+                stage.phase('rate_limit')
+
+                requested = None
+                try:
+                    response = await self._client.get(url, headers=headers)
+                    stage.phase('http')
+                except httpx.TransportError as e:
+                    stage.phase('http')
+                    error = f'{type(e).__name__}: {e}'
+                else:
+                    result.status = response.status_code
+                    if response.status_code == 304 and meta is not None:
+                        meta = await asyncio.to_thread(self.cache.touch, url, meta)
+                        return result._set(200, body, meta, from_cache=True)
+                    if response.status_code not in RETRY_STATUSES:
+                        break
+                    error, requested = f'HTTP {response.status_code}', retry_after(response)
+
+                if result.attempts > self.max_retries:
+                    result.error = error
+                    return result
+
+                delay = self._delay(result.attempts, requested)
+                if result.status == 429:
+                    # Rate limited: slow down every request to this host, not just this one
+                    bucket.pause(delay)
+                self.logger.warning(f'{error} from {url}. Retry {result.attempts}/{self.max_retries} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                stage.phase('backoff')
+
+            if response.status_code != 200:
+                result.error = f'HTTP {response.status_code}'
+                return result
+
+            stage.bytes = len(response.content)
+            if self.cache is not None:
+                processed = {key: val for key, val in (meta or {}).items() if key == 'processed_hash'}
+                meta = await asyncio.to_thread(self.cache.put, url, response.content, response.headers, processed)
+            return result._set(200, response.content, meta)
+        finally:
+            stage.labels['status'] = result.status
+            get_profiler().finish(stage)
+
+
+def fetch_pages(urls, tags: dict = None, **kwargs) -> dict:
+    """
+    Fetch every URL through an AsyncFetcher and return {url: FetchResult}. Blocking, for use from tasks and scripts.
+        :param: tags -> optional {url: tag} carried onto each result
+        :param: kwargs -> AsyncFetcher options
+    """
+    tags = tags or {}
+
+    async def run():
+        async with AsyncFetcher(**kwargs) as fetcher:
+            for url in dict.fromkeys(urls):
+                fetcher.put(url, tags.get(url))
+            return {result.url: result async for result in fetcher.results()}
+
+    return asyncio.run(run())
@@ -1,7 +1,10 @@
 import time
 import sys
 import os
+import re
 import datetime as dt
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # For casting query results to a Pandas DataFrame
 import pandas as pd
@@ -9,10 +12,10 @@ import pandas as pd
 # Prefect logger
 from prefect import get_run_logger, task
 
-# Snowflake Connections
-from snowflake.connector import ProgrammingError
-from prefect_snowflake import SnowflakeCredentials, SnowflakeConnector
-from src.connectors import get_snowflake_connection
+# Snowflake Connections. The connector and prefect_snowflake are imported when queries run.
+from src.connectors import get_connection_pool
+from src.profiling import get_profiler
+from src.snowflake_queries import snowflake_stage_ingestion, DEFAULT_CHUNK_ROWS
 
 
 @task(name='url_setup')
@@ -31,18 +34,9 @@ def setup(
     logging = get_run_logger()
     logging.info(f'Received endpoint {endpoint} for source {source} and year {year}.')
 
-    # Build endpoint URL & Filenames
-    paths = ('seasons', 'teams')
-    if source in paths:
-        if source == 'seasons':
-            url = f"{endpoint}NHL_{year}_games.html#games"
-            filename = f"NHL_{year}_regular_season"
-        elif source == 'teams':
-            url = f"{endpoint}NHL_{year}.html#stats"
-            filename = f"NHL_{year}_team_stats"
-        else:
-            pass
-    else:
+    with get_profiler().stage('setup', source=source):
+        url, filename = build_url(source, endpoint, year)
+    if url is None:
         logging.error(f'Invalid source specified: {source}')
         sys.exit(1)
 
@@ -50,72 +44,329 @@ def setup(
     return url, filename
 
 
-def snowflake_query_exec(queries, method: str = 'standard'):
+def build_url(
+        source: str,
+        endpoint: str = "https://www.hockey-reference.com/leagues/",
+        year: int = dt.datetime.now().year
+):
+    """
+    Build the URL and destination filename for a source and year without the task overhead of `setup`.
+    Returns (None, None) for an unknown source.
+    """
+    # Build endpoint URL & Filenames
+    if source == 'seasons':
+        return f"{endpoint}NHL_{year}_games.html#games", f"NHL_{year}_regular_season"
+    if source == 'teams':
+        return f"{endpoint}NHL_{year}.html#stats", f"NHL_{year}_team_stats"
+    return None, None
+
+
+def write_frame(
+        data: pd.DataFrame, target, file_format: str = 'csv',
+        compression: str = 'snappy', row_group_size: int = 100_000
+):
+    """
+    Serialize a DataFrame for staging in S3.
+        :param: target -> path or binary file-like object to write to
+        :param: file_format -> 'csv' or 'parquet'. Parquet keeps column types, so Snowflake loads it without casting.
+        :param: compression -> parquet codec (snappy, zstd, gzip). Ignored for CSV.
+        :param: row_group_size -> rows per parquet row group. Ignored for CSV.
+    """
+    if file_format == 'parquet':
+        data.to_parquet(
+            target, index=False, engine='pyarrow', compression=compression, row_group_size=row_group_size,
+            coerce_timestamps='us', allow_truncated_timestamps=True
+        )
+    elif file_format == 'csv':
+        data.to_csv(target, index=False)
+    else:
+        raise ValueError(f'Unsupported file format: {file_format}')
+
+
+def write_chunks(
+        data: pd.DataFrame, directory: str, name: str, file_format: str = 'csv',
+        chunk_size: int = DEFAULT_CHUNK_ROWS, max_workers: int = 4
+) -> list:
+    """ Write a DataFrame as files of at most `chunk_size` rows under `directory`, `max_workers` at a time """
+    starts = range(0, max(len(data), 1), chunk_size)
+    paths = [os.path.join(directory, f'{name}_{idx:04d}.{file_format}') for idx in range(len(starts))]
+
+    def write(start, path):
+        write_frame(data.iloc[start:start + chunk_size], path, file_format)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(write, starts, paths))
+    return paths
+
+
+def snowflake_stage_load(
+        data: pd.DataFrame, db, schema, table, name, method: str = 'standard', file_format: str = 'csv',
+        chunk_size: int = DEFAULT_CHUNK_ROWS, parallel: int = 4
+) -> dict:
+    """
+    Load a DataFrame straight into a table through its table stage instead of S3.
+    Files of `chunk_size` rows are written locally and PUT with `parallel` threads under a prefix unique to this
+    load, so Snowflake load metadata never skips them, then copied in and purged.
+    Returns the number of files and bytes staged.
+    """
+    with tempfile.TemporaryDirectory(prefix='nhl_stage_') as directory:
+        paths = write_chunks(data, directory, name, file_format, chunk_size, parallel)
+        staged = {'files': len(paths), 'bytes': sum(os.path.getsize(path) for path in paths)}
+
+        prefix = f'{name}_{dt.datetime.now():%Y%m%d%H%M%S%f}'
+        snowflake_query_exec(
+            snowflake_stage_ingestion(db, schema, table, directory, prefix, file_format, parallel), method=method
+        )
+    return staged
+
+
+# Statements that only report a status (DDL, session commands, loads and DML). Their results are never fetched.
+STATUS_STATEMENTS = {
+    'alter', 'comment', 'copy', 'create', 'delete', 'drop', 'grant', 'insert', 'merge', 'put', 'remove', 'revoke',
+    'truncate', 'undrop', 'update', 'use',
+}
+FETCH_MODES = ('none', 'scalar', 'frame')
+# Client-side file transfers
+TRANSFER_STATEMENTS = {'get', 'put'}
+
+
+def statement_type(query: str) -> str:
+    """ Leading keyword of a statement, lower-cased, skipping whitespace and comments """
+    match = re.match(r'(?s)\s*(?:(?:--[^\n]*\n|/\*.*?\*/)\s*)*(\w+)', query)
+    return match.group(1).lower() if match else ''
+
+
+def fetch_mode(query: str, mode: str = None) -> str:
+    """ Fetch strategy for a statement: `mode` when given, otherwise 'none' for status statements and 'frame' """
+    if mode is not None:
+        if mode not in FETCH_MODES:
+            raise ValueError(f'Unsupported fetch mode: {mode}. Expected one of {FETCH_MODES}')
+        return mode
+    return 'none' if statement_type(query) in STATUS_STATEMENTS else 'frame'
+
+
+def fetch_result(curs, mode: str):
+    """
+    Read the result of a finished query once, with the strategy picked by `fetch_mode`. Returns (result, rows).
+        'none'   -> (None, rows affected or files loaded). Nothing is transferred.
+        'scalar' -> (first column of the first row or None, 1 or 0)
+        'frame'  -> (the whole result set as a DataFrame, row count)
+    """
+    if mode == 'none':
+        return None, curs.rowcount
+    if mode == 'scalar':
+        row = curs.fetchone()
+        return (row[0], 1) if row else (None, 0)
+    dataframe = curs.fetch_pandas_all()
+    return dataframe, len(dataframe)
+
+
+def snowflake_query_exec(
+        queries, method: str = 'standard', concurrent: bool = False, depends_on: dict = None, fetch: dict = None,
+        raise_errors: bool = False
+):
+    """
+    Execute a dictionary of queries against Snowflake and return any results keyed like the input.
+        :param: queries -> {name: query} as produced by the builders in src.snowflake_queries
+        :param: method -> connection method passed to the connection pool. Default: standard
+        :param: concurrent -> submit every query whose dependencies are met together and wait on all of them. Default: False
+        :param: depends_on -> {name: [names that must finish first]} ordering constraints for concurrent mode
+        :param: fetch -> {name: 'none' | 'scalar' | 'frame'} to override the fetch strategy picked from the statement
+                         type. DDL, COPY and DML are not fetched and are left out of the results; anything else is
+                         returned as a DataFrame. Use snowflake_query_batches to stream large results.
+        :param: raise_errors -> re-raise a failed query after logging it, for callers whose next step depends on it
+                                having succeeded. Default: False, the error is logged and None is returned
+    """
+    from snowflake.connector import ProgrammingError
+
+    fetch = fetch or {}
     logging = get_run_logger()
     try:
-        # Cursor & Connection
-        conn = get_snowflake_connection(method)
-        logging.info(f"Snowflake connection established: {conn}")
+        # Cursor & Connection, borrowed from the process-wide pool so every task shares one session
+        with get_connection_pool(method).connection() as conn:
+            logging.info(f"Snowflake connection established: {conn}")
 
-        response = {}
+            response = {}
 
-        if conn:
-            curs = conn.cursor()
+            if conn and concurrent:
+                return _execute_concurrent(conn, queries, depends_on or {}, fetch, logging)
 
-            # Retrieve formatted queries and execute - Snowflake Connector Form. Async
-            for idx, query in queries.items():
+            if conn:
+                curs = conn.cursor()
 
-                logging.info(
-                    f"""
-                    Executing Query {idx}: \n
-                    \t{query}\n
-                    """
-                )
+                # Retrieve formatted queries and execute - Snowflake Connector Form. Async
+                for idx, query in queries.items():
 
-                curs.execute_async(query)
-                query_id = curs.sfqid
-                logging.info(f'Query added to queue: {query_id}')
+                    logging.info(
+                        f"""
+                        Executing Query {idx}: \n
+                        \t{query}\n
+                        """
+                    )
 
-                curs.get_results_from_sfqid(query_id)
+                    stage = get_profiler().start('snowflake_query', query=idx)
+                    if statement_type(query) in TRANSFER_STATEMENTS:
+                        # The connector moves the files itself, which only works synchronously
+                        curs.execute(query)
+                        query_id = curs.sfqid
+                        stage.labels['query_id'] = query_id
+                    else:
+                        curs.execute_async(query)
+                        query_id = curs.sfqid
+                        stage.labels['query_id'] = query_id
+                        stage.phase('queue')
+                        logging.info(f'Query added to queue: {query_id}')
 
-                # IF THE SNOWFLAKE QUERY RETURNS DATA, STORE IT. ELSE, CONTINUE PROCESS.
-                result = curs.fetchone()
-                df = curs.fetch_pandas_all()
+                        curs.get_results_from_sfqid(query_id)
+                    stage.phase('execution')
 
-                if result:
-                    logging.info(f'Query result: {result}')
-                    logging.info(f'Query completed successfully and stored: {query_id}')
-                    response[idx] = result[0]
-                    if len(df):
-                        response[idx] = df
+                    # IF THE SNOWFLAKE QUERY RETURNS DATA, STORE IT. ELSE, CONTINUE PROCESS.
+                    mode = fetch_mode(query, fetch.get(idx))
+                    result, stage.rows = fetch_result(curs, mode)
+                    stage.phase('fetch')
+                    get_profiler().finish(stage)
 
-                while conn.is_still_running(conn.get_query_status_throw_if_error(query_id)):
-                    logging.info(f'Awaiting query completion for {query_id}')
-                    time.sleep(1)
+                    if mode != 'none':
+                        logging.info(f'Query completed successfully and stored: {query_id}')
+                        response[idx] = result
+                    else:
+                        logging.info(f'Query completed successfully: {query_id}. Rows affected: {stage.rows}')
 
-            return response
+                    while conn.is_still_running(conn.get_query_status_throw_if_error(query_id)):
+                        logging.info(f'Awaiting query completion for {query_id}')
+                        time.sleep(1)
 
-        if not conn:
-            # Retrieve formatted queries and execute - Fallback: Prefect Snowflake Connector. Sync
-            # Prefect Snowflake Connector
+                curs.close()
+                return response
 
-            logging.warning(f"Snowflake cursor is empty! Attempting Prefect Connector.")
-            credentials = SnowflakeCredentials.load("development")
+        # Retrieve formatted queries and execute - Fallback: Prefect Snowflake Connector. Sync
+        # Prefect Snowflake Connector
 
-            with SnowflakeConnector.load("development") as cnx:
-                for idx, query in queries.items():
-                        logging.info(
-                            f"""
-                            Executing Query {idx}: \n
-                            \t{query}\n
-                            """
-                        )
-                        result = cnx.fetch_all(query)
-                        if result:
-                            logging.info(f'Query Result from Prefect Snowflake: {result}')
-                            response[idx] = result
-
-            return response
+        logging.warning(f"Snowflake cursor is empty! Attempting Prefect Connector.")
+        from prefect_snowflake import SnowflakeCredentials, SnowflakeConnector
+        credentials = SnowflakeCredentials.load("development")
+
+        with SnowflakeConnector.load("development") as cnx:
+            for idx, query in queries.items():
+                    logging.info(
+                        f"""
+                        Executing Query {idx}: \n
+                        \t{query}\n
+                        """
+                    )
+                    mode = fetch_mode(query, fetch.get(idx))
+                    if mode == 'none':
+                        cnx.execute(query)
+                        continue
+
+                    result = cnx.fetch_one(query) if mode == 'scalar' else cnx.fetch_all(query)
+                    if result:
+                        logging.info(f'Query Result from Prefect Snowflake: {result}')
+                        response[idx] = result[0] if mode == 'scalar' else result
+
+        return response
 
     except ProgrammingError as err:
         logging.error(f'Programming Error: {err}')
+        if raise_errors:
+            raise
+
+
+def _wait_for_queries(conn, query_ids, initial_delay: float = 0.05, max_delay: float = 5.0):
+    """ Poll a set of query ids with exponential backoff until at least one finishes. Returns the finished ids. """
+    delay = initial_delay
+    while True:
+        finished = [
+            query_id for query_id in query_ids
+            if not conn.is_still_running(conn.get_query_status_throw_if_error(query_id))
+        ]
+        if finished:
+            return finished
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def _execute_concurrent(conn, queries, depends_on, fetch, logging):
+    """ Submit every query whose dependencies have completed, wait on all in-flight query ids and repeat """
+    # Dependencies on queries outside this batch are already satisfied
+    depends_on = {idx: [dep for dep in depends_on.get(idx, []) if dep in queries] for idx in queries}
+
+    pending, running, completed = dict(queries), {}, set()
+    response = {}
+
+    while pending or running:
+        ready = [idx for idx in pending if all(dep in completed for dep in depends_on[idx])]
+        if not ready and not running:
+            raise ValueError(f'Circular query dependencies between: {list(pending)}')
+
+        for idx in ready:
+            query = pending.pop(idx)
+            logging.info(
+                f"""
+                Executing Query {idx}: \n
+                \t{query}\n
+                """
+            )
+            stage = get_profiler().start('snowflake_query', query=idx)
+            curs = conn.cursor()
+            curs.execute_async(query)
+            stage.labels['query_id'] = curs.sfqid
+            stage.phase('queue')
+            running[curs.sfqid] = (idx, curs, stage)
+            logging.info(f'Query added to queue: {curs.sfqid}')
+
+        for query_id in _wait_for_queries(conn, list(running)):
+            idx, curs, stage = running.pop(query_id)
+            curs.get_results_from_sfqid(query_id)
+            # Includes time spent waiting on other queries of the batch, as they are polled together
+            stage.phase('execution')
+
+            # IF THE SNOWFLAKE QUERY RETURNS DATA, STORE IT. ELSE, CONTINUE PROCESS.
+            mode = fetch_mode(queries[idx], fetch.get(idx))
+            result, stage.rows = fetch_result(curs, mode)
+            stage.phase('fetch')
+            get_profiler().finish(stage)
+
+            if mode != 'none':
+                logging.info(f'Query completed successfully and stored: {query_id}')
+                response[idx] = result
+            else:
+                logging.info(f'Query completed successfully: {query_id}. Rows affected: {stage.rows}')
+
+            curs.close()
+            completed.add(idx)
+
+    return response
+
+
+def snowflake_query_batches(query: str, method: str = 'standard', batch_format: str = 'pandas'):
+    """
+    Stream the result of a large SELECT in the connector's result batches, so only one batch is held in memory.
+    The pooled session stays checked out until the iterator is exhausted or closed.
+        :param: query -> a single SELECT statement
+        :param: method -> connection method passed to the connection pool. Default: standard
+        :param: batch_format -> 'pandas' to yield DataFrames, 'arrow' to yield pyarrow Tables. Default: pandas
+    """
+    if batch_format not in ('pandas', 'arrow'):
+        raise ValueError(f'Unsupported batch format: {batch_format}')
+
+    logging = get_run_logger()
+    with get_connection_pool(method).connection() as conn:
+        curs = conn.cursor()
+        # Wall time includes the time the caller spends on each batch
+        stage = get_profiler().start('snowflake_query', query='batches', format=batch_format)
+        stage.rows = 0
+        try:
+            curs.execute(query)
+            stage.labels['query_id'] = curs.sfqid
+            stage.phase('execution')
+            logging.info(f'Streaming results of {curs.sfqid} as {batch_format} batches')
+
+            batches = curs.fetch_pandas_batches() if batch_format == 'pandas' else curs.fetch_arrow_batches()
+            for batch in batches:
+                stage.rows += len(batch) if batch_format == 'pandas' else batch.num_rows
+                yield batch
+            stage.phase('fetch')
+        finally:
+            get_profiler().finish(stage)
+            curs.close()
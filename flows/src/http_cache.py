@@ -0,0 +1,238 @@
+# On-disk HTTP cache for hockeyreference.com pages. Bodies are stored gzip compressed next to a small JSON
+# metadata file holding the validators (ETag / Last-Modified) used for conditional requests.
+
+import datetime as dt
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+
+from src.connectors import env_setting
+
+# Pages for seasons that have finished never change. The current season page changes a few times a day.
+CURRENT_SEASON_TTL = {
+    'seasons': 4 * 60 * 60,
+    'teams': 4 * 60 * 60,
+}
+DEFAULT_TTL = 60 * 60
+
+# Overridden by NHL_HTTP_CACHE_DIR and NHL_HTTP_CACHE_MAX_BYTES
+DEFAULT_CACHE_DIR = './data/http_cache'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class Unchanged:
+    """ Returned by the flows' file_parser instead of a frame when the page was already loaded downstream.
+        Checked by type rather than identity, so it survives task results persisted by Prefect.
+    """
+
+    def __repr__(self):
+        return 'UNCHANGED'
+
+
+UNCHANGED = Unchanged()
+
+
+def is_unchanged(result) -> bool:
+    return isinstance(result, Unchanged)
+
+
+def current_season(today: dt.date = None) -> int:
+    """ NHL seasons are named after the year they end in. A new season starts being published in the fall. """
+    today = today or dt.date.today()
+    return today.year + 1 if today.month >= 9 else today.year
+
+
+def season_end(year: int) -> float:
+    """ Timestamp after which a season's pages are final, matching the June 30 boundary of a season's games """
+    return dt.datetime(year, 7, 1).timestamp()
+
+
+def cache_ttl(url: str, fetched_at: float = None):
+    """ Seconds a cached page stays fresh without revalidation. None means the page is immutable.
+        A finished season is only immutable when the cached copy was fetched after the season ended. An older copy
+        may predate the final games, so it is revalidated once, after which touch() records the new fetch time.
+    """
+    match = re.search(r'NHL_(\d{4})(_games)?\.html', url)
+    if not match:
+        return DEFAULT_TTL
+
+    year, source = int(match.group(1)), 'seasons' if match.group(2) else 'teams'
+    if year >= current_season():
+        return CURRENT_SEASON_TTL[source]
+    if fetched_at is not None and fetched_at >= season_end(year):
+        return None
+    return 0
+
+
+class HttpCache:
+    """ Size-bounded on-disk cache with LRU eviction. Safe to share between threads in one process. """
+
+    def __init__(self, directory: str = None, max_bytes: int = None):
+        self.directory = env_setting('NHL_HTTP_CACHE_DIR', DEFAULT_CACHE_DIR) if directory is None else directory
+        self.max_bytes = (
+            int(env_setting('NHL_HTTP_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)) if max_bytes is None else max_bytes
+        )
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.split('#')[0].encode()).hexdigest()
+        base = os.path.join(self.directory, key)
+        return f'{base}.json', f'{base}.gz'
+
+    def contains(self, url) -> bool:
+        return all(os.path.exists(path) for path in self._paths(url))
+
+    def get(self, url):
+        """ Metadata and decompressed body for a url, or (None, None) on a miss """
+        meta_path, body_path = self._paths(url)
+        with self._lock:
+            if not (os.path.exists(meta_path) and os.path.exists(body_path)):
+                return None, None
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with gzip.open(body_path, 'rb') as f:
+                body = f.read()
+            # Access time drives LRU eviction
+            os.utime(meta_path)
+        return meta, body
+
+    def put(self, url, body: bytes, headers, meta: dict = None):
+        """ Store a body and its validators. Keeps the processed marker of the previous entry. """
+        meta_path, body_path = self._paths(url)
+        meta = dict(meta or {})
+        meta.update({
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+            'content_hash': hashlib.sha256(body).hexdigest(),
+        })
+        with self._lock:
+            with gzip.open(body_path, 'wb', compresslevel=6) as f:
+                f.write(body)
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        self.evict()
+        return meta
+
+    def touch(self, url, meta: dict):
+        """ Mark a cached entry as revalidated now """
+        meta_path, _ = self._paths(url)
+        meta['fetched_at'] = time.time()
+        with self._lock:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        return meta
+
+    def mark_processed(self, url):
+        """ Record that the current body was loaded downstream so an identical page can be skipped next time """
+        meta, _ = self.get(url)
+        if meta is not None:
+            meta['processed_hash'] = meta['content_hash']
+            meta_path, _ = self._paths(url)
+            with self._lock:
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in `max_bytes` """
+        with self._lock:
+            entries, total = [], 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                meta_path = os.path.join(self.directory, name)
+                body_path = meta_path[:-len('.json')] + '.gz'
+                size = os.path.getsize(meta_path) + (os.path.getsize(body_path) if os.path.exists(body_path) else 0)
+                entries.append((os.path.getmtime(meta_path), meta_path, body_path, size))
+                total += size
+
+            for _, meta_path, body_path, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for path in (meta_path, body_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                total -= size
+
+
+def _cached_response(url, body: bytes, meta: dict, from_cache: bool) -> requests.Response:
+    response = requests.Response()
+    response._content = body
+    response.status_code = 200
+    response.url = url
+    response.encoding = 'utf-8'
+    return _annotate(response, meta, from_cache)
+
+
+def _annotate(response, meta: dict, from_cache: bool):
+    response.from_cache = from_cache
+    response.content_hash = meta['content_hash']
+    response.content_changed = meta['content_hash'] != meta.get('processed_hash')
+    return response
+
+
+class CachedSession:
+    """ Wraps a requests session with conditional requests against an HttpCache.
+        Responses carry `from_cache`, `content_hash` and `content_changed` attributes.
+    """
+
+    def __init__(self, session: requests.Session, cache: HttpCache):
+        self.session = session
+        self.cache = cache
+
+    def get(self, url, **kwargs):
+        meta, body = self.cache.get(url)
+
+        if meta is not None:
+            ttl = cache_ttl(url, meta['fetched_at'])
+            if ttl is None or time.time() - meta['fetched_at'] < ttl:
+                return _cached_response(url, body, meta, from_cache=True)
+
+            # Stale: revalidate with the stored validators
+            headers = dict(kwargs.pop('headers', None) or {})
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            kwargs['headers'] = headers
+
+        response = self.session.get(url, **kwargs)
+
+        if response.status_code == 304 and meta is not None:
+            meta = self.cache.touch(url, meta)
+            return _cached_response(url, body, meta, from_cache=True)
+
+        if response.status_code == 200:
+            meta = self.cache.put(url, response.content, response.headers, meta={
+                key: val for key, val in (meta or {}).items() if key == 'processed_hash'
+            })
+            return _annotate(response, meta, from_cache=False)
+
+        return response
+
+    def mark_processed(self, url):
+        self.cache.mark_processed(url)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_http_cache() -> HttpCache:
+    """ Process-wide cache instance shared by every session """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = HttpCache()
+        return _cache
@@ -0,0 +1,109 @@
+# Incremental loading helpers. Diffs a freshly parsed season against a watermark of what was last loaded so only
+# new or changed games are merged into Snowflake instead of deleting and re-copying the whole season.
+# Team stats snapshots are diffed the same way and only changed teams are appended to their history table.
+
+import os
+import pandas as pd
+
+# Natural key of a regular season game and the columns that can change once it is scheduled
+SEASON_KEYS = ['date', 'away_team_id', 'home_team_id']
+SEASON_VALUES = ['away_goals', 'home_goals', 'length_of_game_min']
+
+# Team stats rows are keyed by team within a season. Every stat column can change after a game is played.
+TEAM_KEYS = ['Team']
+TEAM_VALUES = ['GP', 'W', 'L', 'OL', 'PTS', 'PTS%', 'GF', 'GA', 'SRS', 'SOS', 'RPt%', 'RW', 'RgRec', 'RgPt%']
+
+WATERMARK_DIR = './data/watermarks'
+
+
+def _normalize(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """ Coerce a season frame to comparable string columns regardless of whether it came from
+        hockeyreference.com (datetime64 / float) or from Snowflake (date / integer / varchar).
+    """
+    dataframe = dataframe.rename(columns=str.lower)
+    normalized = pd.DataFrame({
+        'date': pd.to_datetime(dataframe['date']).dt.strftime('%Y-%m-%d'),
+        'away_team_id': dataframe['away_team_id'].astype(str),
+        'home_team_id': dataframe['home_team_id'].astype(str),
+    })
+    for col in SEASON_VALUES:
+        normalized[col] = pd.to_numeric(dataframe[col], errors='coerce').round().astype('Int64').astype(str)
+    return normalized
+
+
+def row_hashes(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """ Key columns plus a stable hash of the value columns for each game """
+    normalized = _normalize(dataframe)
+    hashes = normalized[SEASON_KEYS].copy()
+    hashes['row_hash'] = pd.util.hash_pandas_object(normalized[SEASON_VALUES], index=False).astype('uint64')
+    return hashes
+
+
+def changed_rows(dataframe: pd.DataFrame, watermark: pd.DataFrame) -> pd.DataFrame:
+    """ Rows of `dataframe` that are new or whose values differ from the watermark """
+    current = row_hashes(dataframe)
+    if watermark is None or not len(watermark):
+        return dataframe
+
+    # A game stored twice would fan out the merge, keep one hash per key so the mask lines up with `dataframe`
+    loaded = watermark[SEASON_KEYS + ['row_hash']].drop_duplicates(SEASON_KEYS, keep='last')
+    merged = current.merge(
+        loaded.astype({'row_hash': 'uint64'}),
+        on=SEASON_KEYS, how='left', suffixes=('', '_loaded')
+    )
+    mask = (merged['row_hash'] != merged['row_hash_loaded']).to_numpy()
+    return dataframe[mask]
+
+
+def team_row_hashes(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """ Team plus a stable hash of its stats. Numbers are compared as floats so int/float drift is not a change. """
+    values = pd.DataFrame({
+        col: (
+            dataframe[col].astype('float64').round(6).astype(str)
+            if pd.api.types.is_numeric_dtype(dataframe[col]) else dataframe[col].astype(str)
+        )
+        for col in TEAM_VALUES
+    })
+    hashes = dataframe[TEAM_KEYS].astype(str).reset_index(drop=True)
+    hashes['row_hash'] = pd.util.hash_pandas_object(values, index=False).astype('uint64').to_numpy()
+    return hashes
+
+
+def changed_team_rows(dataframe: pd.DataFrame, current: pd.DataFrame, season) -> pd.DataFrame:
+    """
+    Team rows whose stats differ from the current history rows, laid out for the history table: the team_stats
+    columns followed by season and row_hash. Empty when the snapshot is unchanged.
+    """
+    hashes = team_row_hashes(dataframe)
+    mask = pd.Series(True, index=hashes.index)
+    if current is not None and len(current):
+        # Snowflake returns unquoted identifiers upper-cased (TEAM, ROW_HASH), DuckDB and local files keep their case
+        current = current.rename(columns=str.lower).rename(columns={'team': 'Team'})
+        loaded = dict(zip(current['Team'].astype(str), current['row_hash'].astype('uint64')))
+        mask = hashes['row_hash'] != hashes['Team'].map(loaded)
+
+    changes = dataframe.reset_index(drop=True)[mask.to_numpy()].copy()
+    changes['season'] = season
+    changes['row_hash'] = hashes['row_hash'][mask].astype(str).to_numpy()
+    return changes
+
+
+def snowflake_watermark(loaded: pd.DataFrame) -> pd.DataFrame:
+    """ Watermark built from the rows currently stored in Snowflake """
+    if loaded is None or not isinstance(loaded, pd.DataFrame) or not len(loaded):
+        return None
+    return row_hashes(loaded)
+
+
+def load_local_watermark(table: str, year) -> pd.DataFrame:
+    path = os.path.join(WATERMARK_DIR, f'{table}_{year}.csv')
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, dtype={'row_hash': 'uint64'})
+
+
+def save_local_watermark(dataframe: pd.DataFrame, table: str, year, hashes=row_hashes):
+    os.makedirs(WATERMARK_DIR, exist_ok=True)
+    path = os.path.join(WATERMARK_DIR, f'{table}_{year}.csv')
+    hashes(dataframe).to_csv(path, index=False)
+    return path
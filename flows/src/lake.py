@@ -0,0 +1,212 @@
+# Local Parquet data lake. Every parsed source is stored as a hive-style partitioned dataset,
+#   {root}/{source}/season={year}/part-{hash}.parquet
+#   {root}/{source}/season={year}/snapshot={date}/part-{hash}.parquet   (sources that are re-scraped as snapshots)
+# next to a manifest.json holding row counts, min/max dates and content hashes per partition. Reads prune partitions
+# from the manifest and project columns, so analyses over many seasons only open the files and columns they need.
+# The lake is also what sync_to_s3 mirrors into a bucket.
+
+import datetime as dt
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+
+from prefect import get_run_logger, task
+
+from src.connectors import env_setting
+from src.helpers import write_frame
+from src.profiling import get_profiler
+from src.serializers import FRAME_TASK
+
+# Overridden by NHL_LAKE_DIR
+DEFAULT_LAKE_DIR = './data/lake'
+
+# Team stats change during a season, so each scrape is kept as its own snapshot partition
+SNAPSHOT_SOURCES = {'teams'}
+DATE_COLUMNS = {'seasons': 'date'}
+PARTITION_KEYS = ['season', 'snapshot']
+# Load timestamps added by DataTransform. A page scraped again with the same data is not a change.
+METADATA_COLUMNS = ['updated_at']
+
+
+def content_hash(dataframe: pd.DataFrame) -> str:
+    """ Hash of the values and column names of a frame, independent of how it is serialized and when it was loaded """
+    dataframe = dataframe.drop(columns=[col for col in METADATA_COLUMNS if col in dataframe.columns])
+    digest = hashlib.sha256(','.join(map(str, dataframe.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(dataframe, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class DataLake:
+    """ Partitioned Parquet datasets under `root` with a JSON manifest. Safe to share between threads in one process. """
+
+    def __init__(self, root: str = None):
+        self.root = env_setting('NHL_LAKE_DIR', DEFAULT_LAKE_DIR) if root is None else root
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(self.root, 'manifest.json')
+
+    def manifest(self) -> dict:
+        """ {source: {partition path: entry}} """
+        if not os.path.exists(self._manifest_path):
+            return {}
+        with open(self._manifest_path) as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: dict):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f'{self._manifest_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self._manifest_path)
+
+    def write(self, dataframe: pd.DataFrame, source: str, season: int, snapshot=None) -> dict:
+        """
+        Store a parsed frame as the partition for its season, replacing the previous file of that partition.
+        Snapshot sources get one partition per `snapshot` date, today by default. Unchanged data is not rewritten.
+        Returns the manifest entry of the partition.
+        """
+        partition = {'season': int(season)}
+        if source in SNAPSHOT_SOURCES:
+            partition['snapshot'] = str(snapshot or dt.date.today())
+        path = os.path.join(source, *(f'{key}={value}' for key, value in partition.items()))
+
+        digest = content_hash(dataframe)
+        with self._lock:
+            manifest = self.manifest()
+            previous = manifest.get(source, {}).get(path)
+            if previous is not None and previous['content_hash'] == digest:
+                return previous
+
+            file = os.path.join(path, f'part-{digest[:16]}.parquet')
+            os.makedirs(os.path.join(self.root, path), exist_ok=True)
+            write_frame(dataframe, os.path.join(self.root, file), 'parquet')
+
+            date_col = DATE_COLUMNS.get(source)
+            dates = pd.to_datetime(dataframe[date_col]) if date_col in dataframe.columns else None
+            entry = {
+                'partition': partition,
+                'file': file,
+                'rows': len(dataframe),
+                'bytes': os.path.getsize(os.path.join(self.root, file)),
+                'columns': list(map(str, dataframe.columns)),
+                'min_date': dates.min().strftime('%Y-%m-%d') if dates is not None and dates.notna().any() else None,
+                'max_date': dates.max().strftime('%Y-%m-%d') if dates is not None and dates.notna().any() else None,
+                'content_hash': digest,
+                'written_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+                'synced_hash': previous.get('synced_hash') if previous else None,
+            }
+            manifest.setdefault(source, {})[path] = entry
+            self._save_manifest(manifest)
+
+            if previous is not None and previous['file'] != file:
+                os.remove(os.path.join(self.root, previous['file']))
+        return entry
+
+    def partitions(self, source: str, seasons=None, start=None, end=None, snapshot=None) -> list:
+        """
+        Manifest entries of `source` that can hold matching rows, sorted by partition.
+            :param: seasons -> iterable of seasons to keep. Default: every season
+            :param: start / end -> inclusive date range. Partitions whose min/max dates fall outside it are skipped.
+            :param: snapshot -> a snapshot date, or 'latest' for the newest snapshot of each season
+        """
+        entries = list(self.manifest().get(source, {}).values())
+        if seasons is not None:
+            seasons = {int(season) for season in seasons}
+            entries = [entry for entry in entries if entry['partition']['season'] in seasons]
+        if start is not None:
+            start = str(pd.Timestamp(start).date())
+            entries = [entry for entry in entries if entry['max_date'] is None or entry['max_date'] >= start]
+        if end is not None:
+            end = str(pd.Timestamp(end).date())
+            entries = [entry for entry in entries if entry['min_date'] is None or entry['min_date'] <= end]
+        if snapshot == 'latest':
+            latest = {}
+            for entry in entries:
+                season = entry['partition']['season']
+                if season not in latest or entry['partition']['snapshot'] > latest[season]['partition']['snapshot']:
+                    latest[season] = entry
+            entries = list(latest.values())
+        elif snapshot is not None:
+            entries = [entry for entry in entries if entry['partition'].get('snapshot') == str(snapshot)]
+        return sorted(entries, key=lambda entry: sorted(entry['partition'].items()))
+
+    def read(self, source: str, columns: list = None, seasons=None, start=None, end=None, snapshot=None) -> pd.DataFrame:
+        """
+        Rows of `source` from the pruned partitions, with partition keys as columns.
+            :param: columns -> data and/or partition columns to return. Only these are read from the files.
+            :param: seasons / start / end / snapshot -> see `partitions`. `start` and `end` also filter rows, using
+                    the Parquet row group statistics to skip data.
+        """
+        import pyarrow.parquet as pq
+
+        date_col = DATE_COLUMNS.get(source)
+        keys = [key for key in PARTITION_KEYS if columns is None or key in columns]
+        data_columns = None if columns is None else [col for col in columns if col not in PARTITION_KEYS]
+
+        filters = []
+        if date_col and start is not None:
+            filters.append((date_col, '>=', pd.Timestamp(start)))
+        if date_col and end is not None:
+            filters.append((date_col, '<', pd.Timestamp(end) + pd.Timedelta(days=1)))
+
+        frames = []
+        for entry in self.partitions(source, seasons, start, end, snapshot):
+            table = pq.read_table(
+                os.path.join(self.root, entry['file']), columns=data_columns, filters=filters or None
+            )
+            frame = table.to_pandas()
+            for key in keys:
+                if key in entry['partition']:
+                    frame[key] = entry['partition'][key]
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def sync_to_s3(self, bucket: str, prefix: str = 'lake', client=None) -> list:
+        """ Upload partitions changed since their last sync, plus the manifest, under s3://bucket/prefix/ """
+        from src.connectors import get_s3_client
+
+        client = client or get_s3_client()
+        uploaded = []
+        with self._lock:
+            manifest = self.manifest()
+            for entries in manifest.values():
+                for entry in entries.values():
+                    if entry.get('synced_hash') == entry['content_hash']:
+                        continue
+                    key = f"{prefix}/{entry['file']}".replace(os.sep, '/')
+                    client.upload_file(os.path.join(self.root, entry['file']), bucket, key)
+                    entry['synced_hash'] = entry['content_hash']
+                    uploaded.append(key)
+            if uploaded:
+                self._save_manifest(manifest)
+                client.upload_file(self._manifest_path, bucket, f'{prefix}/manifest.json')
+        return uploaded
+
+
+_lake = None
+_lake_lock = threading.Lock()
+
+
+def get_data_lake() -> DataLake:
+    """ Process-wide lake instance shared by every task """
+    global _lake
+    with _lake_lock:
+        if _lake is None:
+            _lake = DataLake()
+        return _lake
+
+
+@task(name="lake_store", **FRAME_TASK)
+def lake_store(dataframe: pd.DataFrame, source: str, year):
+    """ Store a parsed source in the local Parquet lake """
+    logging = get_run_logger()
+    with get_profiler().stage('lake_store', source=source) as stage:
+        entry = get_data_lake().write(dataframe, source, year)
+        stage.rows, stage.bytes = entry['rows'], entry['bytes']
+    logging.info(f"Stored {entry['rows']} rows in the data lake at {entry['file']}")
+    return entry
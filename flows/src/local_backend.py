@@ -0,0 +1,414 @@
+# Local execution backend for development and CI. Emulates the parts of the Snowflake connector and boto3 S3 client
+# used by the pipeline on top of an embedded DuckDB database and the local filesystem, so full production-mode flows
+# can run offline without a warehouse or a bucket.
+#
+#   NHL_S3_BACKEND=local python flows/nhl_pipeline.py --snowflake_conn local --env production
+
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+from snowflake.connector import ProgrammingError
+
+from src.connectors import env_setting
+
+# Overridden by NHL_LOCAL_WAREHOUSE_DIR
+DEFAULT_LOCAL_ROOT = './data/local_warehouse'
+# Rows per batch for fetch_*_batches. Snowflake sizes its result chunks server-side.
+LOCAL_BATCH_ROWS = 50_000
+
+
+def local_root():
+    return env_setting('NHL_LOCAL_WAREHOUSE_DIR', DEFAULT_LOCAL_ROOT)
+
+
+def _local_s3_root():
+    return os.path.join(local_root(), 's3')
+
+
+def _stage_path(url: str) -> str:
+    """ s3://bucket/prefix/ -> local directory mirroring the bucket """
+    return os.path.join(_local_s3_root(), re.sub(r'^s3://', '', url))
+
+
+class LocalS3Client:
+    """ Subset of the boto3 S3 client API backed by directories under local_root()/s3 """
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        path = os.path.join(_local_s3_root(), bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def head_bucket(self, Bucket):
+        os.makedirs(os.path.join(_local_s3_root(), Bucket), exist_ok=True)
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        with open(self._path(Bucket, Key), 'wb') as f:
+            f.write(Body)
+        return {'ETag': uuid.uuid4().hex}
+
+    def get_object(self, Bucket, Key):
+        with open(os.path.join(_local_s3_root(), Bucket, Key), 'rb') as f:
+            return {'Body': io.BytesIO(f.read())}
+
+    def upload_file(self, Filename, Bucket, Key):
+        shutil.copyfile(Filename, self._path(Bucket, Key))
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self._uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'{UploadId}-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            parts = self._uploads.pop(UploadId)
+        with open(self._path(Bucket, Key), 'wb') as f:
+            for part in sorted(MultipartUpload['Parts'], key=lambda part: part['PartNumber']):
+                f.write(parts[part['PartNumber']])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        return {}
+
+
+class LocalCursor:
+    """ Snowflake cursor look-alike. Queries run synchronously, so they are already finished when submitted. """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.sfqid = None
+        self.rowcount = None
+        self._result = None
+        self._position = 0
+
+    def execute(self, query):
+        self.sfqid = self.connection._run(query)
+        self.get_results_from_sfqid(self.sfqid)
+        return self
+
+    def execute_async(self, query):
+        self.sfqid = self.connection._run(query)
+        return self
+
+    def get_results_from_sfqid(self, query_id):
+        self.connection.get_query_status_throw_if_error(query_id)
+        self._load(query_id)
+
+    def _load(self, query_id):
+        self._result = self.connection._results[query_id][0]
+        self._position = 0
+        self.rowcount = None if self._result is None else len(self._result)
+
+    def fetchone(self):
+        if self._result is None or self._position >= len(self._result):
+            return None
+        row = tuple(self._result.iloc[self._position])
+        self._position += 1
+        return row
+
+    def fetch_pandas_all(self):
+        # Like the Snowflake connector, this reads the whole result set regardless of earlier fetchone calls
+        if self._result is None:
+            return pd.DataFrame()
+        self._position = len(self._result)
+        return self._result.reset_index(drop=True)
+
+    def fetch_arrow_all(self):
+        if self._result is None or not len(self._result.columns):
+            return None
+        return pa.Table.from_pandas(self.fetch_pandas_all(), preserve_index=False)
+
+    def fetch_arrow_batches(self):
+        table = self.fetch_arrow_all()
+        if table is None:
+            return
+        for batch in table.to_batches(max_chunksize=LOCAL_BATCH_ROWS):
+            yield pa.Table.from_batches([batch])
+
+    def fetch_pandas_batches(self):
+        for table in self.fetch_arrow_batches():
+            yield table.to_pandas()
+
+    def close(self):
+        self._result = None
+
+
+class LocalConnection:
+    """ Snowflake connection look-alike over DuckDB. Each Snowflake database is a DuckDB file under local_root(). """
+
+    def __init__(self, database: str = None, schema: str = None):
+        os.makedirs(local_root(), exist_ok=True)
+        self._db = duckdb.connect()
+        self._lock = threading.Lock()
+        self._results = {}
+        self._closed = False
+        self._database = None
+        self._schema = schema or 'main'
+        if database:
+            self._run(f'create database if not exists {database}')
+            self._run(f'use database {database}')
+
+    # Snowflake connector API
+    def cursor(self):
+        return LocalCursor(self)
+
+    def is_still_running(self, status):
+        return False
+
+    def get_query_status_throw_if_error(self, query_id):
+        _, error = self._results[query_id]
+        if error is not None:
+            raise ProgrammingError(msg=str(error))
+        return 'SUCCESS'
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._db.close()
+            self._closed = True
+
+    # Local registries persisted next to the database files
+    def _registry(self, name):
+        path = os.path.join(local_root(), f'{name}.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_registry(self, name, data):
+        with open(os.path.join(local_root(), f'{name}.json'), 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def _run(self, query):
+        """ Translate and execute a statement, storing its result or error under a new query id """
+        query_id = uuid.uuid4().hex
+        with self._lock:
+            try:
+                self._results[query_id] = (self._execute(query.strip().rstrip(';').strip()), None)
+            except Exception as e:
+                self._results[query_id] = (None, e)
+        return query_id
+
+    def _sql(self, sql):
+        relation = self._db.execute(sql)
+        try:
+            return relation.df()
+        except Exception:
+            # Statements without a result set
+            return pd.DataFrame()
+
+    def _attach(self, name, create):
+        path = f'{os.path.join(local_root(), name)}.duckdb'
+        attached = self._sql('select database_name from duckdb_databases()')['database_name'].tolist()
+        if name not in attached and (create or os.path.exists(path)):
+            self._sql(f"attach '{path}' as {name}")
+
+    def _execute(self, query):
+        # Snowflake-only objects
+        if re.match(r'(?is)^create\s+file\s+format', query):
+            return pd.DataFrame()
+        match = re.match(r"(?is)^create\s+stage\s+if\s+not\s+exists\s+([\w.]+).*?url\s*=\s*'([^']+)'", query)
+        if match:
+            stages = self._registry('stages')
+            stages[match.group(1).split('.')[-1].lower()] = match.group(2)
+            self._save_registry('stages', stages)
+            return pd.DataFrame()
+
+        # Databases map to attached DuckDB files, schemas to DuckDB schemas inside them
+        match = re.match(r'(?is)^create\s+database\s+if\s+not\s+exists\s+(\w+)', query)
+        if match:
+            self._attach(match.group(1).lower(), create=True)
+            return pd.DataFrame()
+        match = re.match(r'(?is)^use\s+database\s+(\w+)', query)
+        if match:
+            self._database = match.group(1).lower()
+            # Databases created by an earlier run exist on disk but are not attached to this session yet
+            self._attach(self._database, create=False)
+            self._sql(f'use {self._database}')
+            return pd.DataFrame()
+        match = re.match(r'(?is)^create\s+schema\s+if\s+not\s+exists\s+(\w+)', query)
+        if match:
+            return self._sql(f'create schema if not exists {self._database}.{match.group(1)}')
+        match = re.match(r'(?is)^use\s+schema\s+(\w+)', query)
+        if match:
+            self._schema = match.group(1).lower()
+            self._sql(f'use {self._database}.{self._schema}')
+            return pd.DataFrame()
+
+        if re.match(r'(?is)^copy\s+into', query):
+            return self._copy_into(query)
+        if re.match(r'(?is)^put\s', query):
+            return self._put(query)
+
+        return self._sql(self._translate(query))
+
+    def _translate(self, query):
+        """ Rewrite Snowflake dialect that DuckDB does not accept """
+        # Stage file references inside queries, e.g. MERGE ... USING (SELECT $1 ... FROM @stage/file.csv (...))
+        def read_stage(match):
+            path = self._resolve_stage(match.group(1), match.group(2))
+            with open(path) as f:
+                width = len(f.readline().split(','))
+            names = ', '.join(f"'c{idx}'" for idx in range(1, width + 1))
+            return f"read_csv('{path}', header=false, skip=1, all_varchar=true, names=[{names}])"
+
+        query = re.sub(r"@([\w.]+)/(\S+?)\s*\(\s*FILE_FORMAT\s*=>\s*'[^']*'\s*\)", read_stage, query)
+        query = re.sub(r'\$(\d+)', r'c\1', query)
+        query = re.sub(r'(?i)::number\b', '::double', query)
+        query = re.sub(r'(?i)current_timestamp\(\)', 'current_timestamp', query)
+        # information_schema is global in DuckDB
+        query = re.sub(r'(?i)\b\w+\.information_schema\.', 'information_schema.', query)
+        # Snowflake compares dates to strings with LIKE; DuckDB needs an explicit cast
+        query = re.sub(r"(?i)\b(\w+)\s+like\s+'", r"cast(\1 as varchar) like '", query)
+        return query
+
+    def _resolve_stage(self, stage, path=''):
+        if '%' in stage:
+            # Table stage, @db.schema.%table
+            parts = stage.lower().replace('%', '').split('.')
+            name = '.'.join(([self._database, self._schema] + parts)[-3:])
+            return os.path.join(local_root(), 'table_stages', name, path)
+        stages = self._registry('stages')
+        name = stage.split('.')[-1].lower()
+        if name not in stages:
+            raise ValueError(f'Stage does not exist: {stage}')
+        return os.path.join(_stage_path(stages[name]), path)
+
+    def _columns(self, table):
+        parts = table.lower().split('.')
+        catalog, schema, name = ([self._database, self._schema] + parts)[-3:]
+        return self._sql(f"""
+            select column_name, data_type from information_schema.columns
+            where table_catalog = '{catalog}' and table_schema = '{schema}' and table_name = '{name}'
+            order by ordinal_position
+        """)
+
+    @staticmethod
+    def _cast(column, data_type):
+        data_type = data_type.upper()
+        if data_type in ('INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT', 'HUGEINT'):
+            return f'try_cast(try_cast({column} as double) as {data_type})'
+        if data_type == 'DATE':
+            return f'try_cast(try_cast({column} as timestamp) as date)'
+        return f'try_cast({column} as {data_type})'
+
+    def _copy_into(self, query):
+        """ COPY INTO <table> FROM @stage/prefix/ with PATTERN or FILES, skipping files already loaded """
+        match = re.match(r'(?is)^copy\s+into\s+([\w.]+)\s+from\s+@([\w.%]+)/?(\S*)\s*(.*)$', query)
+        if not match:
+            raise ValueError(f'Unsupported COPY statement: {query}')
+        table, stage, prefix, options = match.groups()
+
+        root = self._resolve_stage(stage)
+        base = os.path.join(root, prefix)
+        file_format = re.search(r'(?i)file_format\s*=\s*(\w+)', options)
+        file_format = file_format.group(1).lower() if file_format else 'csv'
+        pattern = re.search(r"(?is)pattern\s*=\s*'([^']*)'", options)
+        files = re.search(r'(?is)files\s*=\s*\(([^)]*)\)', options)
+        force = re.search(r'(?i)force\s*=\s*true', options) is not None
+        purge = re.search(r'(?i)purge\s*=\s*true', options) is not None
+
+        if files:
+            candidates = [os.path.join(base, name.strip().strip("'")) for name in files.group(1).split(',') if name.strip()]
+        else:
+            candidates = sorted(
+                os.path.join(directory, name)
+                for directory, _, names in os.walk(base) for name in names
+            )
+            if pattern:
+                regex = re.compile(pattern.group(1))
+                candidates = [path for path in candidates if regex.fullmatch(os.path.relpath(path, root))]
+
+        # Emulate Snowflake load metadata: unchanged files are not loaded twice unless FORCE = TRUE
+        history = self._registry('load_history')
+        loaded = history.setdefault(table.lower(), {})
+        to_load = [
+            path for path in candidates
+            if os.path.exists(path) and (force or loaded.get(path) != os.path.getmtime(path))
+        ]
+        if not to_load:
+            return pd.DataFrame({'status': ['Copy executed with 0 files processed.']})
+
+        columns = self._columns(table)
+        file_list = '[' + ', '.join(f"'{path}'" for path in to_load) + ']'
+        if file_format == 'parquet':
+            source_columns = {
+                name.lower(): name for name in self._sql(f'describe select * from read_parquet({file_list})')['column_name']
+            }
+            targets = [
+                (name, data_type, source_columns[name.lower()]) for name, data_type in columns.itertuples(index=False)
+                if name.lower() in source_columns
+            ]
+            source = f'read_parquet({file_list}, union_by_name=true)'
+        else:
+            width = len(self._sql(f'describe select * from read_csv({file_list}, header=false, skip=1, all_varchar=true)'))
+            names = [f'c{idx}' for idx in range(1, width + 1)]
+            targets = [
+                (name, data_type, names[idx])
+                for idx, (name, data_type) in enumerate(columns.itertuples(index=False)) if idx < width
+            ]
+            quoted = ', '.join(f"'{name}'" for name in names)
+            source = f'read_csv({file_list}, header=false, skip=1, all_varchar=true, names=[{quoted}])'
+
+        insert_columns = ', '.join(f'"{name}"' for name, _, _ in targets)
+        select_columns = ', '.join(self._cast(f'"{column}"', data_type) for _, data_type, column in targets)
+        self._sql(f'insert into {table} ({insert_columns}) select {select_columns} from {source}')
+
+        for path in to_load:
+            loaded[path] = os.path.getmtime(path)
+            if purge:
+                os.remove(path)
+        self._save_registry('load_history', history)
+        return pd.DataFrame({'file': to_load, 'status': 'LOADED'})
+
+    def _put(self, query):
+        """ PUT 'file://<glob>' @stage/prefix/ [PARALLEL = n] [AUTO_COMPRESS = TRUE|FALSE], gzipping like the connector """
+        match = re.match(r"(?is)^put\s+'?file://([^'\s]+)'?\s+@([\w.%]+)/?(\S*)\s*(.*)$", query)
+        if not match:
+            raise ValueError(f'Unsupported PUT statement: {query}')
+        pattern, stage, prefix, options = match.groups()
+        parallel = re.search(r'(?i)parallel\s*=\s*(\d+)', options)
+        compress = re.search(r'(?i)auto_compress\s*=\s*false', options) is None
+
+        target = self._resolve_stage(stage, prefix)
+        os.makedirs(target, exist_ok=True)
+
+        def upload(source):
+            if compress and not source.endswith('.gz'):
+                destination = os.path.join(target, f'{os.path.basename(source)}.gz')
+                with open(source, 'rb') as src, gzip.open(destination, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                destination = os.path.join(target, os.path.basename(source))
+                shutil.copyfile(source, destination)
+            return destination
+
+        sources = sorted(glob.glob(pattern))
+        with ThreadPoolExecutor(max_workers=int(parallel.group(1)) if parallel else 4) as pool:
+            targets = list(pool.map(upload, sources))
+        return pd.DataFrame({'source': sources, 'target': targets, 'status': 'UPLOADED'})
@@ -5,13 +5,54 @@
 import pandas as pd
 import numpy as np
 import warnings
-from pydantic import BaseModel, ValidationError, ConfigDict
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, List
 from datetime import datetime as dt
 
 # Suppress FutureWarning messages
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# Team names as published by hockeyreference.com. Append-only: a team's code is its position in this list, so codes
+# never shift between seasons or when new rows are added. New franchises and renames go at the end.
+TEAMS = [
+    'Anaheim Ducks', 'Arizona Coyotes', 'Boston Bruins', 'Buffalo Sabres', 'Calgary Flames', 'Carolina Hurricanes',
+    'Chicago Blackhawks', 'Colorado Avalanche', 'Columbus Blue Jackets', 'Dallas Stars', 'Detroit Red Wings',
+    'Edmonton Oilers', 'Florida Panthers', 'Los Angeles Kings', 'Minnesota Wild', 'Montreal Canadiens',
+    'Nashville Predators', 'New Jersey Devils', 'New York Islanders', 'New York Rangers', 'Ottawa Senators',
+    'Philadelphia Flyers', 'Pittsburgh Penguins', 'San Jose Sharks', 'Seattle Kraken', 'St. Louis Blues',
+    'Tampa Bay Lightning', 'Toronto Maple Leafs', 'Vancouver Canucks', 'Vegas Golden Knights', 'Washington Capitals',
+    'Winnipeg Jets', 'Atlanta Thrashers', 'Phoenix Coyotes', 'Mighty Ducks of Anaheim', 'Utah Hockey Club',
+    'Utah Mammoth',
+]
+TEAM_DTYPE = pd.CategoricalDtype(categories=TEAMS)
+TEAM_COLUMNS = ('away_team', 'home_team')
+
+# Schedule page columns by their regular_season names
+SEASON_COLUMNS = {
+    'date': 'Date', 'away_team_id': 'Visitor', 'home_team_id': 'Home', 'away_goals': 'G', 'home_goals': 'G.1',
+    'length_of_game_min': 'LOG',
+}
+
+# Columns of a simulated matchup, as used by the model dataset
+MATCHUP_COLUMNS = [
+    'date', 'away_team', 'home_team', 'away_goals', 'home_goals', 'away_outcome', 'home_outcome', 'length_of_game_min'
+]
+
+
+def team_codes(teams) -> pd.Series:
+    """ Stable integer code per team name. Missing values get -1.
+        Raises ValueError for names missing from TEAMS: a shared -1 code would pool every unknown franchise into
+        one team in grouped features and encodings.
+    """
+    teams = pd.Series(teams)
+    if teams.dtype == TEAM_DTYPE:
+        return teams.cat.codes.astype('int16')
+    codes = teams.astype(str).astype(TEAM_DTYPE).cat.codes.astype('int16')
+    unknown = teams[(codes == -1).to_numpy() & teams.notna().to_numpy()].unique()
+    if len(unknown):
+        raise ValueError(f'Teams missing from preprocessing.TEAMS, append them to the list: {list(unknown)}')
+    return codes.set_axis(teams.index)
+
 
 class DataTransform(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -21,36 +62,39 @@ class DataTransform(BaseModel):
 
     @classmethod
     def seasons(cls, dataframe):
+        # Source columns are read under their page names instead of renaming, which would copy the whole frame
+        source = {name: dataframe[column] for name, column in SEASON_COLUMNS.items()}
 
-        dataframe = dataframe.rename(columns=({
-            'Date': 'date', 'Visitor': 'away_team_id', 'Home': 'home_team_id', 'G': 'away_goals', 'G.1': 'home_goals',
-            'LOG': 'length_of_game_min'
-        }))
-        dataframe = dataframe[
-            ['date', 'away_team_id', 'away_goals', 'home_team_id', 'home_goals', 'length_of_game_min']
-        ]
-
-        dataframe['updated_at'] = dt.now()
-
-        # Transforming data
-        dataframe['length_of_game_min'] = dataframe['length_of_game_min'].apply(
-            lambda x: (int(str(x).split(":")[0]) * 60) + (int(str(x).split(":")[1])) if str(x).lower() != 'nan' else x
-        )
-
-        dataframe.date = dataframe.date.apply(pd.to_datetime)
+        # Transforming data. Every column is converted in one vectorized pass into a compact dtype:
+        # nullable small integers for goals and minutes (unplayed games stay <NA>) and categorical team names.
+        log = source['length_of_game_min'].astype('string').str.extract(r'^(\d+):(\d{2})$')
+        minutes = pd.to_numeric(log[0]) * 60 + pd.to_numeric(log[1])
 
-        return dataframe
+        return pd.DataFrame({
+            'date': pd.to_datetime(source['date'], format='%Y-%m-%d'),
+            'away_team_id': source['away_team_id'].astype('category'),
+            'away_goals': pd.to_numeric(source['away_goals'], errors='coerce').astype('Int8'),
+            'home_team_id': source['home_team_id'].astype('category'),
+            'home_goals': pd.to_numeric(source['home_goals'], errors='coerce').astype('Int8'),
+            'length_of_game_min': minutes.astype('Int16'),
+            'updated_at': dt.now(),
+        })
 
     @classmethod
     def teams(cls, dataframe):
 
         print(f"Sample data for teams: {dataframe.head(1)}")
         
-        # Team name cleaning
+        # Team name cleaning. Division header rows are already skipped by src.extract, this only matters for
+        # pages parsed through the pd.read_html fallback.
         filter = ['Central Division', 'Atlantic Division', 'Pacific Division', 'Metropolitan Division']
-        dataframe.rename(columns=({'Unnamed: 0': 'Team'}), inplace=True)
-        dataframe = dataframe[~(dataframe['Team'].isin(filter))]
+        divisions = dataframe['Unnamed: 0'].isin(filter)
+        if divisions.any():
+            dataframe = dataframe[~divisions]
 
+        # A shallow copy shares the column data: renaming and adding updated_at leave the caller's frame untouched
+        dataframe = dataframe.copy(deep=False)
+        dataframe.columns = ['Team' if column == 'Unnamed: 0' else column for column in dataframe.columns]
         dataframe['updated_at'] = dt.now()
         
         return dataframe
@@ -65,34 +109,185 @@ class DataTransform(BaseModel):
         """ Add fake data to simulate a matchup and predict its outcome. Only necessary if testing the model out.
         This same function was used to simulate the Stanley Cup matchup in 2022.
         """
-        try:
-            fake_data = pd.DataFrame({
-                'date': date,
-                'away_team': away_teams,
-                'home_team': home_teams,
-                'away_goals': away_goals,
-                'home_goals': home_goals,
-                'away_outcome': away_result,
-                'home_outcome': home_result,
-                'length_of_game_min': game_length
-            })
-
-            result = pd.concat([dataframe, fake_data], ignore_index=True)
-            return result
-        except Exception as e:
-            if e == ValidationError:
-                print(f'Validation of data failed. Context: {e}')
+        return cls.append_matchups(dataframe, {
+            'date': date,
+            'away_team': away_teams,
+            'home_team': home_teams,
+            'away_goals': away_goals,
+            'home_goals': home_goals,
+            'away_outcome': away_result,
+            'home_outcome': home_result,
+            'length_of_game_min': game_length
+        })
+
+    @classmethod
+    def append_matchups(cls, dataframe, matchups):
+        """ Append any number of matchups as one columnar block.
+        Each column is built once at its final length instead of concatenating a frame per matchup, and team columns
+        keep the TEAMS categories so their codes do not depend on which rows are present.
+            :param: matchups -> DataFrame, dict of arrays or list of records with MATCHUP_COLUMNS
+        """
+        matchups = pd.DataFrame(matchups)
+        n_base, n_new = len(dataframe), len(matchups)
+        columns = list(dataframe.columns) + [column for column in matchups.columns if column not in dataframe.columns]
+
+        def part(frame, other, column, length):
+            if column in frame.columns:
+                return frame[column].reset_index(drop=True)
+            # Missing values of the other side's dtype, so datetime and nullable columns do not fall back to object
+            return other[column].iloc[:0].reindex(range(length))
+
+        block = {}
+        for column in columns:
+            base, new = part(dataframe, matchups, column, n_base), part(matchups, dataframe, column, n_new)
+            if column in TEAM_COLUMNS:
+                # team_codes raises on names missing from TEAMS instead of letting from_codes turn them into NaN
+                codes = np.empty(n_base + n_new, dtype='int16')
+                codes[:n_base] = team_codes(base).to_numpy()
+                codes[n_base:] = team_codes(new).to_numpy()
+                block[column] = pd.Categorical.from_codes(codes, dtype=TEAM_DTYPE)
+            else:
+                block[column] = pd.concat([base, new], ignore_index=True)
+        return pd.DataFrame(block)
+
+    @classmethod
+    def simulate_matchups(cls, dataframe, matchups, date_col: str = 'date'):
+        """ Append a batch of matchups to the dataset and encode everything in a single pass.
+        The simulated rows are the last len(matchups) rows of the result.
+        """
+        combined = cls.append_matchups(dataframe, matchups)
+        combined[date_col] = pd.to_datetime(combined[date_col])
+        return cls.encoding_full(combined, date_col)
 
     @classmethod
     def encoding_full(
         cls, dataframe, date_col: str
     ):
-        # Encode non-numeric variables
-        dataframe.home_team = dataframe.home_team.astype('category').cat.codes
-        dataframe.away_team = dataframe.away_team.astype('category').cat.codes
+        # Encode non-numeric variables. Codes come from TEAMS so they are the same in every season.
+        dataframe.home_team = team_codes(dataframe.home_team)
+        dataframe.away_team = team_codes(dataframe.away_team)
 
         # Encode date as a day of week to avoid time series implication.
         dataframe.rename(columns={f'{date_col}': 'day_of_week'}, inplace=True)
         dataframe['day_of_week'] = dataframe['day_of_week'].dt.dayofweek
 
         return dataframe
+
+
+class FeatureEngine:
+    """ Model features computed from the regular_season frame with grouped cumulative ops instead of dbt SQL.
+        Every feature only uses games played before the one it describes, so it can be used for prediction.
+    """
+
+    @staticmethod
+    def _season(dates: pd.Series) -> pd.Series:
+        # Seasons are named after the year they end in and start in the fall
+        return (dates.dt.year + (dates.dt.month >= 7)).astype('int16')
+
+    @staticmethod
+    def _long(games: pd.DataFrame) -> pd.DataFrame:
+        """ One row per team per game, ordered by date """
+        n = len(games)
+        long = pd.DataFrame({
+            'game': np.tile(np.arange(n), 2),
+            'date': np.tile(games['date'].to_numpy(), 2),
+            'season': np.tile(games['season'].to_numpy(), 2),
+            'team': np.concatenate([games['home_code'].to_numpy(), games['away_code'].to_numpy()]),
+            'opponent': np.concatenate([games['away_code'].to_numpy(), games['home_code'].to_numpy()]),
+            'is_home': np.repeat([True, False], n),
+            'goals_for': np.concatenate([games['home_goals'].to_numpy(), games['away_goals'].to_numpy()]),
+            'goals_against': np.concatenate([games['away_goals'].to_numpy(), games['home_goals'].to_numpy()]),
+        })
+        long['played'] = long['goals_for'].notna() & long['goals_against'].notna()
+        long['win'] = (long['goals_for'] > long['goals_against']).astype('int8')
+        return long.sort_values(['date', 'game'], kind='stable', ignore_index=True)
+
+    @staticmethod
+    def _prior(long: pd.DataFrame, keys, columns, window: int = None):
+        """
+        Mean of `columns` over the previous `window` played games of each group (all of them when None), and the
+        number of games it covers. Unplayed games are skipped, so a future game still sees the latest results.
+        Computed from prefix sums over the played rows of each group, without a Python loop.
+        """
+        group = long.groupby(keys, sort=False).ngroup().to_numpy()
+        # Rows are already in time order, a stable sort keeps that order inside each group
+        order = np.argsort(group, kind='stable')
+        group, played = group[order], long['played'].to_numpy()[order]
+
+        # Played games before each row, counted globally and from the start of its group
+        before = np.cumsum(played) - played
+        first = np.r_[True, group[1:] != group[:-1]]
+        base = np.maximum.accumulate(np.where(first, before, 0))
+        lo = base if window is None else np.maximum(before - window, base)
+        counts = before - lo
+
+        means = {}
+        for column in columns:
+            values = long[column].to_numpy(dtype='float64')[order][played]
+            prefix = np.r_[0.0, np.cumsum(values)]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means[column] = (prefix[before] - prefix[lo]) / counts
+
+        # Back to the input row order
+        restore = np.empty_like(order)
+        restore[order] = np.arange(len(order))
+        means = pd.DataFrame({column: values[restore] for column, values in means.items()}, index=long.index)
+        return means, counts[restore]
+
+    @classmethod
+    def build(cls, dataframe: pd.DataFrame, window: int = 10, split_window: int = 5) -> pd.DataFrame:
+        """
+        Features per game, aligned with the input index.
+            :param: window -> games in the rolling goals for/against averages. Reset every season. Default: 10
+            :param: split_window -> games in the home/away split averages. Default: 5
+        """
+        frame = dataframe.rename(columns=str.lower)
+        dates = pd.to_datetime(frame['date'])
+        games = pd.DataFrame({
+            'date': dates,
+            'season': cls._season(dates),
+            'home_code': team_codes(frame['home_team_id']).to_numpy(),
+            'away_code': team_codes(frame['away_team_id']).to_numpy(),
+            'home_goals': pd.to_numeric(frame['home_goals'], errors='coerce').astype('float64').to_numpy(),
+            'away_goals': pd.to_numeric(frame['away_goals'], errors='coerce').astype('float64').to_numpy(),
+        })
+        long = cls._long(games)
+
+        form, _ = cls._prior(long, ['team', 'season'], ['goals_for', 'goals_against'], window)
+        split, _ = cls._prior(long, ['team', 'season', 'is_home'], ['goals_for', 'goals_against'], split_window)
+        h2h, h2h_games = cls._prior(long, ['team', 'opponent'], ['win', 'goals_for', 'goals_against'])
+
+        rest = long['date'].groupby([long['team'], long['season']], sort=False).diff().dt.days
+
+        long = long.assign(
+            gf_avg=form['goals_for'], ga_avg=form['goals_against'],
+            split_gf=split['goals_for'], split_ga=split['goals_against'],
+            h2h_games=h2h_games, h2h_win_pct=h2h['win'], h2h_goal_diff=h2h['goals_for'] - h2h['goals_against'],
+            rest_days=rest, back_to_back=rest.eq(1),
+        )
+
+        # Back to one row per game: home perspective first, then away
+        home = long[long['is_home']].set_index('game').sort_index()
+        away = long[~long['is_home']].set_index('game').sort_index()
+
+        features = pd.DataFrame({
+            'season': games['season'].to_numpy(),
+            'home_code': games['home_code'].to_numpy(),
+            'away_code': games['away_code'].to_numpy(),
+            'home_gf_avg': home['gf_avg'].to_numpy(),
+            'home_ga_avg': home['ga_avg'].to_numpy(),
+            'away_gf_avg': away['gf_avg'].to_numpy(),
+            'away_ga_avg': away['ga_avg'].to_numpy(),
+            'home_split_gf_avg': home['split_gf'].to_numpy(),
+            'home_split_ga_avg': home['split_ga'].to_numpy(),
+            'away_split_gf_avg': away['split_gf'].to_numpy(),
+            'away_split_ga_avg': away['split_ga'].to_numpy(),
+            'home_rest_days': home['rest_days'].astype('Int16').array,
+            'away_rest_days': away['rest_days'].astype('Int16').array,
+            'home_back_to_back': home['back_to_back'].to_numpy(),
+            'away_back_to_back': away['back_to_back'].to_numpy(),
+            'h2h_games': home['h2h_games'].astype('int32').to_numpy(),
+            'h2h_home_win_pct': home['h2h_win_pct'].to_numpy(),
+            'h2h_home_goal_diff': home['h2h_goal_diff'].to_numpy(),
+        }, index=dataframe.index)
+        return features
@@ -0,0 +1,204 @@
+# Per-stage profiling for the pipelines. Stages record wall time, bytes, rows and the process peak RSS, plus optional
+# named phases (e.g. queue / execution / fetch for a Snowflake query). Records are exported at the end of a flow run as
+# a Prefect table artifact, a JSON file and a Prometheus text file.
+
+import datetime as dt
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from prefect.artifacts import create_table_artifact
+from prefect.context import FlowRunContext
+
+from src.connectors import env_setting
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Overridden by NHL_PROFILE_DIR
+DEFAULT_PROFILE_DIR = './data/profiles'
+METRIC_PREFIX = 'nhl_stage'
+
+
+def peak_rss_bytes():
+    """ High-water mark of the process resident set size, or None where it is not available """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stage:
+    """ Measurements for one run of a stage. Created by Profiler.start or Profiler.stage. """
+
+    def __init__(self, name: str, labels: dict = None):
+        self.name = name
+        self.labels = dict(labels or {})
+        self.rows = None
+        self.bytes = None
+        self.phases = {}
+        self.started_at = dt.datetime.now(dt.timezone.utc)
+        self.wall_seconds = None
+        self.peak_rss_bytes = None
+        self._start = self._mark = time.perf_counter()
+
+    def phase(self, name: str):
+        """ Close a phase: record the time since the stage started or since the previous phase ended """
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._mark
+        self._mark = now
+
+    def finish(self):
+        if self.wall_seconds is None:
+            self.wall_seconds = time.perf_counter() - self._start
+            self.peak_rss_bytes = peak_rss_bytes()
+        return self
+
+    def as_dict(self) -> dict:
+        return {
+            'stage': self.name,
+            'labels': self.labels,
+            'started_at': self.started_at.isoformat(),
+            'wall_seconds': self.wall_seconds,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'phases': self.phases,
+        }
+
+
+class Profiler:
+    """ Thread-safe collector of finished stages for the current process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = []
+
+    def start(self, name: str, **labels) -> Stage:
+        return Stage(name, labels)
+
+    def finish(self, stage: Stage) -> Stage:
+        stage.finish()
+        with self._lock:
+            self._stages.append(stage)
+        return stage
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        """ Time the body of a with block. The yielded Stage can be given rows, bytes, phases and extra labels. """
+        record = self.start(name, **labels)
+        try:
+            yield record
+        except BaseException:
+            record.labels['status'] = 'failed'
+            raise
+        finally:
+            self.finish(record)
+
+    def records(self) -> list:
+        with self._lock:
+            return [stage.as_dict() for stage in self._stages]
+
+    def drain(self) -> list:
+        """ Return every record and start over, so one process can run several flows """
+        with self._lock:
+            stages, self._stages = self._stages, []
+        return [stage.as_dict() for stage in stages]
+
+
+def _labels(record, **extra) -> str:
+    labels = {'stage': record['stage'], **record['labels'], **extra}
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def prometheus_text(records: list, run: str = None) -> str:
+    """ Records in the Prometheus text exposition format, one gauge per measurement """
+    extra = {'run': run} if run else {}
+    metrics = [
+        ('seconds', 'Wall time of a pipeline stage', 'wall_seconds'),
+        ('rows', 'Rows handled by a pipeline stage', 'rows'),
+        ('bytes', 'Bytes handled by a pipeline stage', 'bytes'),
+        ('peak_rss_bytes', 'Process peak resident set size when a pipeline stage finished', 'peak_rss_bytes'),
+    ]
+
+    lines = []
+    for suffix, description, field in metrics:
+        samples = [record for record in records if record[field] is not None]
+        if not samples:
+            continue
+        lines += [f'# HELP {METRIC_PREFIX}_{suffix} {description}', f'# TYPE {METRIC_PREFIX}_{suffix} gauge']
+        lines += [f'{METRIC_PREFIX}_{suffix}{_labels(record, **extra)} {record[field]}' for record in samples]
+
+    phased = [record for record in records if record['phases']]
+    if phased:
+        lines += [
+            f'# HELP {METRIC_PREFIX}_phase_seconds Wall time of a phase within a pipeline stage',
+            f'# TYPE {METRIC_PREFIX}_phase_seconds gauge',
+        ]
+        lines += [
+            f'{METRIC_PREFIX}_phase_seconds{_labels(record, phase=phase, **extra)} {seconds}'
+            for record in phased for phase, seconds in record['phases'].items()
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def export_profile(run: str, directory: str = None, artifact: bool = True) -> dict:
+    """
+    Write the stages recorded so far to {directory}/{run}_{timestamp}.json and .prom and, inside a flow run,
+    publish them as a Prefect table artifact. Returns the paths written.
+    """
+    records = get_profiler().drain()
+    if not records:
+        return {}
+
+    directory = env_setting('NHL_PROFILE_DIR', DEFAULT_PROFILE_DIR) if directory is None else directory
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f'{run}_{dt.datetime.now():%Y%m%d%H%M%S}')
+    with open(f'{base}.json', 'w') as f:
+        json.dump({'run': run, 'stages': records}, f, indent=2, default=str)
+    with open(f'{base}.prom', 'w') as f:
+        f.write(prometheus_text(records, run))
+
+    if artifact:
+        _publish_artifact(run, records)
+
+    return {'json': f'{base}.json', 'prometheus': f'{base}.prom'}
+
+
+def _publish_artifact(run: str, records: list):
+    if FlowRunContext.get() is None:
+        return
+
+    table = [
+        {
+            'stage': record['stage'],
+            'labels': ', '.join(f'{key}={value}' for key, value in record['labels'].items()),
+            'wall_seconds': round(record['wall_seconds'], 4),
+            'rows': record['rows'],
+            'bytes': record['bytes'],
+            'peak_rss_mb': round(record['peak_rss_bytes'] / 1e6, 1) if record['peak_rss_bytes'] else None,
+            'phases': ', '.join(f'{name}={seconds:.4f}s' for name, seconds in record['phases'].items()),
+        }
+        for record in records
+    ]
+    create_table_artifact(
+        key=f'{run.replace("_", "-").lower()}-profile', table=table,
+        description=f'Stage timings and resource usage for {run}'
+    )
+
+
+_profiler = Profiler()
+
+
+def get_profiler() -> Profiler:
+    """ Process-wide profiler shared by every task """
+    return _profiler
@@ -0,0 +1,191 @@
+# Cached Snowflake table definitions. Column names and types for a schema are read from information_schema once,
+# kept in memory and in a small JSON snapshot under ./data, and reused until they expire or the DDL in
+# src.snowflake_queries.snowflake_schema changes. DataFrames are then validated against them without a query.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+from src.connectors import env_setting
+from src.helpers import snowflake_query_exec
+from src.snowflake_queries import snowflake_schema, snowflake_table_definitions
+
+# Overridden by NHL_SCHEMA_CACHE_TTL and NHL_SCHEMA_CACHE_PATH
+DEFAULT_TTL = 6 * 60 * 60
+DEFAULT_PATH = './data/schema_registry.json'
+
+# Snowflake and DuckDB type names grouped by the pandas dtypes that load into them
+TEXT_TYPES = {'VARCHAR', 'TEXT', 'STRING', 'CHAR', 'CHARACTER', 'NCHAR', 'NVARCHAR'}
+NUMERIC_TYPES = {'NUMBER', 'DECIMAL', 'NUMERIC', 'FLOAT', 'FLOAT4', 'FLOAT8', 'DOUBLE', 'DOUBLE PRECISION', 'REAL'}
+
+
+def ddl_fingerprint(db, schema) -> str:
+    """ Hash of the table DDL. Cached definitions are dropped as soon as it changes. """
+    ddl = '\n'.join(' '.join(query.split()) for query in snowflake_schema(db, schema).values())
+    return hashlib.sha256(ddl.encode()).hexdigest()[:16]
+
+
+def type_family(data_type: str):
+    """ text, numeric, temporal or boolean. None for types that accept anything (VARIANT, ...). """
+    base = data_type.upper().split('(')[0].strip()
+    if base in TEXT_TYPES:
+        return 'text'
+    if base in NUMERIC_TYPES or base.endswith('INT') or base.endswith('INTEGER'):
+        return 'numeric'
+    if base.startswith(('DATE', 'TIMESTAMP', 'TIME')):
+        return 'temporal'
+    if base == 'BOOLEAN':
+        return 'boolean'
+    return None
+
+
+def _compatible(series: pd.Series, family) -> bool:
+    if family in (None, 'text'):
+        return True
+
+    values = series.dropna()
+    if family == 'numeric':
+        if pd.api.types.is_numeric_dtype(series):
+            return True
+        return not pd.to_numeric(values, errors='coerce').isna().any()
+    if family == 'temporal':
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return True
+        if pd.api.types.is_numeric_dtype(series):
+            return False
+        return not pd.to_datetime(values, errors='coerce').isna().any()
+    return pd.api.types.is_bool_dtype(series) or values.isin([True, False, 0, 1]).all()
+
+
+def validate_frame(dataframe: pd.DataFrame, columns, positional: bool = True) -> list:
+    """
+    Compare a DataFrame with a table definition, entirely in memory.
+        :param: columns -> [(column_name, data_type), ...] in ordinal order, as returned by SchemaRegistry.columns
+        :param: positional -> also require the table's column order, as CSV loads are positional. Default: True
+    Returns a list of problems, empty when the frame can be loaded.
+    """
+    if not columns:
+        return ['destination table not found']
+
+    source = {str(name).lower(): name for name in dataframe.columns}
+    dest = [name.lower() for name, _ in columns]
+
+    problems = []
+    missing = [name for name in dest if name not in source]
+    extra = [source[name] for name in source if name not in dest]
+    if missing:
+        problems.append(f'missing columns: {missing}')
+    if extra:
+        problems.append(f'unexpected columns: {extra}')
+    if positional and not missing and not extra and list(source) != dest:
+        problems.append(f'column order {list(dataframe.columns)} does not match destination order {dest}')
+
+    for name, data_type in columns:
+        column = source.get(name.lower())
+        if column is not None and not _compatible(dataframe[column], type_family(data_type)):
+            problems.append(f'column {column} ({dataframe[column].dtype}) cannot be loaded into {data_type}')
+
+    return problems
+
+
+def _as_tuples(tables):
+    return {table: [tuple(column) for column in columns] for table, columns in tables.items()}
+
+
+class SchemaRegistry:
+    """ Table definitions keyed by db/schema/table. Safe to share between threads in one process. """
+
+    def __init__(self, ttl: int = None, path: str = None):
+        self.ttl = int(env_setting('NHL_SCHEMA_CACHE_TTL', DEFAULT_TTL)) if ttl is None else ttl
+        self.path = env_setting('NHL_SCHEMA_CACHE_PATH', DEFAULT_PATH) if path is None else path
+        self._lock = threading.Lock()
+        self._entries = self._read()
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def _fresh(self, entry, db, schema) -> bool:
+        return (
+            entry is not None
+            and entry['fingerprint'] == ddl_fingerprint(db, schema)
+            and time.time() - entry['loaded_at'] < self.ttl
+        )
+
+    def tables(self, db, schema, snowflake_conn) -> dict:
+        """ {table: [(column_name, data_type), ...]} for a schema, loaded from Snowflake only when stale """
+        key = f'{db}.{schema}'.lower()
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry, db, schema):
+                return _as_tuples(entry['tables'])
+
+        tables = self._load(db, schema, snowflake_conn)
+
+        # An empty schema has not been created yet and is looked up again on the next call
+        if tables:
+            with self._lock:
+                self._entries[key] = {
+                    'fingerprint': ddl_fingerprint(db, schema), 'loaded_at': time.time(), 'tables': tables
+                }
+                self._write()
+        return _as_tuples(tables)
+
+    def columns(self, db, schema, table, snowflake_conn) -> list:
+        return self.tables(db, schema, snowflake_conn).get(table.lower(), [])
+
+    def validate(self, dataframe, db, schema, table, snowflake_conn, positional: bool = True) -> list:
+        return validate_frame(dataframe, self.columns(db, schema, table, snowflake_conn), positional)
+
+    def invalidate(self, db=None, schema=None):
+        """ Drop cached definitions for one schema, or for every schema when called without arguments """
+        with self._lock:
+            if db is None:
+                self._entries = {}
+            else:
+                self._entries.pop(f'{db}.{schema}'.lower(), None)
+            self._write()
+
+    @staticmethod
+    def _load(db, schema, snowflake_conn) -> dict:
+        result = (snowflake_query_exec(snowflake_table_definitions(db, schema), method=snowflake_conn) or {})
+        definitions = result.get('definitions')
+        if not isinstance(definitions, pd.DataFrame):
+            return {}
+
+        definitions = definitions.rename(columns=str.lower).sort_values(['table_name', 'ordinal_position'])
+        return {
+            str(table).lower(): [[name, data_type] for name, data_type in zip(rows['column_name'], rows['data_type'])]
+            for table, rows in definitions.groupby('table_name', sort=False)
+        }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_schema_registry() -> SchemaRegistry:
+    """ Process-wide registry shared by every task """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SchemaRegistry()
+        return _registry
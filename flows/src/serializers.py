@@ -0,0 +1,119 @@
+# Task options for DataFrames handed between Prefect tasks.
+#
+# Prefect's default cache policy hashes every task input to build a cache key, which pickles each DataFrame passed in:
+# a full extra copy of the data on every hand-off, for tasks that are never served from the cache. Frame tasks never
+# hash their inputs and keep their results in memory, so the frame returned by file_parser is the same object s3_parser
+# uploads. When results are persisted (PREFECT_RESULTS_PERSIST_BY_DEFAULT, e.g. for retries on remote workers), frames
+# are written as Arrow IPC streams instead of pickles and read back without per-value deserialization.
+#
+#   @task(name="file_parser", **FRAME_TASK)
+
+import base64
+import io
+import pickle
+import struct
+from typing import Literal
+
+import cloudpickle
+import pandas as pd
+
+from prefect.cache_policies import NO_CACHE, CachePolicy
+from prefect.serializers import Serializer
+from prefect.settings import get_current_settings
+
+MAGIC = b'NHLARROW1'
+_LENGTH = struct.Struct('<Q')
+
+
+class _FramePickler(cloudpickle.Pickler):
+    """ Pickles everything but DataFrames, which are collected into `frames` and referenced by position """
+
+    def __init__(self, file, frames):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.frames = frames
+
+    def persistent_id(self, obj):
+        if isinstance(obj, pd.DataFrame):
+            self.frames.append(obj)
+            return len(self.frames) - 1
+        return None
+
+
+class _FrameUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, frames):
+        super().__init__(file)
+        self.frames = frames
+
+    def persistent_load(self, pid):
+        return self.frames[pid]
+
+
+class ArrowSerializer(Serializer):
+    """
+    Result serializer for task results that are or contain DataFrames (e.g. dicts of frames per season).
+    Layout, base64 encoded: MAGIC, then length-prefixed blocks: the pickled result with DataFrames replaced by
+    references, followed by one Arrow IPC stream per frame. Loading reads the streams in place and converts them
+    column by column.
+    """
+
+    type: Literal['arrow'] = 'arrow'
+
+    def dumps(self, obj) -> bytes:
+        import pyarrow as pa
+
+        frames, body = [], io.BytesIO()
+        _FramePickler(body, frames).dump(obj)
+
+        out = io.BytesIO()
+        out.write(MAGIC)
+        for block in [body.getbuffer()] + [self._stream(pa, frame) for frame in frames]:
+            out.write(_LENGTH.pack(len(block)))
+            out.write(block)
+        # Result records are stored as JSON, which needs text
+        return base64.b64encode(out.getbuffer())
+
+    def loads(self, blob: bytes):
+        import pyarrow as pa
+
+        view = memoryview(base64.b64decode(blob))
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError('Not an Arrow task result')
+
+        blocks, offset = [], len(MAGIC)
+        while offset < len(view):
+            (length,) = _LENGTH.unpack_from(view, offset)
+            offset += _LENGTH.size
+            blocks.append(view[offset:offset + length])
+            offset += length
+
+        frames = [
+            pa.ipc.open_stream(pa.py_buffer(block)).read_all().to_pandas(split_blocks=True, self_destruct=True)
+            for block in blocks[1:]
+        ]
+        return _FrameUnpickler(io.BytesIO(blocks[0]), frames).load()
+
+    @staticmethod
+    def _stream(pa, frame: pd.DataFrame):
+        table = pa.Table.from_pandas(frame)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return memoryview(sink.getvalue())
+
+
+class TaskRunId(CachePolicy):
+    """ Keys a result by its own task run: it can be persisted, but is never reused by another run """
+
+    def compute_key(self, task_ctx, inputs, flow_parameters, **kwargs):
+        return str(task_ctx.task_run.id) if task_ctx else None
+
+
+# Options of every task that takes or returns DataFrames. Setting a result serializer would switch persistence on,
+# so it follows the global setting explicitly. Prefect only writes results that have a cache key.
+_PERSIST = get_current_settings().results.persist_by_default
+FRAME_TASK = {
+    'cache_policy': TaskRunId() if _PERSIST else NO_CACHE,
+    'result_serializer': ArrowSerializer(),
+    'persist_result': _PERSIST,
+}
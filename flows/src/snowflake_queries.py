@@ -1,3 +1,6 @@
+import hashlib
+
+
 # QUERY EXECUTIONS
 def snowflake_stages(db: str, schema: str, s3_bucket_name: str):
     queries = {
@@ -39,15 +42,37 @@ def snowflake_stages(db: str, schema: str, s3_bucket_name: str):
     return queries
 
 
-def snowflake_checks(db: str, table: str):
+# Ordering constraints for concurrent execution, e.g. snowflake_query_exec(queries, concurrent=True, depends_on=...)
+# Statements without an entry here have no dependencies and run in parallel.
+STAGE_DEPENDENCIES = {
+    "use_db": ["create_db"],
+    "create_schema": ["use_db"],
+    "use_schema": ["create_schema"],
+    "create_parquet": ["use_schema"],
+    "create_csv": ["use_schema"],
+    "csv": ["create_csv"],
+    "parquet": ["create_parquet"],
+}
+
+
+def snowflake_table_definitions(db: str, schema: str):
+    """ Column names and types of every table in a schema. Cached by src.schema_registry. """
     return {
-        "columns": f"""
-            SELECT DISTINCT column_name FROM {db}.information_schema.columns
-            WHERE lower(table_name) like '%{table}%'
+        "definitions": f"""
+            SELECT table_name, column_name, data_type, ordinal_position FROM {db}.information_schema.columns
+            WHERE lower(table_catalog) = lower('{db}') AND lower(table_schema) = lower('{schema}')
+            ORDER BY table_name, ordinal_position
         """
     }
 
 
+# Append-only history of team stats rows. Each change closes the current row and opens a new one.
+TEAM_HISTORY_TABLE = 'team_stats_history'
+TEAM_STAT_COLUMNS = [
+    'Team', 'GP', 'W', 'L', 'OL', 'PTS', '"PTS%"', 'GF', 'GA', 'SRS', 'SOS', '"RPt%"', 'RW', 'RgRec', '"RgPt%"'
+]
+
+
 def snowflake_schema(db, schema):
     queries = {
         "create_db": f"create database if not exists {db};",
@@ -85,6 +110,36 @@ def snowflake_schema(db, schema):
                 updated_at date
             )
         """,
+        "team_stats_history": f"""
+            create table if not exists {db}.{schema}.{TEAM_HISTORY_TABLE} (
+                Team VARCHAR,
+                GP VARCHAR,
+                W VARCHAR,
+                L VARCHAR,
+                OL VARCHAR,
+                PTS VARCHAR,
+                "PTS%" VARCHAR,
+                GF VARCHAR,
+                GA VARCHAR,
+                SRS VARCHAR,
+                SOS VARCHAR,
+                "RPt%" VARCHAR,
+                RW VARCHAR,
+                RgRec VARCHAR,
+                "RgPt%" VARCHAR,
+                season integer,
+                row_hash varchar(20),
+                valid_from timestamp,
+                valid_to timestamp,
+                is_current boolean
+            );
+        """,
+        "team_stats_current": f"""
+            create view if not exists {db}.{schema}.team_stats_current as
+            select {', '.join(TEAM_STAT_COLUMNS)}, season, valid_from as updated_at
+            from {db}.{schema}.{TEAM_HISTORY_TABLE}
+            where is_current
+        """,
         "playoff_season": f"""
             create table if not exists {db}.{schema}.playoff_season (
                 date date,
@@ -100,29 +155,81 @@ def snowflake_schema(db, schema):
     return queries
 
 
-def snowflake_cleanup(db, schema, table, load_year):
+SCHEMA_DEPENDENCIES = {
+    "use_db": ["create_db"],
+    "create_schema": ["use_db"],
+    "use_schema": ["create_schema"],
+    "team_stats": ["create_schema"],
+    "regular_season": ["create_schema"],
+    "playoff_season": ["create_schema"],
+    "team_stats_history": ["create_schema"],
+    "team_stats_current": ["team_stats_history"],
+}
+
+
+def snowflake_season_cleanup(db, schema, table, season):
+    """ Delete the games of a season by game date instead of load date, so reloading a season never touches rows
+        loaded for another season on the same day. Seasons span July to June, as in snowflake_watermark.
+        Team stats rows carry no game date and are left alone.
+    """
 
     if table == 'team_stats':
-        print('Team stats do not need deletion from a season date as they are refreshed records. Not deleting records by season date. Passing')
+        print('Team stats have no season date to delete by. Not deleting records by season. Passing')
         return {}
-    else:
-        print(
-            f"""
-            Cleaning up data with query: \n
+
+    queries = {
+        "dedupe_season": f"""
             DELETE FROM {db}.{schema}.{table}
-            WHERE date like '{load_year}%'
-            """
-        )
-        queries = {
-            "dedupe": f"""
-                DELETE FROM {db}.{schema}.{table}
-                WHERE updated_at like '{load_year}%'
-            """
-        }
-        return queries 
+            WHERE date between '{int(season) - 1}-07-01' and '{season}-06-30'
+        """
+    }
+    print(f"Cleaning up data with query: \n{queries['dedupe_season']}")
+
+    return queries
+
+
+# COPY INTO accepts at most 1,000 names in FILES
+COPY_FILES_PER_BATCH = 1000
+
+
+def snowflake_files_ingestion(db, schema, table, location, files, copy_options, force: bool = False):
+    """
+    COPY INTO from an explicit list of files under @location, one statement per batch of COPY_FILES_PER_BATCH.
+    Snowflake reads only the named files instead of listing the prefix, so load time does not grow with the bucket.
+    With `force`, the files are loaded even if load metadata shows they were loaded before. Only pass it after the
+    rows of those files were deleted, e.g. with snowflake_season_cleanup, or they are loaded twice.
+    """
+    if not files:
+        # No statements would turn a reload into a plain delete of the season
+        raise ValueError(f'No files to load into {table} from @{location}')
+    files = sorted(files)
+    queries = {}
+    for idx in range(0, len(files), COPY_FILES_PER_BATCH):
+        names = ', '.join(f"'{name}'" for name in files[idx:idx + COPY_FILES_PER_BATCH])
+        queries[f"ingest_files_{idx // COPY_FILES_PER_BATCH}"] = f"""
+            COPY INTO {db}.{schema}.{table}
+            FROM @{location}
+            FILES = ({names})
+            {copy_options}
+            FORCE = {'TRUE' if force else 'FALSE'};
+        """
+    print(f"Queries prepared for ingestion of {len(files)} files in {len(queries)} batches from @{location}")
+
+    return queries
+
 
+def snowflake_ingestion(db, schema, table, source, file_format: str = 'csv', files: list = None, force: bool = False):
+    """ COPY INTO from the external stage. With `files`, only those names under {source}/ are loaded, see
+        snowflake_files_ingestion. Otherwise every file under the prefix is matched with PATTERN.
+    """
 
-def snowflake_ingestion(db, schema, table, source):
+    if file_format == 'parquet':
+        return snowflake_ingestion_parquet(db, schema, table, source, files, force)
+
+    if files is not None:
+        return snowflake_files_ingestion(
+            db, schema, table, f'nhl_raw_data_csv/{source}/', files, 'FILE_FORMAT = csv', force
+        )
 
     queries = {
         "ingest_from_stage": f"""
@@ -135,3 +242,222 @@ def snowflake_ingestion(db, schema, table, source):
     print(f"Query prepared for ingestion from external stage: \n\t{queries['ingest_from_stage']}")
 
     return queries
+
+
+def snowflake_ingestion_parquet(db, schema, table, source, files: list = None, force: bool = False):
+    """ Typed load from the parquet stage. Columns are matched by name, so no positional casts are needed. """
+
+    if files is not None:
+        return snowflake_files_ingestion(
+            db, schema, table, f'nhl_raw_data_parquet/{source}/', files,
+            'FILE_FORMAT = parquet\n            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE', force
+        )
+
+    queries = {
+        "ingest_from_stage": f"""
+            COPY INTO {db}.{schema}.{table}
+            FROM @nhl_raw_data_parquet/{source}/
+            FILE_FORMAT = parquet
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+            PATTERN = '.*[.]parquet';
+        """
+    }
+    print(f"Query prepared for ingestion from external stage: \n\t{queries['ingest_from_stage']}")
+
+    return queries
+
+
+# Rows per file of a direct table stage load. Kept here, free of pandas and Prefect, for the entry point parsers.
+DEFAULT_CHUNK_ROWS = 100_000
+
+
+def snowflake_stage_ingestion(db, schema, table, local_dir, prefix, file_format: str = 'csv', parallel: int = 4):
+    """
+    Direct load through the table stage, without S3 or a storage integration. Every file in `local_dir` is PUT under
+    `prefix` with `parallel` upload threads, copied into the table and purged from the stage.
+    CSV files are gzipped by the connector on the way up; parquet is already compressed.
+    """
+
+    stage = f'@{db}.{schema}.%{table}/{prefix}/'
+    if file_format == 'parquet':
+        compress = 'AUTO_COMPRESS = FALSE'
+        copy_options = """FILE_FORMAT = parquet
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE"""
+    else:
+        compress = 'AUTO_COMPRESS = TRUE'
+        copy_options = "FILE_FORMAT = csv"
+
+    queries = {
+        "put_files": f"""
+            PUT 'file://{local_dir}/*.{file_format}' {stage}
+            PARALLEL = {parallel}
+            {compress}
+            OVERWRITE = TRUE;
+        """,
+        "ingest_from_table_stage": f"""
+            COPY INTO {db}.{schema}.{table}
+            FROM {stage}
+            {copy_options}
+            PURGE = TRUE;
+        """
+    }
+    print(f"Query prepared for ingestion from the table stage: \n\t{queries['ingest_from_table_stage']}")
+
+    return queries
+
+
+def snowflake_backfill_ingestion(
+        db, schema, table, source, filenames, file_format: str = 'csv', force: bool = False
+):
+    """ COPY INTO naming every file produced by a backfill run, in batches, instead of one COPY per year.
+        With `force`, for seasons just cleared by snowflake_season_cleanup, files are reloaded even if Snowflake
+        loaded them before.
+    """
+    files = [f'{name}.{file_format}' for name in filenames]
+    return snowflake_ingestion(db, schema, table, source, file_format, files=files, force=force)
+
+
+def snowflake_watermark(db, schema, table, load_year):
+    """ Games already loaded for a season, used to diff an incremental load. Seasons span July to June. """
+    return {
+        "watermark": f"""
+            SELECT date, away_team_id, away_goals, home_team_id, home_goals, length_of_game_min
+            FROM {db}.{schema}.{table}
+            WHERE date between '{int(load_year) - 1}-07-01' and '{load_year}-06-30'
+        """
+    }
+
+
+def snowflake_merge(db, schema, table, source, filename):
+    """ Upsert only the changed games staged in a single file, keyed on (date, away_team_id, home_team_id) """
+
+    queries = {
+        "merge_from_stage": f"""
+            MERGE INTO {db}.{schema}.{table} tgt
+            USING (
+                SELECT
+                    $1::date as date,
+                    $2::varchar as away_team_id,
+                    $3::number as away_goals,
+                    $4::varchar as home_team_id,
+                    $5::number as home_goals,
+                    $6::varchar as length_of_game_min,
+                    $7::timestamp::date as updated_at
+                FROM @{db}.{schema}.nhl_raw_data_csv/{source}/{filename}.csv
+                (FILE_FORMAT => '{db}.{schema}.csv')
+            ) src
+            ON tgt.date = src.date
+                AND tgt.away_team_id = src.away_team_id
+                AND tgt.home_team_id = src.home_team_id
+            WHEN MATCHED THEN UPDATE SET
+                away_goals = src.away_goals,
+                home_goals = src.home_goals,
+                length_of_game_min = src.length_of_game_min,
+                updated_at = src.updated_at
+            WHEN NOT MATCHED THEN INSERT (
+                date, away_team_id, away_goals, home_team_id, home_goals, length_of_game_min, updated_at
+            ) VALUES (
+                src.date, src.away_team_id, src.away_goals, src.home_team_id, src.home_goals,
+                src.length_of_game_min, src.updated_at
+            );
+        """
+    }
+    print(f"Query prepared for incremental merge from external stage: \n\t{queries['merge_from_stage']}")
+
+    return queries
+
+
+def snowflake_team_watermark(db, schema, season):
+    """ Hashes of the current team rows for a season """
+    return {
+        "watermark": f"""
+            SELECT Team, row_hash FROM {db}.{schema}.{TEAM_HISTORY_TABLE}
+            WHERE season = {season} AND is_current
+        """
+    }
+
+
+def snowflake_team_history_merge(db, schema, source, filename):
+    """ SCD load of the changed team rows staged in a single file. Columns are the team_stats columns followed by
+        season and row_hash. Rows whose hash is already current are ignored, so a file can be loaded twice safely.
+    """
+    staged = ',\n                    '.join(
+        [f'${idx}::varchar as c{idx}' for idx in range(1, len(TEAM_STAT_COLUMNS) + 1)] + [
+            f'${len(TEAM_STAT_COLUMNS) + 1}::timestamp as updated_at',
+            f'${len(TEAM_STAT_COLUMNS) + 2}::number as season',
+            f'${len(TEAM_STAT_COLUMNS) + 3}::varchar as row_hash',
+        ]
+    )
+    source_rows = f"""
+                SELECT
+                    {staged}
+                FROM @{db}.{schema}.nhl_raw_data_csv/{source}/{filename}.csv
+                (FILE_FORMAT => '{db}.{schema}.csv')
+    """
+    values = ', '.join(f'src.c{idx}' for idx in range(1, len(TEAM_STAT_COLUMNS) + 1))
+
+    queries = {
+        "close_changed": f"""
+            UPDATE {db}.{schema}.{TEAM_HISTORY_TABLE} tgt
+            SET valid_to = src.updated_at, is_current = false
+            FROM ({source_rows}) src
+            WHERE tgt.Team = src.c1
+                AND tgt.season = src.season
+                AND tgt.is_current
+                AND tgt.row_hash != src.row_hash
+        """,
+        "insert_changed": f"""
+            INSERT INTO {db}.{schema}.{TEAM_HISTORY_TABLE} (
+                {', '.join(TEAM_STAT_COLUMNS)}, season, row_hash, valid_from, valid_to, is_current
+            )
+            SELECT {values}, src.season, src.row_hash, src.updated_at, NULL, true
+            FROM ({source_rows}) src
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {db}.{schema}.{TEAM_HISTORY_TABLE} cur
+                WHERE cur.is_current
+                    AND cur.Team = src.c1
+                    AND cur.season = src.season
+                    AND cur.row_hash = src.row_hash
+            )
+        """
+    }
+    print(f"Query prepared for team stats history load from external stage: \n\t{queries['insert_changed']}")
+
+    return queries
+
+
+# Marker table recording which revision of the stage and table DDL has been applied to a schema
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+
+def schema_version(db, schema, s3_bucket_name):
+    """ Fingerprint of the rendered stage and table DDL. Any change to the DDL produces a new version. """
+    ddl = list(snowflake_stages(db, schema, s3_bucket_name).values()) + list(snowflake_schema(db, schema).values())
+    return hashlib.sha256(''.join(ddl).encode()).hexdigest()[:16]
+
+
+def snowflake_schema_version_check(db, schema, version):
+    """ Set the session context and count markers for a DDL version. Fails if the marker table does not exist yet. """
+    return {
+        "use_db": f"use database {db};",
+        "use_schema": f"use schema {schema};",
+        "version": f"""
+            SELECT count(*) FROM {db}.{schema}.{SCHEMA_VERSION_TABLE}
+            WHERE version = '{version}'
+        """
+    }
+
+
+def snowflake_schema_version_mark(db, schema, version):
+    return {
+        "create_marker": f"""
+            create table if not exists {db}.{schema}.{SCHEMA_VERSION_TABLE} (
+                version varchar(16),
+                applied_at timestamp
+            )
+        """,
+        "mark_version": f"""
+            INSERT INTO {db}.{schema}.{SCHEMA_VERSION_TABLE} (version, applied_at)
+            SELECT '{version}', current_timestamp()
+        """
+    }
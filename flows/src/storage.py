@@ -0,0 +1,192 @@
+# Streaming uploads to S3. DataFrames are serialized straight into a multipart upload from memory, so nothing is
+# written to local disk and only a few parts are held in memory at once regardless of the size of the frame.
+# Every upload is recorded in the run manifest, which tells COPY INTO exactly which files this run produced.
+
+import datetime as dt
+import io
+import json
+import posixpath
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from src.connectors import get_s3_client
+from src.helpers import write_frame
+
+# S3 rejects parts smaller than 5 MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# Run manifests are kept outside every source prefix, so stage COPYs never see them
+MANIFEST_PREFIX = '_manifests'
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """ Writable binary stream backed by an S3 multipart upload.
+        Parts are uploaded in parallel as soon as `part_size` bytes are buffered, with at most `max_workers` parts
+        in flight. Objects smaller than one part are sent with a single PutObject instead.
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int = DEFAULT_PART_SIZE, max_workers: int = 4, client=None):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.client = client or get_s3_client()
+        self.bytes_written = 0
+
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed S3MultipartWriter')
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _submit_part(self, body: bytes):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+
+        part_number = len(self._parts) + 1
+        # Blocks while max_workers parts are in flight, which bounds the memory held by the writer
+        self._slots.acquire()
+        future = self._pool.submit(self._upload_part, part_number, body)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _upload_part(self, part_number: int, body: bytes):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=part_number, Body=body
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, MultipartUpload={'Parts': parts}
+                )
+        except Exception:
+            self.abort()
+            raise
+        self._pool.shutdown(wait=True)
+        self._buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        """ Drop any uploaded parts so a failed upload does not leave billable fragments behind """
+        self._pool.shutdown(wait=True)
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+
+def upload_frame(
+        data: pd.DataFrame, bucket: str, key: str, file_format: str = 'csv',
+        compression: str = 'snappy', row_group_size: int = 100_000,
+        part_size: int = DEFAULT_PART_SIZE, max_workers: int = 4
+) -> int:
+    """ Serialize a DataFrame directly into S3 and return the number of bytes uploaded """
+    writer = S3MultipartWriter(bucket, key, part_size=part_size, max_workers=max_workers)
+    try:
+        write_frame(data, writer, file_format, compression, row_group_size)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    get_run_manifest().add(bucket, key, writer.bytes_written, len(data))
+    return writer.bytes_written
+
+
+class RunManifest:
+    """ Files uploaded by one run, so loads can name them in COPY INTO ... FILES instead of listing whole prefixes.
+        Saved as JSON under s3://bucket/_manifests/ to reload exactly the files of a past run.
+    """
+
+    def __init__(self, run_id: str = None, entries: list = None):
+        self.run_id = run_id or f'{dt.datetime.now():%Y%m%d%H%M%S}_{uuid.uuid4().hex[:8]}'
+        self.entries = list(entries or [])
+        self._lock = threading.Lock()
+
+    def add(self, bucket: str, key: str, size: int, rows: int):
+        with self._lock:
+            # A file uploaded twice in one run is listed once, with its latest size
+            self.entries = [entry for entry in self.entries if (entry['bucket'], entry['key']) != (bucket, key)]
+            self.entries.append({
+                'bucket': bucket, 'key': key, 'bytes': size, 'rows': rows,
+                'uploaded_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+            })
+
+    def files(self, bucket: str, prefix: str, file_format: str = None) -> list:
+        """ Names of the files uploaded directly under `prefix`/, relative to it, as COPY INTO ... FILES expects """
+        with self._lock:
+            keys = [entry['key'] for entry in self.entries if entry['bucket'] == bucket]
+        names = [
+            posixpath.relpath(key, prefix) for key in keys
+            if posixpath.dirname(key) == prefix.strip('/')
+        ]
+        if file_format is not None:
+            names = [name for name in names if name.endswith(f'.{file_format}')]
+        return sorted(names)
+
+    def save(self, name: str, client=None) -> list:
+        """ Write the manifest to every bucket this run uploaded to, as _manifests/<name>/<run_id>.json """
+        with self._lock:
+            entries = list(self.entries)
+        if not entries:
+            return []
+
+        client = client or get_s3_client()
+        keys = []
+        for bucket in sorted({entry['bucket'] for entry in entries}):
+            key = f'{MANIFEST_PREFIX}/{name}/{self.run_id}.json'
+            body = {'run_id': self.run_id, 'files': [entry for entry in entries if entry['bucket'] == bucket]}
+            client.put_object(Bucket=bucket, Key=key, Body=json.dumps(body, indent=2).encode())
+            keys.append(f's3://{bucket}/{key}')
+        return keys
+
+    @classmethod
+    def load(cls, bucket: str, key: str, client=None) -> 'RunManifest':
+        """ Manifest of a past run, e.g. to reload its files with snowflake_ingestion(..., files=..., force=True)
+            after clearing their season with snowflake_season_cleanup
+        """
+        client = client or get_s3_client()
+        body = json.loads(client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        return cls(body['run_id'], body['files'])
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def get_run_manifest() -> RunManifest:
+    """ Manifest of the run in this process """
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = RunManifest()
+        return _manifest
@@ -0,0 +1,32 @@
+# Offline tests. S3 and Snowflake are replaced by the local backends in src.local_backend, so no credentials or
+# network are needed. Run from the repository root with `python -m pytest -q`.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefect.logging import disable_run_logger  # noqa: E402
+
+from src import connectors  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def run_logger():
+    """ Task functions are called directly, outside a flow run """
+    with disable_run_logger():
+        yield
+
+
+@pytest.fixture
+def warehouse(tmp_path, monkeypatch):
+    """ Empty local warehouse and bucket store. Yields the connection method to pass to snowflake_query_exec. """
+    monkeypatch.setenv('NHL_LOCAL_WAREHOUSE_DIR', str(tmp_path / 'warehouse'))
+    monkeypatch.setenv('NHL_S3_BACKEND', 'local')
+    monkeypatch.setenv('SNOWFLAKE_DB', 'nhl_test')
+    monkeypatch.setenv('SFSCHEMA', 'raw')
+    connectors.close_connection_pools()
+    yield 'local'
+    connectors.close_connection_pools()
@@ -0,0 +1,84 @@
+import datetime as dt
+import json
+import os
+import time
+
+import pytest
+import requests
+
+from src import http_cache
+from src.http_cache import CachedSession, HttpCache, cache_ttl, current_season
+
+PAST = 'https://www.hockey-reference.com/leagues/NHL_2020_games.html'
+
+
+class FakeSession:
+    """ Serves one body and answers conditional requests with 304 when the ETag matches """
+
+    def __init__(self, body=b'<html>games</html>', etag='"v1"'):
+        self.body, self.etag, self.requests = body, etag, []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        response = requests.Response()
+        response.url = url
+        if (headers or {}).get('If-None-Match') == self.etag:
+            response.status_code = 304
+        else:
+            response.status_code, response._content = 200, self.body
+            response.headers['ETag'] = self.etag
+        return response
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HttpCache(str(tmp_path / 'http_cache'), max_bytes=1024 * 1024)
+
+
+def test_current_season_pages_expire():
+    url = f'https://www.hockey-reference.com/leagues/NHL_{current_season()}.html'
+    assert cache_ttl(url, time.time()) == http_cache.CURRENT_SEASON_TTL['teams']
+
+
+def test_past_season_is_immutable_only_when_fetched_after_it_ended():
+    assert cache_ttl(PAST, dt.datetime(2020, 10, 1).timestamp()) is None
+    assert cache_ttl(PAST, dt.datetime(2020, 2, 1).timestamp()) == 0
+
+
+def test_copy_fetched_during_the_season_is_revalidated_once(cache):
+    session = CachedSession(FakeSession(), cache)
+    session.get(PAST)
+
+    # Pretend the cached copy was fetched while the season was still being played
+    meta, _ = cache.get(PAST)
+    meta['fetched_at'] = dt.datetime(2020, 2, 1).timestamp()
+    with open(cache._paths(PAST)[0], 'w') as f:
+        json.dump(meta, f)
+
+    assert session.get(PAST).from_cache
+    assert session.get(PAST).from_cache
+    assert session.session.requests == [{}, {'If-None-Match': '"v1"'}]
+
+
+def test_unchanged_page_is_skipped_after_it_was_processed(cache):
+    session = CachedSession(FakeSession(), cache)
+    assert session.get(PAST).content_changed
+
+    session.mark_processed(PAST)
+
+    assert not session.get(PAST).content_changed
+
+
+def test_least_recently_used_pages_are_evicted(tmp_path):
+    # Bodies are gzip compressed, so random bytes keep each entry at roughly 1.2 kB
+    cache = HttpCache(str(tmp_path / 'http_cache'), max_bytes=4000)
+    headers = requests.structures.CaseInsensitiveDict()
+
+    for idx, url in enumerate('abc'):
+        cache.put(url, os.urandom(1000), headers)
+        # Spread the access times so the order does not depend on the file system's timestamp resolution
+        os.utime(cache._paths(url)[0], (idx, idx))
+    cache.get('a')
+    cache.put('d', os.urandom(1000), headers)
+
+    assert [url for url in 'abcd' if cache.contains(url)] == ['a', 'c', 'd']
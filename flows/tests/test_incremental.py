@@ -0,0 +1,111 @@
+import datetime as dt
+
+import pandas as pd
+import pytest
+from snowflake.connector import ProgrammingError
+
+import nhl_regular_seasons
+from src import incremental
+from src.helpers import snowflake_query_exec
+
+DB, SCHEMA, BUCKET = 'nhl_test', 'raw', 'nhl-test'
+
+
+def games(*rows):
+    """ A parsed season as returned by DataTransform.seasons """
+    return pd.DataFrame({
+        'date': pd.to_datetime([row[0] for row in rows]),
+        'away_team_id': pd.Series([row[1] for row in rows], dtype='category'),
+        'away_goals': pd.Series([row[2] for row in rows], dtype='Int8'),
+        'home_team_id': pd.Series([row[3] for row in rows], dtype='category'),
+        'home_goals': pd.Series([row[4] for row in rows], dtype='Int8'),
+        'length_of_game_min': pd.Series([60] * len(rows), dtype='Int16'),
+        'updated_at': dt.datetime(2024, 1, 1),
+    })
+
+
+SEASON = games(
+    ('2023-10-10', 'Boston Bruins', 3, 'Chicago Blackhawks', 2),
+    ('2023-10-11', 'Dallas Stars', None, 'Seattle Kraken', None),
+)
+
+
+@pytest.fixture
+def watermark_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(incremental, 'WATERMARK_DIR', str(tmp_path / 'watermarks'))
+
+
+def test_without_watermark_every_game_is_new():
+    assert len(incremental.changed_rows(SEASON, None)) == 2
+
+
+def test_only_new_or_changed_games_are_returned():
+    update = games(
+        ('2023-10-10', 'Boston Bruins', 3, 'Chicago Blackhawks', 2),
+        ('2023-10-11', 'Dallas Stars', 1, 'Seattle Kraken', 4),
+        ('2023-10-12', 'Boston Bruins', None, 'Dallas Stars', None),
+    )
+
+    changes = incremental.changed_rows(update, incremental.row_hashes(SEASON))
+
+    assert changes['date'].dt.strftime('%Y-%m-%d').tolist() == ['2023-10-11', '2023-10-12']
+
+
+def test_snowflake_rows_match_the_parsed_season():
+    # Snowflake returns upper-case columns, dates and numbers rather than datetimes and nullable integers
+    stored = pd.DataFrame({
+        'DATE': [dt.date(2023, 10, 10), dt.date(2023, 10, 11)],
+        'AWAY_TEAM_ID': ['Boston Bruins', 'Dallas Stars'],
+        'AWAY_GOALS': [3.0, None],
+        'HOME_TEAM_ID': ['Chicago Blackhawks', 'Seattle Kraken'],
+        'HOME_GOALS': [2.0, None],
+        'LENGTH_OF_GAME_MIN': ['60', '60'],
+    })
+
+    assert not len(incremental.changed_rows(SEASON, incremental.snowflake_watermark(stored)))
+
+
+def test_duplicate_watermark_keys_do_not_misalign_the_diff():
+    watermark = incremental.row_hashes(SEASON)
+    watermark = pd.concat([watermark, watermark.iloc[[0]]], ignore_index=True)
+
+    assert not len(incremental.changed_rows(SEASON, watermark))
+
+
+def test_local_watermark_round_trip(watermark_dir):
+    assert incremental.load_local_watermark('regular_season', 2024) is None
+
+    incremental.save_local_watermark(SEASON, 'regular_season', 2024)
+    loaded = incremental.load_local_watermark('regular_season', 2024)
+
+    assert not len(incremental.changed_rows(SEASON, loaded))
+
+
+def stage_increment(filename, data):
+    nhl_regular_seasons.s3_parser.fn(
+        filename=filename, data=data, s3_folder='seasons_incremental', s3_bucket_name=BUCKET
+    )
+
+
+def test_merge_upserts_changed_games(warehouse):
+    nhl_regular_seasons.snowflake_base_model.fn(warehouse, BUCKET, DB, SCHEMA, raise_errors=True)
+    stage_increment('NHL_2024_1', SEASON)
+    nhl_regular_seasons.snowflake_merge_load.fn(DB, SCHEMA, 'regular_season', 'seasons_incremental', 'NHL_2024_1', warehouse)
+
+    played = games(('2023-10-11', 'Dallas Stars', 1, 'Seattle Kraken', 4))
+    stage_increment('NHL_2024_2', played)
+    nhl_regular_seasons.snowflake_merge_load.fn(DB, SCHEMA, 'regular_season', 'seasons_incremental', 'NHL_2024_2', warehouse)
+
+    rows = snowflake_query_exec(
+        {'rows': f'select * from {DB}.{SCHEMA}.regular_season order by date'}, method=warehouse
+    )['rows']
+    assert len(rows) == 2
+    assert rows.rename(columns=str.lower)['home_goals'].tolist()[1] == 4
+
+
+def test_failed_merge_fails_the_task(warehouse):
+    # Without the table the MERGE fails. The flow saves the watermark after this task, so it is never reached.
+    with pytest.raises(ProgrammingError):
+        nhl_regular_seasons.snowflake_merge_load.fn(
+            DB, SCHEMA, 'regular_season', 'seasons_incremental', 'NHL_2024_missing', warehouse
+        )
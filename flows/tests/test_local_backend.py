@@ -0,0 +1,74 @@
+import glob
+import os
+
+import pytest
+
+import nhl_regular_seasons
+from src.helpers import snowflake_query_exec, snowflake_stage_load
+from src.local_backend import local_root
+from src.snowflake_queries import snowflake_ingestion
+from src.storage import upload_frame
+from test_incremental import games
+
+DB, SCHEMA, BUCKET = 'nhl_test', 'raw', 'nhl-test'
+
+OCTOBER = games(('2023-10-10', 'Boston Bruins', 3, 'Chicago Blackhawks', 2))
+NOVEMBER = games(
+    ('2023-11-01', 'Dallas Stars', 1, 'Seattle Kraken', 4),
+    ('2023-11-02', 'Seattle Kraken', 2, 'Boston Bruins', 5),
+)
+
+
+@pytest.fixture
+def model(warehouse):
+    nhl_regular_seasons.snowflake_base_model.fn(warehouse, BUCKET, DB, SCHEMA, raise_errors=True)
+    upload_frame(OCTOBER, BUCKET, 'seasons/october.csv')
+    upload_frame(NOVEMBER, BUCKET, 'seasons/november.csv')
+    return warehouse
+
+
+def query(method, sql):
+    return snowflake_query_exec({'rows': sql}, method=method)['rows']
+
+
+def games_loaded(method):
+    return int(query(method, f'select count(*) as games from {DB}.{SCHEMA}.regular_season').iloc[0, 0])
+
+
+def test_copy_files_loads_only_the_named_files(model):
+    snowflake_query_exec(snowflake_ingestion(DB, SCHEMA, 'regular_season', 'seasons', files=['november.csv']), model)
+    assert games_loaded(model) == 2
+
+
+def test_load_history_skips_files_unless_forced(model):
+    load = snowflake_ingestion(DB, SCHEMA, 'regular_season', 'seasons', files=['october.csv'])
+    snowflake_query_exec(load, method=model)
+    snowflake_query_exec(load, method=model)
+    assert games_loaded(model) == 1
+
+    snowflake_query_exec(
+        snowflake_ingestion(DB, SCHEMA, 'regular_season', 'seasons', files=['october.csv'], force=True), method=model
+    )
+    assert games_loaded(model) == 2
+
+
+def test_copy_pattern_loads_every_file_under_the_prefix(model):
+    snowflake_query_exec(snowflake_ingestion(DB, SCHEMA, 'regular_season', 'seasons'), method=model)
+    assert games_loaded(model) == 3
+
+
+def test_positional_columns_are_read_from_stage_files(model):
+    rows = query(model, f"""
+        select $1::date as date, $3::number as away_goals
+        from @{DB}.{SCHEMA}.nhl_raw_data_csv/seasons/november.csv (FILE_FORMAT => '{DB}.{SCHEMA}.csv')
+        order by 1
+    """)
+    assert rows.rename(columns=str.lower)['away_goals'].tolist() == [1, 2]
+
+
+def test_stage_load_puts_every_chunk_and_purges_it(model):
+    staged = snowflake_stage_load(NOVEMBER, DB, SCHEMA, 'regular_season', 'seasons_2024', model, chunk_size=1)
+
+    assert staged['files'] == 2
+    assert games_loaded(model) == 2
+    assert not glob.glob(os.path.join(local_root(), 'table_stages', '**', '*.gz'), recursive=True)
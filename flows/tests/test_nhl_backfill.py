@@ -0,0 +1,89 @@
+import datetime as dt
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+import nhl_backfill
+import nhl_regular_seasons
+from src.fetcher import FetchResult
+from src.helpers import snowflake_query_exec
+from src.schema_registry import SchemaRegistry
+from src.snowflake_queries import TEAM_HISTORY_TABLE
+
+FLOWS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB, SCHEMA, BUCKET = 'nhl_test', 'raw', 'nhl-test'
+
+
+def standings(*teams):
+    """ A parsed standings page as returned by DataTransform.teams """
+    rows = len(teams)
+    return pd.DataFrame({
+        'Team': list(teams),
+        'GP': [82] * rows, 'W': [41] * rows, 'L': [31] * rows, 'OL': [10] * rows,
+        'PTS': [92] * rows, 'PTS%': [0.561] * rows, 'GF': [250] * rows, 'GA': [240] * rows,
+        'SRS': [0.1] * rows, 'SOS': [0.0] * rows, 'RPt%': [0.55] * rows, 'RW': [35] * rows,
+        'RgRec': ['41-31-10'] * rows, 'RgPt%': [0.561] * rows,
+        'updated_at': dt.datetime(2024, 7, 1),
+    })
+
+
+def test_reversed_season_range_is_rejected():
+    result = subprocess.run(
+        [sys.executable, 'nhl_backfill.py', 'teams', '--start_year', '2024', '--end_year', '2020'],
+        cwd=FLOWS_DIR, capture_output=True, text=True
+    )
+
+    assert result.returncode == 2
+    assert '--start_year 2024 is after --end_year 2020' in result.stderr
+
+
+def backfill_teams(method, day):
+    results = {'teams': {
+        year: (f'NHL_{year}_team_stats_{day}', standings('Boston Bruins', 'Dallas Stars')) for year in (2023, 2024)
+    }}
+    uploaded = nhl_backfill.backfill_s3_parser.fn(results, s3_bucket_name=BUCKET)
+    nhl_backfill.backfill_history_load.fn(DB, SCHEMA, 'teams', uploaded['teams'], method)
+
+
+def test_rerunning_a_team_backfill_does_not_duplicate_seasons(warehouse):
+    nhl_regular_seasons.snowflake_base_model.fn(warehouse, BUCKET, DB, SCHEMA, raise_errors=True)
+
+    # Files are date-stamped, so a re-run on another day stages new files for the same seasons
+    backfill_teams(warehouse, '2024-10-01')
+    backfill_teams(warehouse, '2024-10-02')
+
+    rows = snowflake_query_exec(
+        {'rows': f'select season, count(*) as teams from {DB}.{SCHEMA}.{TEAM_HISTORY_TABLE} group by season'},
+        method=warehouse
+    )['rows'].rename(columns=str.lower)
+    assert dict(zip(rows['season'].astype(int), rows['teams'].astype(int))) == {2023: 2, 2024: 2}
+
+
+def test_a_season_failing_the_column_check_is_skipped(warehouse, tmp_path, monkeypatch):
+    nhl_regular_seasons.snowflake_base_model.fn(warehouse, BUCKET, DB, SCHEMA, raise_errors=True)
+
+    def fetch_pages(urls, **kwargs):
+        pages = {}
+        for url in urls:
+            pages[url] = FetchResult(url)._set(200, url.encode())
+        return pages
+
+    def transform_page(source, year, content):
+        dataframe = standings('Boston Bruins')
+        if year == 2004:
+            # Ties instead of overtime losses
+            dataframe = dataframe.rename(columns={'OL': 'T'})
+        return dataframe
+
+    monkeypatch.setattr(nhl_backfill, 'fetch_pages', fetch_pages)
+    monkeypatch.setattr(nhl_backfill, 'transform_page', transform_page)
+    registry = SchemaRegistry(path=str(tmp_path / 'schema_registry.json'))
+    monkeypatch.setattr(nhl_backfill, 'get_schema_registry', lambda: registry)
+
+    results = nhl_backfill.backfill_fetch.fn(
+        DB, ['teams'], 'https://www.hockey-reference.com/leagues/', [2004, 2006], warehouse, cache=False, schema=SCHEMA
+    )
+
+    assert list(results['teams']) == [2006]
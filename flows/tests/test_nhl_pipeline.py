@@ -0,0 +1,40 @@
+import pytest
+from snowflake.connector import ProgrammingError
+
+import nhl_pipeline
+import nhl_regular_seasons
+from src.helpers import snowflake_query_exec
+from src.snowflake_queries import schema_version, snowflake_schema, snowflake_schema_version_check
+
+DB, SCHEMA, BUCKET = 'nhl_test', 'raw', 'nhl-test'
+
+
+def applied_versions(method):
+    version = schema_version(DB, SCHEMA, BUCKET)
+    return (snowflake_query_exec(
+        snowflake_schema_version_check(DB, SCHEMA, version), method=method, fetch={'version': 'scalar'}
+    ) or {}).get('version')
+
+
+def test_versioned_base_model_applies_once(warehouse):
+    version = nhl_pipeline.snowflake_base_model_versioned.fn(warehouse, BUCKET, DB, SCHEMA)
+
+    assert version == schema_version(DB, SCHEMA, BUCKET)
+    assert applied_versions(warehouse) == 1
+
+
+def test_failed_ddl_does_not_mark_the_version(warehouse, monkeypatch):
+    def broken_schema(db, schema):
+        queries = snowflake_schema(db, schema)
+        queries['regular_season'] = f'create tabel {db}.{schema}.regular_season (date date)'
+        return queries
+
+    with monkeypatch.context() as patch:
+        patch.setattr(nhl_regular_seasons, 'snowflake_schema', broken_schema)
+        with pytest.raises(ProgrammingError):
+            nhl_pipeline.snowflake_base_model_versioned.fn(warehouse, BUCKET, DB, SCHEMA)
+    assert not applied_versions(warehouse)
+
+    # The next run retries the DDL
+    nhl_pipeline.snowflake_base_model_versioned.fn(warehouse, BUCKET, DB, SCHEMA)
+    assert applied_versions(warehouse) == 1
@@ -0,0 +1,50 @@
+import pytest
+
+import nhl_regular_seasons
+from src.helpers import snowflake_query_exec
+from src.storage import upload_frame
+from test_incremental import games
+
+DB, SCHEMA, BUCKET = 'nhl_test', 'raw', 'nhl-test'
+
+SEASON_2023 = games(('2023-01-15', 'Boston Bruins', 3, 'Chicago Blackhawks', 2))
+SEASON_2024 = games(
+    ('2023-10-10', 'Dallas Stars', 1, 'Seattle Kraken', 4),
+    ('2024-04-01', 'Seattle Kraken', 2, 'Boston Bruins', 5),
+)
+
+
+@pytest.fixture
+def seasons(warehouse):
+    nhl_regular_seasons.snowflake_base_model.fn(warehouse, BUCKET, DB, SCHEMA, raise_errors=True)
+    upload_frame(SEASON_2023, BUCKET, 'seasons/NHL_2023_regular_season.csv')
+    upload_frame(SEASON_2024, BUCKET, 'seasons/NHL_2024_regular_season.csv')
+    for year in (2023, 2024):
+        load(warehouse, year, [f'NHL_{year}_regular_season.csv'])
+    return warehouse
+
+
+def load(method, year, files):
+    nhl_regular_seasons.snowflake_load.fn(DB, SCHEMA, 'regular_season', year, 'seasons', method, 'csv', files)
+
+
+def games_per_season(method):
+    rows = snowflake_query_exec({'rows': f"""
+        select case when date < '2023-07-01' then 2023 else 2024 end as season, count(*) as games
+        from {DB}.{SCHEMA}.regular_season group by 1
+    """}, method=method)['rows'].rename(columns=str.lower)
+    return dict(zip(rows['season'].astype(int), rows['games'].astype(int)))
+
+
+def test_reloading_a_season_replaces_only_its_games(seasons):
+    # The file is in the load history already, the cleanup makes it safe to force
+    load(seasons, 2024, ['NHL_2024_regular_season.csv'])
+
+    assert games_per_season(seasons) == {2023: 1, 2024: 2}
+
+
+def test_reload_without_files_fails_before_the_season_is_cleared(seasons):
+    with pytest.raises(ValueError):
+        load(seasons, 2024, [])
+
+    assert games_per_season(seasons) == {2023: 1, 2024: 2}
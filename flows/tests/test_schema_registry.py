@@ -0,0 +1,60 @@
+import datetime as dt
+
+import pandas as pd
+
+import nhl_regular_seasons
+from src.schema_registry import SchemaRegistry, type_family, validate_frame
+
+COLUMNS = [('date', 'DATE'), ('away_team_id', 'VARCHAR'), ('away_goals', 'NUMBER(38,0)')]
+
+
+def frame(**columns):
+    return pd.DataFrame(columns)
+
+
+def test_matching_frame_has_no_problems():
+    dataframe = frame(date=[dt.datetime(2024, 1, 1)], away_team_id=['Boston Bruins'], away_goals=[3])
+    assert validate_frame(dataframe, COLUMNS) == []
+
+
+def test_missing_and_unexpected_columns_are_reported():
+    # Seasons before 2005-06 carry ties (T) instead of overtime losses (OL)
+    dataframe = frame(date=['2004-01-01'], away_team_id=['Boston Bruins'], T=[1])
+    assert validate_frame(dataframe, COLUMNS) == ["missing columns: ['away_goals']", "unexpected columns: ['T']"]
+
+
+def test_column_order_only_matters_for_positional_loads():
+    dataframe = frame(away_team_id=['Boston Bruins'], date=['2024-01-01'], away_goals=[3])
+
+    assert len(validate_frame(dataframe, COLUMNS)) == 1
+    assert validate_frame(dataframe, COLUMNS, positional=False) == []
+
+
+def test_values_that_cannot_load_into_the_column_type():
+    dataframe = frame(date=['not a date'], away_team_id=['Boston Bruins'], away_goals=['three'])
+    assert len(validate_frame(dataframe, COLUMNS)) == 2
+
+
+def test_type_families():
+    assert [type_family(name) for name in ('VARCHAR(16777216)', 'BIGINT', 'TIMESTAMP_NTZ', 'VARIANT')] == [
+        'text', 'numeric', 'temporal', None
+    ]
+
+
+def test_missing_table():
+    assert validate_frame(frame(a=[1]), []) == ['destination table not found']
+
+
+def test_definitions_are_read_from_the_warehouse_once(warehouse, tmp_path, monkeypatch):
+    nhl_regular_seasons.snowflake_base_model.fn(warehouse, 'nhl-test', 'nhl_test', 'raw', raise_errors=True)
+    loads = []
+    load = SchemaRegistry._load
+    monkeypatch.setattr(SchemaRegistry, '_load', staticmethod(lambda *args: loads.append(args) or load(*args)))
+
+    registry = SchemaRegistry(path=str(tmp_path / 'schema_registry.json'))
+    columns = registry.columns('nhl_test', 'raw', 'regular_season', warehouse)
+    # A second registry reads the snapshot written by the first instead of querying again
+    assert SchemaRegistry(path=registry.path).columns('nhl_test', 'raw', 'regular_season', warehouse) == columns
+
+    assert [name for name, _ in columns][:2] == ['date', 'away_team_id']
+    assert len(loads) == 1
@@ -0,0 +1,88 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from src import storage
+from src.local_backend import LocalS3Client
+from src.storage import MIN_PART_SIZE, RunManifest, S3MultipartWriter, upload_frame
+from test_incremental import games
+
+BUCKET = 'nhl-test'
+
+
+class RecordingClient(LocalS3Client):
+    """ Local S3 client that records its calls and can fail a given part """
+
+    def __init__(self, fail_part: int = None):
+        super().__init__()
+        self.calls, self.fail_part = [], fail_part
+
+    def put_object(self, **kwargs):
+        self.calls.append('put_object')
+        return super().put_object(**kwargs)
+
+    def upload_part(self, **kwargs):
+        self.calls.append('upload_part')
+        if kwargs['PartNumber'] == self.fail_part:
+            raise IOError('connection reset')
+        return super().upload_part(**kwargs)
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append('abort_multipart_upload')
+        return super().abort_multipart_upload(**kwargs)
+
+
+@pytest.fixture
+def manifest(warehouse, monkeypatch):
+    monkeypatch.setattr(storage, '_manifest', RunManifest())
+    return storage.get_run_manifest()
+
+
+def read(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+def test_small_objects_are_sent_with_one_put(warehouse):
+    client = RecordingClient()
+    with S3MultipartWriter(BUCKET, 'small.bin', client=client) as writer:
+        writer.write(b'x' * 100)
+
+    assert client.calls == ['put_object']
+    assert read(client, 'small.bin') == b'x' * 100
+
+
+def test_large_objects_are_uploaded_in_parts(warehouse):
+    client = RecordingClient()
+    body = os.urandom(2 * MIN_PART_SIZE + 1024)
+    with S3MultipartWriter(BUCKET, 'large.bin', part_size=MIN_PART_SIZE, max_workers=2, client=client) as writer:
+        for idx in range(0, len(body), 1024 * 1024):
+            writer.write(body[idx:idx + 1024 * 1024])
+
+    assert client.calls == ['upload_part'] * 3
+    assert read(client, 'large.bin') == body
+
+
+def test_a_failed_part_aborts_the_upload(warehouse):
+    client = RecordingClient(fail_part=1)
+    writer = S3MultipartWriter(BUCKET, 'failed.bin', part_size=MIN_PART_SIZE, client=client)
+    writer.write(os.urandom(MIN_PART_SIZE + 1))
+
+    with pytest.raises(IOError):
+        writer.close()
+    assert client.calls[-1] == 'abort_multipart_upload'
+    with pytest.raises(FileNotFoundError):
+        read(client, 'failed.bin')
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_upload_frame_round_trip_is_recorded_in_the_manifest(manifest, file_format):
+    data = games(('2023-10-10', 'Boston Bruins', 3, 'Chicago Blackhawks', 2))
+    size = upload_frame(data, BUCKET, f'seasons/NHL_2024.{file_format}', file_format)
+
+    body = io.BytesIO(read(LocalS3Client(), f'seasons/NHL_2024.{file_format}'))
+    loaded = pd.read_csv(body) if file_format == 'csv' else pd.read_parquet(body)
+    assert loaded['home_team_id'].astype(str).tolist() == ['Chicago Blackhawks']
+    assert manifest.files(BUCKET, 'seasons', file_format) == [f'NHL_2024.{file_format}']
+    assert manifest.entries[0]['bytes'] == size